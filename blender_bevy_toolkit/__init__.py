@@ -105,6 +105,103 @@ class ExportBevy(bpy.types.Operator, ExportHelper):
 
     filename_ext = ".scn"
     filter_glob: bpy.props.StringProperty(default="*.scn", options={"HIDDEN"})
+    compact_ron: bpy.props.BoolProperty(
+        name="Compact",
+        description="Write the scene without any whitespace (smaller and faster to load)",
+        default=False,
+    )
+    scene_format: bpy.props.EnumProperty(
+        name="Scene Format",
+        items=[
+            ("ron", "RON", "Human readable .scn file"),
+            ("binary", "Binary", "CBOR .scnb file. Faster to write and to load"),
+        ],
+        default="ron",
+    )
+    use_export_cache: bpy.props.BoolProperty(
+        name="Use Export Cache",
+        description=(
+            "Reuse meshes and materials written by previous exports to the same "
+            "folder. Writes export_cache.json into the output folder"
+        ),
+        default=False,
+    )
+    incremental_export: bpy.props.BoolProperty(
+        name="Incremental",
+        description="Only encode the objects that changed since the last export",
+        default=False,
+    )
+    vertex_merge_tolerance: bpy.props.FloatProperty(
+        name="Vertex Merge Tolerance",
+        description=(
+            "Merge vertices whose attributes round to the same multiple of this. "
+            "Zero only merges identical vertices"
+        ),
+        default=0.0,
+        min=0.0,
+        precision=5,
+    )
+    mesh_encoding: bpy.props.EnumProperty(
+        name="Mesh Encoding",
+        description="Store mesh attributes in less space, at some cost in precision",
+        items=[
+            (
+                "quantized_positions",
+                "16 Bit Positions",
+                "Positions within the bounding box",
+            ),
+            ("snorm16_tangents", "16 Bit Tangents", "Each component of the tangent"),
+            ("half_uvs", "Half Float UVs", "16 bit floating point UVs"),
+            ("u16_indices", "16 Bit Indices", "For meshes with few enough vertices"),
+        ],
+        options={"ENUM_FLAG"},
+        default=set(),
+    )
+    normal_encoding: bpy.props.EnumProperty(
+        name="Normal Encoding",
+        description="Store mesh normals in less space, at some cost in precision",
+        items=[
+            ("none", "32 Bit Normals", "Each component of the normal as a float"),
+            ("snorm16_normals", "16 Bit Normals", "Each component of the normal"),
+            (
+                "octahedral_normals",
+                "Octahedral Normals",
+                "Two 16 bit values per normal",
+            ),
+        ],
+        default="none",
+    )
+    optimize_mesh_order: bpy.props.BoolProperty(
+        name="Optimize Mesh Order",
+        description="Reorder triangles and vertices so meshes render faster. Slower to export",
+        default=False,
+    )
+    asset_compression: bpy.props.EnumProperty(
+        name="Compression",
+        description="Compress meshes, materials and binary scenes",
+        items=[
+            ("none", "None", "Write files uncompressed"),
+            ("zstd", "Zstandard", "Smaller files"),
+            ("lz4", "LZ4", "Faster to load, but larger than zstd"),
+        ],
+        default="none",
+    )
+    material_dictionary: bpy.props.BoolProperty(
+        name="Material Dictionary",
+        description=(
+            "With Zstandard compression, train a dictionary on the materials of "
+            "the export and compress them with it"
+        ),
+        default=False,
+    )
+    batch_instances: bpy.props.BoolProperty(
+        name="Batch Instances",
+        description=(
+            "Export objects that share a mesh and material, and only differ "
+            "in their transform, as one entity per group"
+        ),
+        default=False,
+    )
 
     def execute(self, _context):
         """Begin the export"""
@@ -112,13 +209,30 @@ class ExportBevy(bpy.types.Operator, ExportHelper):
         if not self.filepath:
             raise Exception("filepath not set")
 
+        mesh_encoding = set(self.mesh_encoding)
+        if self.normal_encoding != "none":
+            mesh_encoding.add(self.normal_encoding)
+
         do_export(
             {
                 "output_filepath": self.filepath,
                 "mesh_output_folder": "meshes",
                 "material_output_folder": "materials",
                 "texture_output_folder": "textures",
+                "collection_output_folder": "collections",
+                "instance_output_folder": "instances",
                 "make_duplicates_real": False,
+                "vertex_merge_tolerance": self.vertex_merge_tolerance,
+                "use_export_cache": self.use_export_cache,
+                "export_cache_max_entries": 10000,
+                "compact_ron": self.compact_ron,
+                "scene_format": self.scene_format,
+                "incremental_export": self.incremental_export,
+                "batch_instances": self.batch_instances,
+                "mesh_encoding": sorted(mesh_encoding),
+                "optimize_mesh_order": self.optimize_mesh_order,
+                "asset_compression": self.asset_compression,
+                "material_dictionary": self.material_dictionary,
             }
         )
 
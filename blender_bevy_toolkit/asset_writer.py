@@ -0,0 +1,171 @@
+""" Writes the files referenced by a scene (meshes, materials, textures) on
+background threads, so that the exporter doesn't wait on the disk.
+
+Files are written to a temporary file next to their destination and then
+renamed into place. The rename is atomic, so a file with the final name is
+always complete. This matters because these files are named after their
+contents: an export that finds a file already exists trusts that it holds
+the right data, and a file left half written by a crash would never be
+replaced.
+
+Files can be compressed on the way (see compression.py), which also happens
+on the background threads.
+
+Copies (eg of textures) are made as reflinks where the filesystem supports
+them (eg btrfs or XFS), which share the data with the source until either
+is modified. Hard links can be used too, but aren't by default: if the
+source is later edited in place, the exported file changes with it and no
+longer matches its name.
+"""
+import os
+import sys
+import shutil
+import logging
+import threading
+import concurrent.futures
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .utils import jdict
+from .compression import Compressor
+
+logger = logging.getLogger(__name__)
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+
+class AssetWriter:
+    """A queue of files to write. Call `join` to wait for all of them to
+    be written, which raises the first error any of them hit.
+
+    With fsync set, the data is flushed to disk before the file is renamed
+    into place. This is slower but also survives the machine losing power.
+    With hardlink set, copies are made by hard linking to the source where
+    possible. Files written with compress set are compressed by the
+    compressor, if there is one"""
+
+    def __init__(self, max_workers=None, fsync=False, hardlink=False, compressor=None):
+        self.fsync = fsync
+        self.hardlink = hardlink
+        self.compressor = compressor if compressor is not None else Compressor()
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="asset_writer"
+        )
+        self.futures = []
+        self.queued = set()
+        self.lock = threading.Lock()
+
+    def write(self, path, data, compress=False, dictionary=None):
+        """Write bytes to path, unless the file already exists. With compress
+        set, the data is compressed first (with the dictionary, if given)"""
+        if self._should_write(path):
+            logger.info(jdict(event="writing_asset", path=path))
+            if compress and self.compressor.enabled:
+                self._submit(self._compress_and_write, path, data, dictionary)
+            else:
+                self._submit(self._write, path, data)
+
+    def copy(self, source, path):
+        """Copy the file at source to path, unless the file already exists"""
+        if self._should_write(path):
+            logger.info(jdict(event="copying_asset", source=source, path=path))
+            self._submit(self._copy, source, path)
+
+    def join(self):
+        """Wait for every queued file to be written"""
+        self.pool.shutdown(wait=True)
+        for future in self.futures:
+            future.result()
+
+    def _should_write(self, path):
+        """Checks if a file still needs writing. Files are named after their
+        contents, so one that exists (or is already queued) is the same"""
+        with self.lock:
+            if path in self.queued or os.path.exists(path):
+                return False
+            self.queued.add(path)
+            return True
+
+    def _submit(self, function, *args):
+        future = self.pool.submit(function, *args)
+        with self.lock:
+            self.futures.append(future)
+
+    def _write(self, path, data):
+        with self._atomic(path) as outfile:
+            outfile.write(data)
+
+    def _compress_and_write(self, path, data, dictionary):
+        self._write(path, self.compressor.compress(data, dictionary))
+
+    def _copy(self, source, path):
+        if self.hardlink:
+            temp = temp_path(path)
+            try:
+                os.link(source, temp)
+            except OSError:
+                # Eg the source is on a different filesystem
+                pass
+            else:
+                os.replace(temp, path)
+                return
+
+        with open(source, "rb") as infile, self._atomic(path) as outfile:
+            if not reflink(infile, outfile):
+                shutil.copyfileobj(infile, outfile)
+
+    def _atomic(self, path):
+        return AtomicFile(path, self.fsync)
+
+
+class AtomicFile:
+    """A file opened for binary writing that only appears at its path once
+    it has been closed without an error"""
+
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self.temp_path = temp_path(path)
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.temp_path, "wb")
+        return self.file
+
+    def __exit__(self, exc_type, _exc_value, _traceback):
+        complete = False
+        try:
+            if exc_type is None:
+                self.file.flush()
+                if self.fsync:
+                    os.fsync(self.file.fileno())
+                complete = True
+        finally:
+            self.file.close()
+            if complete:
+                os.replace(self.temp_path, self.path)
+            else:
+                os.remove(self.temp_path)
+        return False
+
+
+def temp_path(path):
+    """A temporary file to write before renaming it to path. Unique per
+    thread, in case two exports write the same file at once"""
+    return f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+
+
+def reflink(infile, outfile):
+    """Make outfile share the data of infile, if the filesystem supports it.
+    Returns False if it doesn't"""
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return False
+    try:
+        fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+    except OSError:
+        return False
+    return True
@@ -72,3 +72,10 @@ def register_component(cls):
     COMPONENTS.append(cls)
     COMPONENTS.sort(key=lambda c: c.__name__)
     return cls
+
+
+def get_entity_id(config, obj):
+    """Returns the ID of the entity an object is exported as. Components
+    that reference other objects (eg a parent) should use this rather than
+    searching through the scene"""
+    return config["entity_ids"][obj]
@@ -0,0 +1,182 @@
+""" Optional compression of exported files.
+
+Meshes, instance transforms, binary scenes and materials can be compressed
+as a whole with zstd (https://facebook.github.io/zstd) or LZ4
+(https://lz4.org). The loaders in src/ recognise a compressed file by the
+magic bytes every zstd and LZ4 frame starts with, and load anything else
+as it is. So compression can be turned on and off without changing the
+scene, and a file that doesn't get any smaller is simply left uncompressed.
+
+Files are still named after their uncompressed contents, so the same mesh
+gets the same name whether or not it is compressed.
+
+Materials are small RON files, which compress poorly on their own because
+there is little repetition within any one of them. They have a lot in
+common with each other though, so with zstd a dictionary can be trained
+on all the materials of an export and used to compress each of them. The
+dictionary is written next to the materials as `<dictionary id>.zdict`,
+where the loader finds it from the dictionary ID in the zstd frame header.
+
+Both libraries are optional dependencies. If the one asked for isn't
+installed, files are written uncompressed.
+"""
+import os
+import logging
+import contextlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+from .utils import jdict, hash_bytes
+
+logger = logging.getLogger(__name__)
+
+
+COMPRESSION_METHODS = ("none", "zstd", "lz4")
+
+# The first four bytes of a zstd frame and of an LZ4 frame
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+LZ4_MAGIC = b"\x04\x22\x4d\x18"
+
+DICTIONARY_SUFFIX = ".zdict"
+
+# Dictionaries trained on fewer files than this rarely help, and zstd often
+# refuses to train them at all
+MIN_DICTIONARY_SAMPLES = 8
+
+DEFAULT_DICTIONARY_SIZE = 16 * 1024
+
+# zstd reserves dictionary IDs below this, and some decoders only handle
+# IDs that fit in 31 bits
+MIN_DICTIONARY_ID = 1 << 15
+MAX_DICTIONARY_ID = (1 << 31) - 1
+
+
+class Compressor:
+    """Compresses data with one of the COMPRESSION_METHODS. A level of None
+    uses the library's default"""
+
+    def __init__(self, method="none", level=None):
+        if method not in COMPRESSION_METHODS:
+            raise ValueError(f"Unknown compression method {method}")
+        if method == "zstd" and zstandard is None:
+            logger.warning(jdict(event="zstandard_unavailable", using="none"))
+            method = "none"
+        if method == "lz4" and lz4_frame is None:
+            logger.warning(jdict(event="lz4_unavailable", using="none"))
+            method = "none"
+        self.method = method
+        self.level = level
+
+    @property
+    def enabled(self):
+        """If anything is compressed at all"""
+        return self.method != "none"
+
+    def compress(self, data, dictionary=None):
+        """Compress data into a single frame, or return it as it is if that
+        doesn't make it any smaller. The dictionary (from train_dictionary)
+        is only used by zstd"""
+        if self.method == "zstd":
+            compressed = self._zstd(dictionary).compress(data)
+        elif self.method == "lz4":
+            compressed = lz4_frame.compress(data, **self._lz4_args())
+        else:
+            return data
+        return compressed if len(compressed) < len(data) else data
+
+    @contextlib.contextmanager
+    def stream(self, outfile):
+        """A binary file-like object that compresses everything written to
+        it into outfile, for data that isn't held in memory all at once"""
+        if self.method == "zstd":
+            with self._zstd().stream_writer(outfile, closefd=False) as writer:
+                yield writer
+        elif self.method == "lz4":
+            with lz4_frame.LZ4FrameFile(outfile, "wb", **self._lz4_args()) as writer:
+                yield writer
+        else:
+            yield outfile
+
+    def train_dictionary(self, samples, size=DEFAULT_DICTIONARY_SIZE):
+        """Train a zstd dictionary on some samples of the data it will be
+        used to compress. Returns the dictionary ID and the dictionary, or
+        None if there isn't a dictionary worth using.
+
+        The ID is derived from the samples, so that the same samples always
+        give a dictionary with the same ID"""
+        if self.method != "zstd" or len(samples) < MIN_DICTIONARY_SAMPLES:
+            return None
+        dict_id = MIN_DICTIONARY_ID + int(
+            hash_bytes(b"".join(samples), "md5")[:8], 16
+        ) % (MAX_DICTIONARY_ID - MIN_DICTIONARY_ID)
+        try:
+            dictionary = zstandard.train_dictionary(
+                size, samples, dict_id=dict_id, level=self.level or 0
+            )
+        except zstandard.ZstdError as err:
+            logger.info(jdict(event="dictionary_training_failed", err=str(err)))
+            return None
+        return dict_id, dictionary.as_bytes()
+
+    def _zstd(self, dictionary=None):
+        # Compressors can't be shared between threads, and are cheap to make
+        args = {}
+        if self.level is not None:
+            args["level"] = self.level
+        if dictionary is not None:
+            args["dict_data"] = zstandard.ZstdCompressionDict(dictionary)
+        return zstandard.ZstdCompressor(**args)
+
+    def _lz4_args(self):
+        if self.level is None:
+            return {}
+        return {"compression_level": self.level}
+
+
+def dictionary_path(folder, dict_id):
+    """Where the dictionary with some ID is written. The loader looks for it
+    next to the file compressed with it (see src/blend_compression.rs)"""
+    return os.path.join(folder, f"{dict_id:08x}{DICTIONARY_SUFFIX}")
+
+
+class DictionaryGroup:
+    """Files compressed with a dictionary shared between them. The files are
+    held back until `write` is called, which trains the dictionary on all of
+    them and then queues them to be written"""
+
+    def __init__(self, folder, size=DEFAULT_DICTIONARY_SIZE):
+        self.folder = folder
+        self.size = size
+        self.files = {}
+
+    def add(self, path, data):
+        """Hold a file back until the dictionary has been trained"""
+        self.files[path] = data
+
+    def write(self, asset_writer):
+        """Train the dictionary and queue it and every file to be written.
+        If no dictionary could be trained, files are compressed without one"""
+        paths = sorted(self.files)
+        trained = asset_writer.compressor.train_dictionary(
+            [self.files[p] for p in paths], self.size
+        )
+        dictionary = None
+        if trained is not None:
+            dict_id, dictionary = trained
+            asset_writer.write(dictionary_path(self.folder, dict_id), dictionary)
+            logger.info(
+                jdict(event="trained_dictionary", dict_id=dict_id, files=len(paths))
+            )
+        for path in paths:
+            asset_writer.write(
+                path, self.files[path], compress=True, dictionary=dictionary
+            )
+        self.files = {}
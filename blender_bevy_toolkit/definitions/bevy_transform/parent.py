@@ -1,6 +1,7 @@
 from blender_bevy_toolkit.component_base import (
     register_component,
     ComponentBase,
+    get_entity_id,
 )
 from blender_bevy_toolkit import rust_types
 
@@ -9,10 +10,11 @@ from blender_bevy_toolkit import rust_types
 class Parent(ComponentBase):
     def encode(config, obj):
         """Returns a Component representing this component"""
+        if obj.parent not in config["entity_ids"]:
+            # The parent isn't part of the instanced collection being exported
+            return None
 
-        collection_objs = list(config["scene"].objects)
-
-        parent_id = collection_objs.index(obj.parent)
+        parent_id = get_entity_id(config, obj.parent)
 
         return rust_types.Map(
             type="bevy_transform::components::parent::Parent",
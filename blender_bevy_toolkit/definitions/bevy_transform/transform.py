@@ -1,3 +1,4 @@
+import mathutils
 from blender_bevy_toolkit.component_base import (
     register_component,
     ComponentBase,
@@ -28,10 +29,15 @@ class Transform(ComponentBase):
         }
         """
 
-        if obj.parent is None:
-            transform = obj.matrix_world
-        else:
+        if obj.parent is not None and obj.parent in config["entity_ids"]:
             transform = obj.matrix_local
+        else:
+            transform = obj.matrix_world
+            if "instance_offset" in config:
+                # The object is part of an instanced collection (see
+                # export_collection), which is placed relative to its offset
+                offset = mathutils.Matrix.Translation(-config["instance_offset"])
+                transform = offset @ transform
 
         position, rotation, scale = transform.decompose()
         return rust_types.Map(
@@ -0,0 +1,43 @@
+import os
+from blender_bevy_toolkit.component_base import (
+    register_component,
+    ComponentBase,
+)
+from blender_bevy_toolkit import rust_types, export
+
+
+@register_component
+class CollectionInstance(ComponentBase):
+    def encode(config, obj):
+        """Exports the instanced collection as a scene of its own and returns
+        a component that spawns it as a child of this entity. Only happens
+        if the instances weren't made real (see make_duplicates_real)"""
+        assert CollectionInstance.is_present(obj)
+
+        collection_file = export.export_collection(config, obj.instance_collection)
+
+        config["referenced_files"].append(collection_file)
+        path = os.path.relpath(collection_file, config["output_folder"])
+
+        # TODO: The rust side doesn't support relative paths, so for now we have to hardcode this
+        path = os.path.join("scenes", path)
+
+        return rust_types.Map(
+            type="blender_bevy_toolkit::blend_collection::BlendCollectionLoader",
+            struct=rust_types.Map(path=rust_types.Str(path)),
+        )
+
+    def is_present(obj):
+        """Returns true if the supplied object has this component"""
+        return obj.instance_type == "COLLECTION" and obj.instance_collection is not None
+
+    def can_add(obj):
+        return False
+
+    @staticmethod
+    def register():
+        pass
+
+    @staticmethod
+    def unregister():
+        pass
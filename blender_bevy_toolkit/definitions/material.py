@@ -1,16 +1,16 @@
 import bpy
 import struct
-import hashlib
 import os
-import shutil
 from blender_bevy_toolkit.component_base import (
     register_component,
     ComponentBase,
 )
 from blender_bevy_toolkit.rust_types import ron, Map, Str
+from blender_bevy_toolkit import fingerprint, jdict
+from blender_bevy_toolkit.export_cache import fingerprint_key
+from blender_bevy_toolkit.utils import hash_bytes, hash_file
 
 import logging
-from blender_bevy_toolkit import jdict
 
 logger = logging.getLogger(__name__)
 
@@ -22,34 +22,27 @@ class Material(ComponentBase):
         that references it"""
         assert Material.is_present(obj)
 
-        material_data = (
-            serialize_material(config, obj.data.materials[0])
-            if obj.data.materials and obj.data.materials[0] is not None
-            else DEFAULT_MATERIAL
-        )
-
-        hash = hashlib.md5()
-        hash.update(material_data)
-        hash_text = hash.hexdigest()
-
-        material_output_file = os.path.join(
-            config["material_output_folder"],
-            "{}.material".format(
-                hash_text,
-            ),
-        )
-        if not os.path.exists(material_output_file):
-            logger.info(jdict(event="writing_material", path=material_output_file))
-            open(material_output_file, "wb").write(material_data)
-
-        path = os.path.relpath(material_output_file, config["output_folder"])
+        if len(obj.data.materials) > 1:
+            # The mesh is split into a submesh per material slot (see mesh.py),
+            # and each submesh is drawn with the material in its slot
+            paths = [
+                material_path(config, obj, material) for material in obj.data.materials
+            ]
+            return Map(
+                type="blender_bevy_toolkit::blend_material::BlendSubmeshMaterials",
+                struct=Map(
+                    paths=Map(
+                        type="alloc::vec::Vec<alloc::string::String>",
+                        list=ron.List(*paths),
+                    )
+                ),
+            )
 
-        # TODO: The rust side doesn't support relative paths, so for now we have to hardcode this
-        path = os.path.join("scenes", path)
+        material = obj.data.materials[0] if obj.data.materials else None
 
         return Map(
             type="blender_bevy_toolkit::blend_material::BlendMaterialLoader",
-            struct=Map(path=Str(path)),
+            struct=Map(path=material_path(config, obj, material)),
         )
 
     def is_present(obj):
@@ -68,6 +61,77 @@ class Material(ComponentBase):
         pass
 
 
+def material_path(config, obj, material):
+    """Exports a material (or the default material if it is None) and
+    returns the path a scene uses to reference it"""
+    # Many objects often share one material, so each material is only
+    # serialized (and its textures hashed) once per export
+    cache_key = material.name_full if material is not None else None
+    material_output_file = config["material_cache"].get(cache_key)
+    if material_output_file is None:
+        material_output_file = export_material(config, material)
+        config["material_cache"][cache_key] = material_output_file
+    else:
+        logger.debug(jdict(event="reusing_material", obj_name=obj.name))
+
+    config["referenced_files"].append(material_output_file)
+    path = os.path.relpath(material_output_file, config["output_folder"])
+
+    # TODO: The rust side doesn't support relative paths, so for now we have to hardcode this
+    path = os.path.join("scenes", path)
+    return Str(path)
+
+
+def export_material(config, material):
+    """Serializes a material and writes it into the material output folder.
+    Returns the path to the written file.
+
+    If the export cache is enabled and has a file for a material that looks
+    the same as this one, that file is used without serializing it again"""
+    export_cache = config["export_cache"]
+    cache_key = None
+    if export_cache is not None and material is not None:
+        cache_key = fingerprint_key(
+            (
+                "material",
+                os.path.relpath(
+                    config["texture_output_folder"], config["output_folder"]
+                ),
+                config.get("asset_hash", "md5"),
+                fingerprint.material(material),
+            )
+        )
+        material_output_file = export_cache.get(cache_key)
+        if material_output_file is not None:
+            return material_output_file
+
+    textures_start = len(config["exported_textures"])
+    material_data = (
+        serialize_material(config, material)
+        if material is not None
+        else DEFAULT_MATERIAL
+    )
+    textures = config["exported_textures"][textures_start:]
+
+    hash_text = hash_bytes(material_data, config.get("asset_hash", "md5"))
+
+    material_output_file = os.path.join(
+        config["material_output_folder"],
+        "{}.material".format(
+            hash_text,
+        ),
+    )
+    if config.get("material_dictionary_group") is not None:
+        config["material_dictionary_group"].add(material_output_file, material_data)
+    else:
+        config["asset_writer"].write(material_output_file, material_data, compress=True)
+
+    if cache_key is not None:
+        export_cache.put(cache_key, material_output_file, depends=textures)
+
+    return material_output_file
+
+
 def col_to_ron(col):
     return ron.EnumValue(
         "RgbaLinear", ron.Struct(red=col[0], green=col[1], blue=col[2], alpha=col[3])
@@ -253,7 +317,7 @@ def get_image_from_node_socket(config, socket):
         return ron.EnumValue("None")
 
     current_path = bpy.path.abspath(source.image.filepath, library=source.image.library)
-    hashval = hashimage(image)
+    hashval = hashimage(config, current_path)
     extension = {
         "BMP": "bmp",
         # "IRIS": "",
@@ -276,7 +340,9 @@ def get_image_from_node_socket(config, socket):
     image_output_path = os.path.join(
         config["texture_output_folder"], f"{hashval}.{extension}"
     )
-    shutil.copyfile(current_path, image_output_path)
+    # Skipped if the texture has already been copied
+    config["asset_writer"].copy(current_path, image_output_path)
+    config["exported_textures"].append(image_output_path)
 
     path = os.path.relpath(image_output_path, config["output_folder"])
     # TODO: The rust side doesn't support relative paths, so for now we have to hardcode this
@@ -285,10 +351,15 @@ def get_image_from_node_socket(config, socket):
     return ron.EnumValue("Some", ron.Tuple(path))
 
 
-def hashimage(image):
-    hash = hashlib.md5()
-    hash.update(
-        open(bpy.path.abspath(image.filepath, library=image.library), "rb").read()
-    )
-    hash_text = hash.hexdigest()
+def hashimage(config, path):
+    """Hash the contents of an image file. Images are often shared between
+    many materials, so the hash is remembered for as long as the file's
+    modification time and size stay the same"""
+    algorithm = config.get("asset_hash", "md5")
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size, algorithm)
+    hash_text = config["texture_hashes"].get(key)
+    if hash_text is None:
+        hash_text = hash_file(path, algorithm)
+        config["texture_hashes"][key] = hash_text
     return hash_text
@@ -1,17 +1,23 @@
 import bpy
-import struct
-import hashlib
 import os
+import concurrent.futures
 from blender_bevy_toolkit.component_base import (
     register_component,
     ComponentBase,
 )
-from blender_bevy_toolkit import rust_types
+from blender_bevy_toolkit import rust_types, mesh_buffers, fingerprint
+from blender_bevy_toolkit.export_cache import fingerprint_key
 
 import logging
 from blender_bevy_toolkit import jdict
+from blender_bevy_toolkit.utils import timed, hash_bytes
 import bmesh
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 logger = logging.getLogger(__name__)
 
 
@@ -22,30 +28,40 @@ class Mesh(ComponentBase):
         into a scene file"""
         assert Mesh.is_present(obj)
 
-        mesh_data = serialize_mesh(obj)
-
-        hash = hashlib.md5()
-        hash.update(mesh_data)
-        hash_text = hash.hexdigest()
-
-        mesh_output_file = os.path.join(
-            config["mesh_output_folder"],
-            "{}.mesh".format(
-                hash_text,
-            ),
-        )
-        if not os.path.exists(mesh_output_file):
-            logger.info(jdict(event="writing_mesh", path=mesh_output_file))
-            open(mesh_output_file, "wb").write(mesh_data)
-
-        path = os.path.relpath(mesh_output_file, config["output_folder"])
-
-        # TODO: The rust side doesn't support relative paths, so for now we have to hardcode this
-        path = os.path.join("scenes", path)
+        # Linked duplicates with the same modifiers produce the same mesh,
+        # so each one only needs to be evaluated and serialized once
+        cache_key = (obj.data.name_full, fingerprint.modifier_stack(obj))
+        pending = config["mesh_cache"].get(cache_key)
+        if pending is None:
+            pending = export_mesh(config, obj)
+            config["mesh_cache"][cache_key] = pending
+        else:
+            logger.debug(jdict(event="reusing_mesh", obj_name=obj.name))
+
+        def resolve_path():
+            # The name of the mesh file depends on its contents, so it isn't
+            # known until the mesh has been packed on a worker thread
+            with timed(config["timings"], "wait_for_mesh"):
+                mesh_output_file = pending.result()
+            config["referenced_files"].append(mesh_output_file)
+
+            path = os.path.relpath(mesh_output_file, config["output_folder"])
+
+            # TODO: The rust side doesn't support relative paths, so for now we have to hardcode this
+            path = os.path.join("scenes", path)
+            return rust_types.Str(path)
+
+        if num_submeshes(obj):
+            # Spawns a child entity for each submesh, using the materials
+            # from the BlendSubmeshMaterials component (see material.py)
+            return rust_types.Map(
+                type="blender_bevy_toolkit::blend_mesh::BlendSubmeshLoader",
+                struct=rust_types.Map(path=rust_types.ron.Deferred(resolve_path)),
+            )
 
         return rust_types.Map(
             type="blender_bevy_toolkit::blend_mesh::BlendMeshLoader",
-            struct=rust_types.Map(path=rust_types.Str(path)),
+            struct=rust_types.Map(path=rust_types.ron.Deferred(resolve_path)),
         )
 
     def is_present(obj):
@@ -64,9 +80,132 @@ class Mesh(ComponentBase):
         pass
 
 
-def serialize_mesh(obj):
-    depsgraph = bpy.context.view_layer.depsgraph
-    depsgraph.update()
+class PendingMesh:
+    """A mesh that may still be being packed and written on a worker thread.
+    `result` waits for it and returns the path of the written file"""
+
+    def __init__(self, future, export_cache=None, cache_key=None):
+        self.future = future
+        self.export_cache = export_cache
+        self.cache_key = cache_key
+
+    @classmethod
+    def done(cls, path):
+        """A mesh that has already been written"""
+        future = concurrent.futures.Future()
+        future.set_result(path)
+        return cls(future)
+
+    def result(self):
+        """Wait for the mesh to be written and return its path. This must
+        be called from the main thread, as it updates the export cache"""
+        mesh_output_file = self.future.result()
+        if self.cache_key is not None:
+            self.export_cache.put(self.cache_key, mesh_output_file)
+            self.cache_key = None
+        return mesh_output_file
+
+
+def export_mesh(config, obj):
+    """Serializes the mesh of an object and writes it into the mesh
+    output folder. Returns a PendingMesh for the written file.
+
+    Only pulling the data out of blender happens straight away. Merging
+    vertices, packing, hashing and writing the file happen on a worker
+    thread from config["mesh_pool"], so the next object can be extracted
+    in the meantime.
+
+    If the export cache is enabled and has a file for a mesh that looks
+    the same as this one, that file is used without serializing the mesh"""
+    export_cache = config["export_cache"]
+    cache_key = None
+    if export_cache is not None:
+        description = fingerprint.mesh_object(obj)
+        if description is not None:
+            cache_key = fingerprint_key(
+                (
+                    "mesh",
+                    mesh_buffers.MESH_VERSION,
+                    config.get("vertex_merge_tolerance", 0.0),
+                    config.get("asset_hash", "md5"),
+                    num_submeshes(obj),
+                    tuple(sorted(config.get("mesh_encoding", ()))),
+                    config.get("optimize_mesh_order", False),
+                    description,
+                )
+            )
+            mesh_output_file = export_cache.get(cache_key)
+            if mesh_output_file is not None:
+                return PendingMesh.done(mesh_output_file)
+
+    with timed(config["timings"], "extract_mesh"):
+        corners, corner_materials = extract_mesh(config, obj)
+
+    future = config["mesh_pool"].submit(
+        write_mesh,
+        config["asset_writer"],
+        config["mesh_output_folder"],
+        corners,
+        corner_materials,
+        num_submeshes(obj),
+        config.get("vertex_merge_tolerance", 0.0),
+        config.get("asset_hash", "md5"),
+        tuple(config.get("mesh_encoding", ())),
+        config.get("optimize_mesh_order", False),
+    )
+    return PendingMesh(future, export_cache, cache_key)
+
+
+def write_mesh(
+    asset_writer,
+    mesh_output_folder,
+    corners,
+    corner_materials,
+    submesh_count,
+    merge_tolerance,
+    hash_algorithm="md5",
+    encoding=(),
+    optimize_order=False,
+):
+    """Packs the triangle corners of a mesh into a .mesh file named after
+    its contents, and queues it to be written. This doesn't touch blender,
+    so it can run on any thread. Returns the path of the file"""
+    mesh_data = pack_corners(
+        corners,
+        merge_tolerance,
+        corner_materials,
+        submesh_count,
+        encoding,
+        optimize_order,
+    )
+
+    hash_text = hash_bytes(mesh_data, hash_algorithm)
+
+    mesh_output_file = os.path.join(
+        mesh_output_folder,
+        "{}.mesh".format(
+            hash_text,
+        ),
+    )
+    asset_writer.write(mesh_output_file, mesh_data, compress=True)
+
+    return mesh_output_file
+
+
+def num_submeshes(obj):
+    """Meshes with more than one material slot are split into a submesh per
+    slot. Returns zero if the mesh isn't split"""
+    num_slots = len(obj.data.materials)
+    return num_slots if num_slots > 1 else 0
+
+
+def extract_mesh(config, obj):
+    """Copies the triangle corners of the evaluated mesh of an object out of
+    blender. See extract_mesh_arrays for the layout.
+
+    Returns the corners and, for meshes that are split into submeshes, the
+    material slot of each corner (otherwise None)"""
+    depsgraph = config["depsgraph"]
 
     eval_object = obj.evaluated_get(depsgraph)
     mesh = eval_object.to_mesh(
@@ -79,76 +218,186 @@ def serialize_mesh(obj):
     mesh.calc_normals_split()
     mesh.calc_tangents()
 
-    verts = []
-    normals = []
-    indices = []
-    uv0 = []
-    tangents = []
+    if np is not None:
+        corners = extract_mesh_arrays(mesh)
+    else:
+        corners = extract_mesh_loops(mesh)
 
-    dedup_data_lookup = {}
+    corner_materials = None
+    if num_submeshes(obj):
+        corner_materials = extract_corner_materials(mesh, num_submeshes(obj))
+
+    eval_object.to_mesh_clear()
+
+    return corners, corner_materials
+
+
+def pack_corners(
+    corners,
+    merge_tolerance=0.0,
+    corner_materials=None,
+    submesh_count=0,
+    encoding=(),
+    optimize_order=False,
+):
+    """Merges triangle corners into vertices and packs them into the bytes
+    of a .mesh file.
+
+    Every attribute is rounded to a grid of merge_tolerance and vertices
+    that land in the same grid cell are merged (see
+    mesh_buffers.deduplicate_vertices). The default of zero only merges
+    exact duplicates.
+
+    If corner_materials is given, the mesh is split into submesh_count
+    submeshes by the material slot of each corner. The attributes are
+    stored with the given encoding (see mesh_buffers.ENCODINGS).
+
+    With optimize_order set, triangles and vertices are reordered so the
+    GPU can make better use of its vertex cache (see
+    mesh_buffers.optimize_mesh_order)"""
+    submeshes = None
+    if corner_materials is not None:
+        vertices, indices, submeshes = mesh_buffers.deduplicate_submeshes(
+            corners, corner_materials, submesh_count, merge_tolerance
+        )
+    else:
+        vertices, indices = mesh_buffers.deduplicate_vertices(corners, merge_tolerance)
+
+    if optimize_order:
+        # Simulating the cache is about as slow as reordering, so only
+        # measure the improvement if it is going to be logged
+        measure = logger.isEnabledFor(logging.DEBUG)
+        if measure:
+            acmr_before = mesh_buffers.average_cache_miss_ratio(indices)
+        vertices, indices = mesh_buffers.optimize_mesh_order(
+            vertices, indices, submeshes
+        )
+        if measure:
+            logger.debug(
+                jdict(
+                    event="optimized_mesh_order",
+                    triangles=len(indices) // 3,
+                    acmr_before=acmr_before,
+                    acmr_after=mesh_buffers.average_cache_miss_ratio(indices),
+                )
+            )
+
+    if np is not None and isinstance(vertices, np.ndarray):
+        return mesh_buffers.pack_mesh(
+            {
+                "positions": vertices[:, 0:3],
+                "normals": vertices[:, 3:6],
+                "tangents": vertices[:, 8:12],
+                "uv0": vertices[:, 6:8],
+            },
+            indices=indices,
+            submeshes=submeshes,
+            encoding=encoding,
+        )
+
+    return mesh_buffers.pack_mesh(
+        {
+            "positions": [v[0:3] for v in vertices],
+            "normals": [v[3:6] for v in vertices],
+            "tangents": [v[8:12] for v in vertices],
+            "uv0": [v[6:8] for v in vertices],
+        },
+        indices=indices,
+        submeshes=submeshes,
+        encoding=encoding,
+    )
 
-    for loop_tri in mesh.loop_triangles:
-        triangle_indices = []
 
+def extract_corner_materials(mesh, num_slots):
+    """The material slot of each triangle corner, in the same order as the
+    corners. Out of range slots are clamped, as blender does when drawing"""
+    if np is not None:
+        triangle_materials = np.empty(len(mesh.loop_triangles), dtype=np.int32)
+        mesh.loop_triangles.foreach_get("material_index", triangle_materials)
+        return np.repeat(np.clip(triangle_materials, 0, num_slots - 1), 3)
+
+    return [
+        min(max(loop_tri.material_index, 0), num_slots - 1)
+        for loop_tri in mesh.loop_triangles
+        for _ in range(3)
+    ]
+
+
+def extract_mesh_arrays(mesh):
+    """Pull each attribute out of blender in bulk with foreach_get and
+    gather them into a numpy array with one row per triangle corner:
+    (position, normal, uv, tangent)"""
+    num_verts = len(mesh.vertices)
+    num_loops = len(mesh.loops)
+    num_tris = len(mesh.loop_triangles)
+
+    positions = np.empty(num_verts * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", positions)
+    positions = positions.reshape(-1, 3)
+
+    loop_vertex_indices = np.empty(num_loops, dtype=np.int32)
+    mesh.loops.foreach_get("vertex_index", loop_vertex_indices)
+
+    normals = np.empty(num_loops * 3, dtype=np.float32)
+    mesh.loops.foreach_get("normal", normals)
+    normals = normals.reshape(-1, 3)
+
+    # Bevy expects tangents to be a vec4 because https://github.com/bevyengine/bevy/issues/3604
+    tangents = np.empty((num_loops, 4), dtype=np.float32)
+    tangent_xyz = np.empty(num_loops * 3, dtype=np.float32)
+    mesh.loops.foreach_get("tangent", tangent_xyz)
+    tangents[:, :3] = tangent_xyz.reshape(-1, 3)
+    bitangent_signs = np.empty(num_loops, dtype=np.float32)
+    mesh.loops.foreach_get("bitangent_sign", bitangent_signs)
+    tangents[:, 3] = bitangent_signs
+
+    uv0 = np.zeros((num_loops, 2), dtype=np.float32)
+    if mesh.uv_layers:
+        uv_raw = np.empty(num_loops * 2, dtype=np.float32)
+        mesh.uv_layers[0].data.foreach_get("uv", uv_raw)
+        uv0[:, 0] = uv_raw[0::2]
+        uv0[:, 1] = 1.0 - uv_raw[1::2]
+
+    triangle_loops = np.empty(num_tris * 3, dtype=np.int32)
+    mesh.loop_triangles.foreach_get("loops", triangle_loops)
+
+    # One row per triangle corner: (position, normal, uv, tangent)
+    corners = np.empty((len(triangle_loops), 12), dtype=np.float32)
+    corners[:, 0:3] = positions[loop_vertex_indices[triangle_loops]]
+    corners[:, 3:6] = normals[triangle_loops]
+    corners[:, 6:8] = uv0[triangle_loops]
+    corners[:, 8:12] = tangents[triangle_loops]
+    return corners
+
+
+def extract_mesh_loops(mesh):
+    """Gather the triangle corners one at a time, as a list with the same
+    layout as extract_mesh_arrays. This is slow on large meshes, and is only
+    used when numpy is unavailable"""
+    corners = []
+
+    for loop_tri in mesh.loop_triangles:
         for loop_index in loop_tri.loops:
             loop = mesh.loops[loop_index]
 
             vert = mesh.vertices[loop.vertex_index]
-            position = tuple(vert.co)
-            normal = tuple(loop.normal)
-            tangent = tuple(
-                [loop.tangent[0], loop.tangent[1], loop.tangent[2], loop.bitangent_sign]
-            )
-
             if mesh.uv_layers:
-
                 uv_raw = mesh.uv_layers[0].data[loop_index].uv
                 uv = (uv_raw[0], 1.0 - uv_raw[1])
             else:
                 uv = (0.0, 0.0)
 
-            dedup = (position, normal, uv, tangent)
-            if dedup not in dedup_data_lookup:
-                index = len(verts)
-                verts.append(position)
-                normals.append(normal)
-                uv0.append(uv)
-                tangents.append(tangent)
-                dedup_data_lookup[dedup] = index
-            else:
-                index = dedup_data_lookup[dedup]
-
-            triangle_indices.append(index)
-        indices.append(tuple(triangle_indices))
-
-    eval_object.to_mesh_clear()
+            corners.append(
+                (
+                    *vert.co,
+                    *loop.normal,
+                    *uv,
+                    *loop.tangent,
+                    loop.bitangent_sign,
+                )
+            )
 
-    # Output our file
-    # We start off with a header containing data about the file
-    out_data = b""
-    out_data += struct.pack("H", len(verts))
-    out_data += struct.pack("H", len(indices))
-
-    # We don't need len(normals) because:
-    assert len(normals) == len(verts)
-    assert len(uv0) == len(verts)
-    assert len(tangents) == len(verts)
-
-    # Now we can pack all our data:
-    for vert in verts:
-        out_data += struct.pack("fff", *vert)
-    for normal in normals:
-        out_data += struct.pack("fff", *normal)
-    for tangent in tangents:
-        out_data += struct.pack(
-            "ffff", *tangent
-        )  # Bevy expects tangents to be a vec4 because https://github.com/bevyengine/bevy/issues/3604
-    for uv in uv0:
-        out_data += struct.pack("ff", *uv)
-    for index in indices:
-        out_data += struct.pack("III", *index)
-
-    return out_data
+    return corners
 
 
 def triangulate_ngons(mesh):
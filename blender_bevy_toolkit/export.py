@@ -1,14 +1,29 @@
 """ Converts from blender objects into a scene description """
 import os
 import logging
+import itertools
+import concurrent.futures
 import bpy
-from . import component_base, rust_types, jdict
+import mathutils
+from . import (
+    component_base,
+    rust_types,
+    export_cache,
+    fingerprint,
+    mesh_buffers,
+    instance_buffers,
+    compression,
+    jdict,
+)
+from .fragment_cache import FragmentCache, FRAGMENTS_SUFFIX
+from .asset_writer import AssetWriter
+from .utils import timed, lookahead, hash_bytes, new_hash
 
 
 logger = logging.getLogger(__name__)
 
 
-class Entity:
+class Entity(rust_types.Reflected):
     """In an ECS, an entity is an opaque ID that is referenced by (or references)
     a set of components. This class represents an entity and as such ... contains
     a lit of components. The ID field should be unique in the scene"""
@@ -17,14 +32,11 @@ class Entity:
         self.entity_id = entity_id
         self.components = comp
 
-    def to_str(self, indent):
-        """Convert into a ... string!"""
-        return rust_types.ron.encode(
-            rust_types.ron.Struct(
-                entity=rust_types.Int(self.entity_id),
-                components=rust_types.List(*self.components),
-            ),
-            indent,
+    def as_ron(self):
+        """Convert into a ... ron struct!"""
+        return rust_types.ron.Struct(
+            entity=rust_types.Int(self.entity_id),
+            components=rust_types.List(*self.components),
         )
 
 
@@ -38,58 +50,508 @@ def export_entity(config, obj, entity_id):
     for component in component_base.COMPONENTS:
         if component.is_present(obj):
             new_component = component.encode(config, obj)
-            entity.components.append(new_component)
+            # Components can leave themselves out by returning None, eg a
+            # parent that isn't part of the scene being exported
+            if new_component is not None:
+                entity.components.append(new_component)
 
     return entity
 
 
-def export_all(config):
-    """Exports everything from this bend file"""
-    output_folder = os.path.dirname(config["output_filepath"])
+# Objects with any other component can't be batched into an instance group,
+# as only their transform and name are kept (see export_instance_group)
+BATCHABLE_COMPONENTS = {
+    "ComputedVisibility",
+    "GlobalTransform",
+    "Label",
+    "Material",
+    "Mesh",
+    "Transform",
+    "Visibility",
+}
+
+
+def instance_key(obj):
+    """Objects with the same key only differ in their transform, so they
+    can be batched into an instance group. Returns None for objects that
+    have to be exported on their own"""
+    if (
+        obj.type != "MESH"
+        or obj.parent is not None
+        or obj.children
+        or obj.hide_render
+        or len(obj.data.materials) > 1
+    ):
+        return None
+    for component in component_base.COMPONENTS:
+        if component.is_present(obj) and (
+            component.__name__ not in BATCHABLE_COMPONENTS
+        ):
+            return None
+
+    # The same key the Mesh and Material components reuse their output by
+    material = obj.data.materials[0] if obj.data.materials else None
+    return (
+        obj.data.name_full,
+        fingerprint.modifier_stack(obj),
+        material.name_full if material is not None else None,
+    )
+
+
+def export_instance_group(config, objects, entity_id):
+    """Export objects that share a mesh and material as a single entity.
+    The transform and name of each object are written into an .instances
+    file, and the entity spawns a child with that transform and label for
+    each of them when loaded (see src/blend_instances.rs). The entity
+    itself is hidden"""
+    logger.debug(
+        jdict(
+            event="serializing_instance_group",
+            obj_name=objects[0].name,
+            instances=len(objects),
+            entity_id=entity_id,
+        )
+    )
+    entity = Entity(entity_id, [])
+
+    # Mesh and material are the same for every object in the group
+    for component in component_base.COMPONENTS:
+        if component.__name__ in ("Mesh", "Material"):
+            entity.components.append(component.encode(config, objects[0]))
+
+    transforms = []
+    for obj in objects:
+        position, rotation, scale = obj.matrix_world.decompose()
+        transforms.append(
+            (*position, rotation.x, rotation.y, rotation.z, rotation.w, *scale)
+        )
+    # The names are the labels the objects would have had (see label.py)
+    data = instance_buffers.pack_instances(transforms, [obj.name for obj in objects])
+
+    instances_file = os.path.join(
+        config["instance_output_folder"],
+        hash_bytes(data, config.get("asset_hash", "md5")) + ".instances",
+    )
+    os.makedirs(config["instance_output_folder"], exist_ok=True)
+    config["asset_writer"].write(instances_file, data, compress=True)
+    config["referenced_files"].append(instances_file)
+
+    # TODO: The rust side doesn't support relative paths, so for now we have to hardcode this
+    path = os.path.join(
+        "scenes", os.path.relpath(instances_file, config["output_folder"])
+    )
+    identity = rust_types.Map(
+        translation=rust_types.Vec3((0.0, 0.0, 0.0)),
+        rotation=rust_types.Quat(mathutils.Quaternion()),
+        scale=rust_types.Vec3((1.0, 1.0, 1.0)),
+    )
+    entity.components += [
+        rust_types.Map(
+            type="blender_bevy_toolkit::blend_instances::BlendInstancesLoader",
+            struct=rust_types.Map(path=rust_types.Str(path)),
+        ),
+        rust_types.Map(
+            type="bevy_transform::components::transform::Transform",
+            struct=identity,
+        ),
+        rust_types.Map(
+            type="bevy_transform::components::global_transform::GlobalTransform",
+            struct=identity,
+        ),
+        rust_types.Map(
+            type="bevy_render::view::visibility::Visibility",
+            struct=rust_types.Map(is_visible=rust_types.Bool(False)),
+        ),
+        rust_types.Map(
+            type="bevy_render::view::visibility::ComputedVisibility",
+            struct=rust_types.Map(is_visible=rust_types.Bool(False)),
+        ),
+    ]
+    return entity
 
-    if config["make_duplicates_real"]:
-        # Make all collections into their real objects. Ideally one day this
-        # will be subbed for actually using proper instancing of collections
-        # but I couldn't get this to work in bevy :(
-        bpy.ops.object.select_all(action="SELECT")
-        bpy.ops.object.duplicates_make_real(use_base_parent=True, use_hierarchy=True)
 
-        # Rigid bodies can often being parented to other objects as a result of
-        # making duplicates real,, which Rapier doesn't deal with
-        # nicely. So let's forceably remove the parent before exporting.
-        for obj in bpy.context.scene.objects:
-            if hasattr(obj, "rapier_rigid_body") and obj.rapier_rigid_body.present:
-                transform_bak = obj.matrix_world.copy()
-                obj.parent = None
-                obj.matrix_world = transform_bak
+def export_collection(config, collection):
+    """Exports the objects in a collection as a scene of their own, for
+    collection instances to load (see definitions/collection_instance.py).
+    Each collection is only exported once, however many times it is
+    instanced. Returns the path to the written file.
 
-    config["mesh_output_folder"] = os.path.join(
-        output_folder, config["mesh_output_folder"]
+    Like meshes, collection scenes are named after their contents, so
+    identical collections from different blend files share a file"""
+    collection_file = config["collection_cache"].get(collection.name_full)
+    if collection_file is not None:
+        return collection_file
+
+    objects = list(collection.all_objects)
+    collection_config = dict(
+        config,
+        entity_ids={o: i for i, o in enumerate(objects)},
+        instance_offset=collection.instance_offset,
+    )
+    entities = rust_types.List(
+        *(export_entity(collection_config, o, i) for i, o in enumerate(objects))
     )
-    if not os.path.exists(config["mesh_output_folder"]):
-        os.makedirs(config["mesh_output_folder"])
 
-    config["material_output_folder"] = os.path.join(
-        output_folder, config["material_output_folder"]
+    # RON scenes are loaded by bevy's own scene loader, which can't read
+    # compressed files
+    binary = config.get("scene_format", "ron") == "binary"
+    if binary:
+        data = rust_types.cbor.encode(entities)
+        extension = ".scnb"
+    else:
+        data = rust_types.ron.encode(
+            entities, indent_size=ron_indent_size(config)
+        ).encode("utf-8")
+        extension = ".scn"
+
+    collection_file = os.path.join(
+        config["collection_output_folder"],
+        hash_bytes(data, config.get("asset_hash", "md5")) + extension,
+    )
+    os.makedirs(config["collection_output_folder"], exist_ok=True)
+    config["asset_writer"].write(collection_file, data, compress=binary)
+    config["collection_cache"][collection.name_full] = collection_file
+    return collection_file
+
+
+def export_entity_fragment(config, obj, entity_id):
+    """Like export_entity, but returns the entity encoded exactly as it is
+    written into the scene. Objects that haven't changed since the previous
+    export reuse the fragment from then rather than encoding again. Other
+    objects are encoded when the scene is written"""
+    fragments = config["fragment_cache"]
+    key = None
+    description = fingerprint.entity(obj, config["fingerprint_memo"])
+    if description is not None:
+        # Entity IDs are the position in the scene, so adding or removing
+        # objects changes the encoding of others
+        parent_id = (
+            component_base.get_entity_id(config, obj.parent)
+            if obj.parent is not None
+            else None
+        )
+        key = export_cache.fingerprint_key((entity_id, parent_id, description))
+        fragment = fragments.get(obj.name_full, key)
+        if fragment is not None:
+            return rust_types.ron.Encoded(fragment)
+
+    files_start = len(config["referenced_files"])
+    entity = export_entity(config, obj, entity_id)
+    depends = config["referenced_files"][files_start:]
+
+    def encode():
+        # Encoding waits for the meshes of the entity, so it is put off until
+        # the entity is written, after the lookahead in export_all. Mesh files
+        # are only added to referenced_files once they are known
+        encode_start = len(config["referenced_files"])
+        fragment = encode_fragment(config, entity)
+        if key is not None:
+            fragments.put(
+                obj.name_full,
+                key,
+                fragment,
+                depends + config["referenced_files"][encode_start:],
+            )
+        return rust_types.ron.Encoded(fragment)
+
+    return rust_types.ron.Deferred(encode)
+
+
+def encode_fragment(config, entity):
+    """Encode a single entity the same way write_ron_scene or
+    write_binary_scene would write it"""
+    if config.get("scene_format", "ron") == "binary":
+        return rust_types.cbor.encode(entity)
+    return rust_types.ron.encode(entity, 1, indent_size=ron_indent_size(config))
+
+
+def fragment_settings(config):
+    """Describes the settings that change how every entity is encoded. The
+    fragments from a previous export can only be used if these match"""
+    return export_cache.fingerprint_key(
+        (
+            config.get("scene_format", "ron"),
+            ron_indent_size(config),
+            config.get("vertex_merge_tolerance", 0.0),
+            config.get("asset_hash", "md5"),
+            tuple(sorted(config.get("mesh_encoding", ()))),
+            config.get("optimize_mesh_order", False),
+            mesh_buffers.MESH_VERSION,
+            os.path.relpath(config["mesh_output_folder"], config["output_folder"]),
+            os.path.relpath(config["material_output_folder"], config["output_folder"]),
+            os.path.relpath(config["texture_output_folder"], config["output_folder"]),
+            os.path.relpath(
+                config["collection_output_folder"], config["output_folder"]
+            ),
+            config.get("batch_instances", False),
+            config.get("min_instances", 2),
+            os.path.relpath(config["instance_output_folder"], config["output_folder"]),
+            tuple(c.__name__ for c in component_base.COMPONENTS),
+        )
+    )
+
+
+def ron_indent_size(config):
+    """Compact output leaves out all the newlines and indentation, which
+    makes the file smaller and faster for bevy to parse"""
+    return 0 if config.get("compact_ron") else None
+
+
+def write_ron_scene(config, entities):
+    """Write the scene as RON into the .scn file"""
+    with open(config["output_filepath"], "w", encoding="utf-8") as outfile:
+        writer = rust_types.ron.Writer(outfile, indent_size=ron_indent_size(config))
+        rust_types.ron.write(entities, writer)
+
+
+def write_binary_scene(config, entities):
+    """Write the scene as CBOR into a .scnb file next to where the .scn file
+    would have been. This is loaded by the BlendBinarySceneLoader in
+    src/blend_scene.rs, which picks loaders by file extension. The scene is
+    compressed as it is written if compression is enabled"""
+    output_filepath = os.path.splitext(config["output_filepath"])[0] + ".scnb"
+    compressor = config["asset_writer"].compressor
+    with open(output_filepath, "wb") as outfile, compressor.stream(outfile) as stream:
+        rust_types.cbor.write(entities, stream)
+
+
+def make_duplicates_real():
+    """Make all collections into their real objects. Otherwise each
+    instanced collection is exported once as a scene of its own, which its
+    instances load (see definitions/collection_instance.py)"""
+    bpy.ops.object.select_all(action="SELECT")
+    bpy.ops.object.duplicates_make_real(use_base_parent=True, use_hierarchy=True)
+
+    # Rigid bodies can often being parented to other objects as a result of
+    # making duplicates real,, which Rapier doesn't deal with
+    # nicely. So let's forceably remove the parent before exporting.
+    for obj in bpy.context.scene.objects:
+        if hasattr(obj, "rapier_rigid_body") and obj.rapier_rigid_body.present:
+            transform_bak = obj.matrix_world.copy()
+            obj.parent = None
+            obj.matrix_world = transform_bak
+
+
+def setup_output_folders(config, output_folder):
+    """Turn the output folders in the config into paths relative to the
+    scene, and create the ones every export writes into"""
+    config["output_folder"] = output_folder
+    for name in ("mesh", "material", "texture"):
+        key = f"{name}_output_folder"
+        config[key] = os.path.join(output_folder, config[key])
+        if not os.path.exists(config[key]):
+            os.makedirs(config[key])
+
+    # Only created once a collection instance is exported
+    config["collection_output_folder"] = os.path.join(
+        output_folder, config.get("collection_output_folder", "collections")
     )
-    if not os.path.exists(config["material_output_folder"]):
-        os.makedirs(config["material_output_folder"])
 
-    config["texture_output_folder"] = os.path.join(
-        output_folder, config["texture_output_folder"]
+    # Only created once an instance group is exported
+    config["instance_output_folder"] = os.path.join(
+        output_folder, config.get("instance_output_folder", "instances")
     )
-    if not os.path.exists(config["texture_output_folder"]):
-        os.makedirs(config["texture_output_folder"])
 
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
-    scene = bpy.context.scene
 
-    config["output_folder"] = output_folder
+def setup_caches(config):
+    """Create the caches that save work within an export, and load the
+    export cache that saves work between exports"""
+    # Mesh component output, keyed by mesh datablock and modifier stack. This
+    # only lives for a single export as it refers to datablocks by name
+    config["mesh_cache"] = {}
+
+    # Material component output, keyed by material datablock (or None for
+    # objects without a material). Also only lives for a single export
+    config["material_cache"] = {}
+
+    # Collection scenes, keyed by collection datablock
+    config["collection_cache"] = {}
+
+    # Every texture copied into the texture output folder
+    config["exported_textures"] = []
+
+    # Hashes of texture files, keyed by path, modification time and size
+    shared_caches = config.get("shared_caches")
+    if shared_caches is not None:
+        config["texture_hashes"] = shared_caches.setdefault("texture_hashes", {})
+    else:
+        config["texture_hashes"] = {}
+
+    # When several scenes are exported in one process (see the --manifest
+    # option of scripts/export.py), they share their export caches so that
+    # meshes and materials that appear in more than one blend file are only
+    # serialized once, even if the cache isn't saved to disk.
+    manifest_path = os.path.join(
+        config["output_folder"], export_cache.MANIFEST_FILENAME
+    )
+    max_entries = config.get("export_cache_max_entries", 10000)
+    if shared_caches is not None and manifest_path in shared_caches:
+        config["export_cache"] = shared_caches[manifest_path]
+    elif config.get("use_export_cache", False):
+        config["export_cache"] = export_cache.ExportCache.load(
+            manifest_path, max_entries
+        )
+    elif shared_caches is not None:
+        config["export_cache"] = export_cache.ExportCache(manifest_path, max_entries)
+    else:
+        config["export_cache"] = None
+    if shared_caches is not None:
+        shared_caches[manifest_path] = config["export_cache"]
+
+
+def batch_objects(config, objects):
+    """Objects that only differ in their transform can be batched into one
+    entity per group. Returns the objects that are exported on their own,
+    and the groups"""
+    if not config.get("batch_instances", False):
+        return objects, []
+    objects, instance_groups = instance_buffers.group_instances(
+        ((o, instance_key(o)) for o in objects), config.get("min_instances", 2)
+    )
+    logger.info(
+        jdict(
+            event="batched_instances",
+            groups=len(instance_groups),
+            objects=sum(len(group) for group in instance_groups),
+        )
+    )
+    return objects, instance_groups
+
+
+def setup_fragment_cache(config):
+    """Load the fragments of the previous export for an incremental export.
+    Returns the function that exports each object"""
+    if not config.get("incremental_export", False):
+        config["fragment_cache"] = None
+        return export_entity
+
+    config["fragment_cache"] = FragmentCache.load(
+        os.path.splitext(config["output_filepath"])[0] + FRAGMENTS_SUFFIX,
+        fragment_settings(config),
+    )
+    config["fingerprint_memo"] = {}
+    return export_entity_fragment
+
+
+def setup_asset_writer(config):
+    """Create the writer that writes mesh, material and texture files in
+    the background, compressing them if asked to"""
+    config["asset_writer"] = AssetWriter(
+        fsync=config.get("fsync_assets", False),
+        hardlink=config.get("hardlink_textures", False),
+        compressor=compression.Compressor(
+            config.get("asset_compression", "none"), config.get("compression_level")
+        ),
+    )
+
+    # Materials are held back until the end of the export, so that a
+    # dictionary can be trained on all of them before compressing them
+    if config.get("material_dictionary", False) and (
+        config["asset_writer"].compressor.method == "zstd"
+    ):
+        config["material_dictionary_group"] = compression.DictionaryGroup(
+            config["material_output_folder"],
+            config.get("material_dictionary_size", compression.DEFAULT_DICTIONARY_SIZE),
+        )
+    else:
+        config["material_dictionary_group"] = None
+
+
+def save_caches(config):
+    """Save the export cache and fragments for the next export"""
+    if config["export_cache"] is not None and config.get("use_export_cache", False):
+        config["export_cache"].save()
+
+    if config["fragment_cache"] is not None:
+        config["fragment_cache"].save()
+        logger.info(
+            jdict(
+                event="incremental_export",
+                reused=config["fragment_cache"].reused,
+                entities=len(config["entity_ids"]),
+            )
+        )
+
+
+def export_all(config):
+    """Exports everything from this bend file"""
+    if config["make_duplicates_real"]:
+        make_duplicates_real()
+
+    setup_output_folders(config, os.path.dirname(config["output_filepath"]))
+
+    # Fail on unknown mesh encodings and asset hashes now, rather than on a
+    # worker thread
+    mesh_buffers.encoding_flags(config.get("mesh_encoding", ()))
+    new_hash(config.get("asset_hash", "md5"))
     config["scene"] = bpy.context.scene
 
-    entities = [export_entity(config, o, i) for i, o in enumerate(scene.objects)]
+    # Time spent in the various stages of the export, in seconds
+    config["timings"] = {}
 
-    with open(config["output_filepath"], "w", encoding="utf-8") as outfile:
-        outfile.write(rust_types.ron.encode(rust_types.ron.List(*entities)))
+    # Evaluate the depsgraph once, after any changes made above, rather than
+    # once for every object that needs evaluated data.
+    with timed(config["timings"], "depsgraph_evaluation"):
+        config["depsgraph"] = bpy.context.evaluated_depsgraph_get()
+
+    setup_caches(config)
+
+    # Batched groups come after the entities of the other objects
+    objects, instance_groups = batch_objects(config, list(config["scene"].objects))
+
+    # Objects are looked up by components that reference other entities, so
+    # build the index once rather than searching the scene each time
+    config["entity_ids"] = {o: i for i, o in enumerate(objects)}
+
+    # Every mesh and material file referenced by the scene
+    config["referenced_files"] = []
+
+    export_function = setup_fragment_cache(config)
+    setup_asset_writer(config)
+
+    # Meshes are packed and written on these threads while the main thread
+    # carries on pulling data out of blender. Numpy and hashlib release the
+    # GIL for the heavy lifting, so threads are enough to use several cores.
+    config["mesh_pool"] = concurrent.futures.ThreadPoolExecutor(
+        max_workers=config.get("mesh_threads"), thread_name_prefix="mesh"
+    )
+
+    # Each entity is written to the file as soon as it has been exported, so
+    # the whole scene never has to be held in memory at once. Exporting runs
+    # a few entities ahead of writing so that their meshes are ready by the
+    # time they are written.
+    try:
+        with timed(config["timings"], "export_entities"):
+            entities = rust_types.ron.List.from_iterable(
+                lookahead(
+                    itertools.chain(
+                        (
+                            export_function(config, o, i)
+                            for o, i in config["entity_ids"].items()
+                        ),
+                        (
+                            export_instance_group(config, group, len(objects) + i)
+                            for i, group in enumerate(instance_groups)
+                        ),
+                    ),
+                    config.get("export_lookahead", 32),
+                )
+            )
+            if config.get("scene_format", "ron") == "binary":
+                write_binary_scene(config, entities)
+            else:
+                write_ron_scene(config, entities)
+        if config["material_dictionary_group"] is not None:
+            with timed(config["timings"], "train_material_dictionary"):
+                config["material_dictionary_group"].write(config["asset_writer"])
+    finally:
+        config["mesh_pool"].shutdown(wait=True)
+        with timed(config["timings"], "wait_for_asset_writes"):
+            config["asset_writer"].join()
+
+    save_caches(config)
+
+    logger.info(jdict(event="export_timings", **config["timings"]))
@@ -0,0 +1,118 @@
+""" A cache that persists between exports. It remembers which output file
+was written for a given fingerprint of blender data, so that exporting an
+unchanged scene again doesn't need to serialize everything again.
+
+The cache is invalidated:
+ - Entirely, if the manifest was written by a different CACHE_VERSION or
+   can't be read.
+ - Per entry, if the output file (or any file it depends on) no longer
+   exists.
+ - Implicitly, whenever the data changes. The fingerprint is the key, so
+   changed data has a different key and the old entry ages out.
+
+The limit is on the number of entries in the manifest, not on the size
+of the files: the manifest holds at most `max_entries` entries, forgetting
+the least recently used ones once it is full. The files of forgotten
+entries are left on disk, because scenes exported earlier may still
+reference them.
+"""
+import os
+import json
+import hashlib
+import logging
+
+from .utils import jdict
+
+logger = logging.getLogger(__name__)
+
+
+# Increment this whenever the exporter output changes in a way that is not
+# captured by the fingerprints. This discards any existing caches.
+CACHE_VERSION = 1
+
+MANIFEST_FILENAME = "export_cache.json"
+
+
+def fingerprint_key(description):
+    """Convert a description of some blender data (nested tuples of
+    plain values) into a short key for the cache"""
+    return hashlib.md5(repr(description).encode("utf-8")).hexdigest()
+
+
+class ExportCache:
+    """Maps from fingerprints to output files. Paths are stored relative to
+    the folder containing the manifest so the output can be moved around"""
+
+    def __init__(self, manifest_path, max_entries):
+        self.manifest_path = manifest_path
+        self.folder = os.path.dirname(manifest_path)
+        self.max_entries = max_entries
+        # Python dicts keep insertion order. The least recently used entry
+        # is always at the start.
+        self.entries = {}
+
+    @classmethod
+    def load(cls, manifest_path, max_entries):
+        """Read the manifest from disk, or start a new cache if there isn't
+        a usable one"""
+        cache = cls(manifest_path, max_entries)
+        try:
+            with open(manifest_path, encoding="utf-8") as manifest_file:
+                manifest = json.load(manifest_file)
+        except FileNotFoundError:
+            return cache
+        except (OSError, ValueError) as err:
+            logger.warning(
+                jdict(event="export_cache_unreadable", path=manifest_path, err=str(err))
+            )
+            return cache
+
+        if manifest.get("version") != CACHE_VERSION:
+            logger.info(jdict(event="export_cache_version_changed", path=manifest_path))
+            return cache
+
+        cache.entries = manifest["entries"]
+        return cache
+
+    def save(self):
+        """Write the manifest to disk"""
+        self._evict()
+        temp_path = self.manifest_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as manifest_file:
+            json.dump(
+                {"version": CACHE_VERSION, "entries": self.entries}, manifest_file
+            )
+        os.replace(temp_path, self.manifest_path)
+
+    def get(self, key):
+        """Returns the output file previously stored for this key, or None
+        if there isn't one or it is no longer valid"""
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+
+        paths = [entry["path"]] + entry["depends"]
+        if not all(os.path.exists(os.path.join(self.folder, p)) for p in paths):
+            logger.debug(jdict(event="export_cache_stale", key=key))
+            return None
+
+        # Move to the end to mark it as recently used
+        self.entries[key] = entry
+        return os.path.join(self.folder, entry["path"])
+
+    def put(self, key, output_path, depends=()):
+        """Record that the data with this key was written to output_path.
+        If the output only makes sense alongside other files (eg the
+        textures used by a material), they can be listed in depends"""
+        self.entries.pop(key, None)
+        self.entries[key] = {
+            "path": os.path.relpath(output_path, self.folder),
+            "depends": [os.path.relpath(p, self.folder) for p in depends],
+        }
+        self._evict()
+
+    def _evict(self):
+        """Drop the least recently used entries until there are at most
+        max_entries left. Their files are not deleted"""
+        while len(self.entries) > self.max_entries:
+            del self.entries[next(iter(self.entries))]
@@ -0,0 +1,359 @@
+""" Cheap descriptions of blender data that change whenever the data changes.
+These are used to tell when two objects would export the same thing, so
+the work only has to be done once """
+import os
+import array
+import hashlib
+
+import bpy
+
+
+def rna_properties(struct, skip=()):
+    """Returns a tuple of (name, value) for every property of a blender
+    struct. References to other datablocks are represented by their name.
+    Nested structs, collections and any properties named in skip are
+    left out"""
+    values = []
+    for prop in struct.bl_rna.properties:
+        if prop.identifier == "rna_type" or prop.type == "COLLECTION":
+            continue
+        if prop.identifier in skip:
+            continue
+
+        value = getattr(struct, prop.identifier)
+        if prop.type == "POINTER":
+            if not isinstance(value, bpy.types.ID):
+                continue
+            value = value.name_full
+        elif prop.type == "ENUM" and prop.is_enum_flag:
+            value = tuple(sorted(value))
+        elif getattr(prop, "is_array", False):
+            value = frozen(value)
+
+        values.append((prop.identifier, value))
+    return tuple(values)
+
+
+def modifier_stack(obj):
+    """Returns a description of the modifiers on an object. Two objects that
+    share a mesh datablock and have the same modifier stack evaluate to the
+    same mesh.
+
+    Modifiers that reference other objects (eg a mirror object or an
+    armature) depend on where that object is, so the position of the
+    referenced object relative to this one is included."""
+    stack = []
+    for modifier in obj.modifiers:
+        stack.append(rna_properties(modifier))
+
+        # Geometry nodes inputs are stored as ID properties rather than
+        # RNA properties
+        if modifier.type == "NODES":
+            stack.append(tuple((k, id_property(modifier[k])) for k in modifier.keys()))
+
+        for prop in modifier.bl_rna.properties:
+            if prop.type != "POINTER":
+                continue
+            target = getattr(modifier, prop.identifier)
+            if isinstance(target, bpy.types.Object):
+                relative = obj.matrix_world.inverted() @ target.matrix_world
+                stack.append(frozen(relative))
+
+    return tuple(stack)
+
+
+def frozen(value):
+    """Converts (possibly nested) sequences such as vectors and matrices
+    into tuples so that they can be compared and hashed"""
+    if isinstance(value, str):
+        return value
+    try:
+        return tuple(frozen(v) for v in value)
+    except TypeError:
+        return value
+
+
+def id_property(value):
+    """Converts the value of a custom (ID) property into a string"""
+    if hasattr(value, "to_dict"):
+        value = value.to_dict()
+    elif hasattr(value, "to_list"):
+        value = value.to_list()
+    return repr(value)
+
+
+def id_rna_properties(datablock):
+    """rna_properties for a datablock, without the properties common to all
+    datablocks (user counts, tags etc.) which change without the data
+    itself changing"""
+    return rna_properties(datablock, skip=bpy.types.ID.bl_rna.properties.keys())
+
+
+def mesh_object(obj, memo=None):
+    """Returns a description of everything that goes into the evaluated
+    mesh of an object.
+
+    Returns None if the evaluated mesh depends on other datablocks (eg a
+    boolean modifier or geometry nodes) as those can't be described cheaply.
+
+    The digest of the mesh datablock is stored in memo (if given), so that
+    linked duplicates only read the geometry once."""
+    for modifier in obj.modifiers:
+        for prop in modifier.bl_rna.properties:
+            if prop.type != "POINTER":
+                continue
+            if isinstance(getattr(modifier, prop.identifier), bpy.types.ID):
+                return None
+
+    mesh = obj.data
+    if memo is None:
+        digest = mesh_data(mesh)
+    else:
+        key = ("mesh_data", mesh.name_full)
+        if key not in memo:
+            memo[key] = mesh_data(mesh)
+        digest = memo[key]
+
+    description = [digest, modifier_stack(obj)]
+    if obj.modifiers:
+        # Values that only modifiers read, such as creases for subdivision
+        # surface and weights for bevel
+        if memo is None:
+            inputs = modifier_inputs(mesh)
+        else:
+            key = ("modifier_inputs", mesh.name_full)
+            if key not in memo:
+                memo[key] = modifier_inputs(mesh)
+            inputs = memo[key]
+        description.append(inputs)
+    if obj.modifiers and obj.vertex_groups:
+        # Vertex groups are only used by modifiers, and reading the weights
+        # is slow, so they are only included when they might matter.
+        description.append(
+            tuple(tuple((g.group, g.weight) for g in v.groups) for v in mesh.vertices)
+        )
+    return tuple(description)
+
+
+def add_values(digest, items, attribute, typecode, size=1):
+    """Add an attribute of every item in a blender collection to a digest.
+    The values are read all at once with foreach_get"""
+    if typecode == "?":
+        # Bool properties can only be read into a list
+        values = [False] * (len(items) * size)
+        items.foreach_get(attribute, values)
+        digest.update(bytes(values))
+    else:
+        values = array.array(typecode, [0]) * (len(items) * size)
+        items.foreach_get(attribute, values)
+        digest.update(values.tobytes())
+
+
+# Per element values that modifiers read, but that don't change the mesh
+# without modifiers. Each is a property of the elements in older versions
+# of blender, and a generic attribute in newer ones.
+MODIFIER_INPUTS = (
+    ("edges", "crease", "crease_edge"),
+    ("edges", "bevel_weight", "bevel_weight_edge"),
+    ("vertices", "bevel_weight", "bevel_weight_vert"),
+    ("vertices", "crease", "crease_vert"),
+)
+
+
+def modifier_inputs(mesh):
+    """Returns a digest of the values in a mesh datablock that only matter
+    to modifiers (see MODIFIER_INPUTS)"""
+    digest = hashlib.md5()
+    for elements, name, attribute_name in MODIFIER_INPUTS:
+        items = getattr(mesh, elements)
+        if len(items) > 0 and hasattr(items[0], name):
+            add_values(digest, items, name, "f")
+        elif attribute_name in mesh.attributes:
+            digest.update(attribute_name.encode("utf-8"))
+            add_values(digest, mesh.attributes[attribute_name].data, "value", "f")
+    return digest.hexdigest()
+
+
+def mesh_data(mesh):
+    """Returns a digest of the geometry stored in a mesh datablock"""
+    digest = hashlib.md5()
+    digest.update(repr(id_rna_properties(mesh)).encode("utf-8"))
+
+    def add(items, attribute, typecode, size=1):
+        add_values(digest, items, attribute, typecode, size)
+
+    add(mesh.vertices, "co", "f", 3)
+    add(mesh.edges, "vertices", "i", 2)
+    add(mesh.edges, "use_edge_sharp", "?")
+    add(mesh.loops, "vertex_index", "i")
+    add(mesh.polygons, "loop_start", "i")
+    add(mesh.polygons, "loop_total", "i")
+    add(mesh.polygons, "use_smooth", "?")
+    add(mesh.polygons, "material_index", "i")
+    if mesh.uv_layers:
+        add(mesh.uv_layers[0].data, "uv", "f", 2)
+        # Tangents are calculated from the active UV layer
+        active_index = mesh.uv_layers.active_index
+        digest.update(repr(active_index).encode("utf-8"))
+        if active_index > 0:
+            add(mesh.uv_layers[active_index].data, "uv", "f", 2)
+    if mesh.has_custom_normals:
+        mesh.calc_normals_split()
+        add(mesh.loops, "normal", "f", 3)
+    if mesh.shape_keys is not None:
+        for key_block in mesh.shape_keys.key_blocks:
+            digest.update(repr(rna_properties(key_block)).encode("utf-8"))
+            add(key_block.data, "co", "f", 3)
+
+    return digest.hexdigest()
+
+
+def entity(obj, memo):
+    """Returns a description of everything the components of an object are
+    encoded from: its transform, its data (including the evaluated mesh and
+    materials) and the settings of every component added through this addon.
+
+    Descriptions of datablocks shared between objects are stored in memo.
+    Returns None if the object can't be described cheaply (see mesh_object)"""
+    description = [
+        obj.name_full,
+        obj.type,
+        obj.parent.name_full if obj.parent is not None else None,
+        frozen(obj.matrix_world),
+        frozen(obj.matrix_local),
+        frozen(obj.dimensions),
+        frozen(obj.bound_box),
+        obj.hide_render,
+        obj.show_bounds,
+        obj.display_bounds_type,
+        obj.empty_display_size,
+    ]
+
+    # Component settings are stored in property groups that addons register
+    # on the Object type at runtime. Finding them means looking through
+    # every property, so only do that once.
+    if "component_properties" not in memo:
+        memo["component_properties"] = [
+            p.identifier
+            for p in obj.bl_rna.properties
+            if p.is_runtime and p.type == "POINTER"
+        ]
+    for identifier in memo["component_properties"]:
+        value = getattr(obj, identifier)
+        if isinstance(value, bpy.types.PropertyGroup):
+            description.append((identifier, rna_properties(value)))
+
+    # The objects in an instanced collection are exported along with the
+    # instance (see export_collection)
+    description.append(obj.instance_type)
+    if obj.instance_type == "COLLECTION" and obj.instance_collection is not None:
+        instanced = collection_instance(obj.instance_collection, memo)
+        if instanced is None:
+            return None
+        description.append(instanced)
+
+    data = obj.data
+    if obj.type == "MESH":
+        mesh = mesh_object(obj, memo)
+        if mesh is None:
+            return None
+        description.append(mesh)
+        for mat in data.materials:
+            if mat is None:
+                description.append(None)
+                continue
+            key = ("material", mat.name_full)
+            if key not in memo:
+                memo[key] = material(mat)
+            description.append(memo[key])
+    elif data is not None:
+        key = ("data", data.name_full)
+        if key not in memo:
+            memo[key] = id_rna_properties(data)
+        description.append(memo[key])
+
+    return tuple(description)
+
+
+def collection_instance(coll, memo):
+    """Returns a description of every object in a collection that is
+    instanced by other objects. Returns None if any of them can't be
+    described (see entity)"""
+    key = ("collection", coll.name_full)
+    if key not in memo:
+        objects = tuple(entity(o, memo) for o in coll.all_objects)
+        memo[key] = None if None in objects else (frozen(coll.instance_offset), objects)
+    return memo[key]
+
+
+def material(mat):
+    """Returns a description of a material, including its node tree and
+    the image files it references"""
+    description = [id_rna_properties(mat)]
+    if mat.node_tree is not None:
+        description.append(node_tree(mat.node_tree, set()))
+    return tuple(description)
+
+
+# Layout and selection state of nodes, which don't affect the output
+NODE_UI_PROPERTIES = (
+    "location",
+    "width",
+    "width_hidden",
+    "height",
+    "dimensions",
+    "select",
+    "hide",
+    "show_options",
+    "show_preview",
+    "show_texture",
+    "use_custom_color",
+    "color",
+)
+
+
+def node_tree(tree, seen):
+    """Returns a description of the nodes in a node tree and how they
+    are linked together. Node groups are followed, but only described
+    the first time they are seen"""
+    nodes = []
+    for node in tree.nodes:
+        entry = [node.name, rna_properties(node, skip=NODE_UI_PROPERTIES)]
+        # Output sockets hold the value of eg RGB and Value nodes
+        for socket in list(node.inputs) + list(node.outputs):
+            entry.append(
+                (socket.identifier, frozen(getattr(socket, "default_value", None)))
+            )
+
+        image = getattr(node, "image", None)
+        if image is not None:
+            entry.append(image_file(image))
+
+        group = getattr(node, "node_tree", None)
+        if group is not None and group.name_full not in seen:
+            seen.add(group.name_full)
+            entry.append(node_tree(group, seen))
+
+        nodes.append(tuple(entry))
+
+    links = tuple(
+        (
+            link.from_node.name,
+            link.from_socket.identifier,
+            link.to_node.name,
+            link.to_socket.identifier,
+        )
+        for link in tree.links
+    )
+    return (tuple(nodes), links)
+
+
+def image_file(image):
+    """Describes the file behind an image. Uses the modification time and
+    size rather than the contents so that it is cheap for large images"""
+    path = bpy.path.abspath(image.filepath, library=image.library)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return (path, image.file_format, None, None)
+    return (path, image.file_format, stat.st_mtime_ns, stat.st_size)
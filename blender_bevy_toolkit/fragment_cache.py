@@ -0,0 +1,113 @@
+""" Remembers how each object was encoded by the last export of a scene, so
+that an incremental export only has to encode the objects that changed.
+
+The fragments are stored in a sidecar file next to the scene. Each object
+has an entry containing:
+ - key: A fingerprint of everything the entity was encoded from
+ - fragment: The encoded entity, exactly as it was written into the scene
+ - depends: Files the fragment references (eg meshes and materials)
+
+The whole file is discarded if it was written by a different
+FRAGMENT_CACHE_VERSION or with different export settings. A single entry
+is discarded if the key changes or a file it depends on is missing.
+Entries for objects that weren't exported are dropped on save.
+"""
+import os
+import json
+import base64
+import logging
+
+from .utils import jdict
+
+logger = logging.getLogger(__name__)
+
+
+# Increment this whenever the encoding of entities changes in a way that is
+# not captured by the fingerprints. This discards any existing fragments.
+FRAGMENT_CACHE_VERSION = 1
+
+FRAGMENTS_SUFFIX = ".fragments.json"
+
+
+class FragmentCache:
+    """Maps from object names to the encoded entity of that object"""
+
+    def __init__(self, path, settings):
+        self.path = path
+        self.folder = os.path.dirname(path)
+        self.settings = settings
+        self.entries = {}
+        self.used = {}
+        self.reused = 0
+
+    @classmethod
+    def load(cls, path, settings):
+        """Read the fragments from disk. Settings is a string describing
+        everything about the export that changes how all entities are
+        encoded (eg the scene format)"""
+        cache = cls(path, settings)
+        try:
+            with open(path, encoding="utf-8") as fragments_file:
+                data = json.load(fragments_file)
+        except FileNotFoundError:
+            return cache
+        except (OSError, ValueError) as err:
+            logger.warning(
+                jdict(event="fragment_cache_unreadable", path=path, err=str(err))
+            )
+            return cache
+
+        if data.get("version") != FRAGMENT_CACHE_VERSION:
+            logger.info(jdict(event="fragment_cache_version_changed", path=path))
+            return cache
+        if data.get("settings") != settings:
+            logger.info(jdict(event="fragment_cache_settings_changed", path=path))
+            return cache
+
+        cache.entries = data["entries"]
+        return cache
+
+    def save(self):
+        """Write the fragments of every object in this export to disk"""
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as fragments_file:
+            json.dump(
+                {
+                    "version": FRAGMENT_CACHE_VERSION,
+                    "settings": self.settings,
+                    "entries": self.used,
+                },
+                fragments_file,
+            )
+        os.replace(temp_path, self.path)
+
+    def get(self, name, key):
+        """Returns the fragment previously stored for this object, or None if
+        the object has changed since"""
+        entry = self.entries.get(name)
+        if entry is None or entry["key"] != key:
+            return None
+        if not all(
+            os.path.exists(os.path.join(self.folder, p)) for p in entry["depends"]
+        ):
+            logger.debug(jdict(event="fragment_cache_stale", name=name))
+            return None
+
+        self.used[name] = entry
+        self.reused += 1
+        if "bytes" in entry:
+            return base64.b64decode(entry["bytes"])
+        return entry["text"]
+
+    def put(self, name, key, fragment, depends=()):
+        """Record the fragment an object was encoded as. Fragments may be
+        text (RON) or bytes (binary scenes)"""
+        entry = {
+            "key": key,
+            "depends": [os.path.relpath(p, self.folder) for p in depends],
+        }
+        if isinstance(fragment, bytes):
+            entry["bytes"] = base64.b64encode(fragment).decode("ascii")
+        else:
+            entry["text"] = fragment
+        self.used[name] = entry
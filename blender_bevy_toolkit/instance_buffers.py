@@ -0,0 +1,76 @@
+""" Batching of objects that only differ in their transform. Objects that
+share a mesh and material are exported as a single entity, which loads the
+transform of every object from an .instances file. Like mesh_buffers.py,
+this works on numpy arrays where numpy is available and falls back to plain
+python lists where it isn't """
+import struct
+
+from .mesh_buffers import np
+
+
+# An .instances file starts with a header, all little-endian:
+#
+#   magic           4 bytes, "BBTI"
+#   version         u16
+#   flags           u16, INSTANCE_NAMES if the names are stored
+#   instance count  u32
+#
+# followed by the transform of each instance as f32 x10: the translation
+# (x, y, z), the rotation quaternion (x, y, z, w) and the scale (x, y, z).
+# With INSTANCE_NAMES, the name of each instance follows as a u32 length
+# and that many bytes of UTF-8, so that the instances keep the labels of
+# the objects they came from. The loader is in src/blend_instances.rs.
+INSTANCES_MAGIC = b"BBTI"
+INSTANCES_VERSION = 1
+INSTANCES_HEADER = struct.Struct("<4sHHI")
+INSTANCE_SIZE = 10
+
+INSTANCE_NAMES = 1 << 0
+
+
+def group_instances(objects, min_instances=2):
+    """Split objects into those exported on their own and groups that are
+    batched together.
+
+    `objects` holds `(obj, key)` pairs. Objects with the same key are
+    batched together, unless the key is None or fewer than min_instances
+    objects share it. Returns `(singles, groups)`, both in the order the
+    objects were given in"""
+    objects = list(objects)
+
+    by_key = {}
+    for obj, key in objects:
+        if key is not None:
+            by_key.setdefault(key, []).append(obj)
+
+    groups = [group for group in by_key.values() if len(group) >= min_instances]
+    batched = {obj for group in groups for obj in group}
+    singles = [obj for obj, _key in objects if obj not in batched]
+    return singles, groups
+
+
+def pack_instances(transforms, names=None):
+    """Create the contents of an .instances file. `transforms` is a numpy
+    array or a list of tuples, with INSTANCE_SIZE values per instance.
+    `names` optionally holds the name of each instance"""
+    flags = INSTANCE_NAMES if names is not None else 0
+    header = INSTANCES_HEADER.pack(
+        INSTANCES_MAGIC, INSTANCES_VERSION, flags, len(transforms)
+    )
+    if np is not None and isinstance(transforms, np.ndarray):
+        assert transforms.shape[1:] == (INSTANCE_SIZE,)
+        body = np.ascontiguousarray(transforms, dtype="<f").tobytes()
+    else:
+        values = [value for transform in transforms for value in transform]
+        assert len(values) == len(transforms) * INSTANCE_SIZE
+        body = struct.pack(f"<{len(values)}f", *values)
+
+    if names is None:
+        return header + body
+    assert len(names) == len(transforms)
+    blocks = [header, body]
+    for name in names:
+        encoded = name.encode("utf-8")
+        blocks.append(struct.pack("<I", len(encoded)))
+        blocks.append(encoded)
+    return b"".join(blocks)
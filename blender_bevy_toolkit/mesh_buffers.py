@@ -0,0 +1,603 @@
+""" Operations on the vertex and index buffers of a mesh that don't need to
+talk to blender. These work on numpy arrays where numpy is available and
+fall back to plain python lists where it isn't """
+import itertools
+import collections
+import math
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# A .mesh file starts with a header, all little-endian:
+#
+#   magic           4 bytes, "BBTM"
+#   version         u16
+#   flags           u16, which of the ATTRIBUTE_* blocks are present,
+#                   whether there is a SUBMESHES table, and how the
+#                   attributes are encoded (see ENCODINGS)
+#   vertex count    u32
+#   triangle count  u32
+#   offsets         u32 x5, byte offset from the start of the file of the
+#                   position, normal, tangent, uv0 and index blocks. The
+#                   offset of an attribute that isn't present is zero.
+#
+# Positions and normals are f32x3, tangents are f32x4, uvs are f32x2 and
+# indices are u32x3 per triangle, unless a smaller encoding is used:
+#
+#   POSITION_QUANTIZED  f32x3 minimum and f32x3 size of the bounding box at
+#                       the start of the block, then u16x3 per vertex giving
+#                       its position within the box in steps of 1/65535
+#   NORMAL_SNORM16      i16x3, in steps of 1/32767
+#   NORMAL_OCTAHEDRAL   i16x2, the normal mapped onto an octahedron and
+#                       unfolded into a square, in steps of 1/32767
+#   TANGENT_SNORM16     i16x4, in steps of 1/32767
+#   UV0_HALF            f16x2
+#   INDEX_U16           u16x3 per triangle. Only used when there are few
+#                       enough vertices
+#
+# Meshes with more than one material are split into submeshes, one per
+# material slot. The vertices and triangles of each submesh are contiguous,
+# and the SUBMESHES table straight after the index block says where they
+# are: a u32 count, then u32 x4 per submesh of the first vertex, vertex
+# count, first triangle and triangle count. Indices always refer to the
+# whole vertex buffer, so the file can also be loaded as one mesh.
+#
+# Version 2 added the submesh table and version 3 the encodings. Files are
+# written with the oldest version that can describe them, so files that
+# don't use these features (and their names) don't change.
+#
+# Files written before the header was versioned start straight away with
+# a u16 vertex count and a u16 triangle count. The loader in
+# src/blend_mesh.rs tells the two apart by the magic bytes.
+MESH_MAGIC = b"BBTM"
+MESH_VERSION = 3
+MESH_VERSION_WITHOUT_SUBMESHES = 1
+MESH_VERSION_WITHOUT_ENCODINGS = 2
+MESH_HEADER = struct.Struct("<4sHHII5I")
+SUBMESH = struct.Struct("<4I")
+
+ATTRIBUTE_POSITION = 1 << 0
+ATTRIBUTE_NORMAL = 1 << 1
+ATTRIBUTE_TANGENT = 1 << 2
+ATTRIBUTE_UV0 = 1 << 3
+SUBMESHES = 1 << 4
+
+NORMAL_SNORM16 = 1 << 5
+NORMAL_OCTAHEDRAL = 1 << 6
+TANGENT_SNORM16 = 1 << 7
+UV0_HALF = 1 << 8
+POSITION_QUANTIZED = 1 << 9
+INDEX_U16 = 1 << 10
+
+# The encodings that can be picked for an export, by name
+ENCODINGS = {
+    "quantized_positions": POSITION_QUANTIZED,
+    "snorm16_normals": NORMAL_SNORM16,
+    "octahedral_normals": NORMAL_OCTAHEDRAL,
+    "snorm16_tangents": TANGENT_SNORM16,
+    "half_uvs": UV0_HALF,
+    "u16_indices": INDEX_U16,
+}
+
+# The vertex attributes of a mesh, in the order their blocks are written,
+# and the flag that says each one is present
+ATTRIBUTES = (
+    ("positions", ATTRIBUTE_POSITION),
+    ("normals", ATTRIBUTE_NORMAL),
+    ("tangents", ATTRIBUTE_TANGENT),
+    ("uv0", ATTRIBUTE_UV0),
+)
+
+SNORM16_MAX = 32767
+UNORM16_MAX = 65535
+
+
+def encoding_flags(names):
+    """Converts the names of ENCODINGS into header flags"""
+    flags = 0
+    for name in names:
+        if name not in ENCODINGS:
+            raise ValueError(f"Unknown mesh encoding {name}")
+        flags |= ENCODINGS[name]
+    if flags & NORMAL_SNORM16 and flags & NORMAL_OCTAHEDRAL:
+        raise ValueError("Normals can only have one encoding")
+    return flags
+
+
+def deduplicate_vertices(corners, tolerance=0.0):
+    """Merge identical triangle corners into shared vertices.
+
+    `corners` contains one row of packed vertex attributes per triangle
+    corner, either as a 2D numpy array or as a list of tuples. Returns
+    `(vertices, indices)` where `vertices` holds the unique rows in the order
+    they are first referenced and `indices` gives the vertex used by each
+    corner.
+
+    If `tolerance` is non-zero every attribute is rounded to the nearest
+    multiple of it before being compared, and corners that round to the same
+    grid cell share a vertex. This is not a distance check: corners almost
+    a whole `tolerance` apart can be merged, while corners very close
+    together on either side of a cell boundary are not. The first corner
+    seen in each grid cell is the one that gets exported.
+    """
+    if np is not None and isinstance(corners, np.ndarray):
+        return _deduplicate_vertices_array(corners, tolerance)
+    return _deduplicate_vertices_list(corners, tolerance)
+
+
+def _deduplicate_vertices_array(corners, tolerance):
+    """numpy implementation of deduplicate_vertices"""
+    if len(corners) == 0:
+        return corners[:0], np.empty(0, dtype=np.uint32)
+
+    if tolerance:
+        keys = np.floor(corners.astype(np.float64) / tolerance + 0.5).astype(np.int64)
+    else:
+        # Adding zero turns -0.0 into 0.0, so they compare equal when looking
+        # at the raw bytes in the same way they do when compared as floats
+        keys = corners + corners.dtype.type(0.0)
+
+    # View each row as a single opaque blob so that rows can be compared
+    # with a single memcmp rather than field by field
+    keys = np.ascontiguousarray(keys)
+    rows = keys.view(np.dtype((np.void, keys.dtype.itemsize * keys.shape[1])))
+    _, first_seen, inverse = np.unique(
+        rows.reshape(-1), return_index=True, return_inverse=True
+    )
+
+    # np.unique sorts the rows, but vertices are expected in the order they
+    # are first referenced by the triangles.
+    order = np.argsort(first_seen, kind="stable")
+    remap = np.empty_like(order)
+    remap[order] = np.arange(len(order))
+
+    vertices = corners[first_seen[order]]
+    indices = remap[inverse.reshape(-1)].astype(np.uint32)
+    return vertices, indices
+
+
+def _deduplicate_vertices_list(corners, tolerance):
+    """Pure python implementation of deduplicate_vertices"""
+    vertices = []
+    indices = []
+    lookup = {}
+
+    for corner in corners:
+        if tolerance:
+            key = tuple(math.floor(value / tolerance + 0.5) for value in corner)
+        else:
+            key = corner
+
+        index = lookup.get(key)
+        if index is None:
+            index = len(vertices)
+            vertices.append(corner)
+            lookup[key] = index
+        indices.append(index)
+
+    return vertices, indices
+
+
+def deduplicate_submeshes(corners, corner_submeshes, num_submeshes, tolerance=0.0):
+    """Like deduplicate_vertices, but for a mesh split into submeshes.
+    `corner_submeshes` gives the submesh of each corner.
+
+    Vertices are only shared within a submesh. The vertices and triangles
+    of each submesh are placed one after another, in the order of the
+    submeshes. Returns `(vertices, indices, submeshes)` where `submeshes`
+    holds (first vertex, vertex count, first triangle, triangle count) for
+    each submesh, as stored in the SUBMESHES table.
+    """
+    use_arrays = np is not None and isinstance(corners, np.ndarray)
+    if use_arrays:
+        corner_submeshes = np.asarray(corner_submeshes)
+
+    vertex_blocks = []
+    index_blocks = []
+    submeshes = []
+    num_verts = 0
+    num_tris = 0
+    for submesh in range(num_submeshes):
+        if use_arrays:
+            selected = corners[corner_submeshes == submesh]
+        else:
+            selected = [
+                corner
+                for corner, corner_submesh in zip(corners, corner_submeshes)
+                if corner_submesh == submesh
+            ]
+        vertices, indices = deduplicate_vertices(selected, tolerance)
+
+        if use_arrays:
+            indices = indices + np.uint32(num_verts)
+        else:
+            indices = [index + num_verts for index in indices]
+        vertex_blocks.append(vertices)
+        index_blocks.append(indices)
+
+        submeshes.append((num_verts, len(vertices), num_tris, len(indices) // 3))
+        num_verts += len(vertices)
+        num_tris += len(indices) // 3
+
+    if use_arrays:
+        return np.concatenate(vertex_blocks), np.concatenate(index_blocks), submeshes
+    return (
+        list(itertools.chain.from_iterable(vertex_blocks)),
+        list(itertools.chain.from_iterable(index_blocks)),
+        submeshes,
+    )
+
+
+# Size of the FIFO post-transform vertex cache that triangles are reordered
+# for. Real GPUs differ, but orders that are good for one size are good for
+# the others too.
+VERTEX_CACHE_SIZE = 16
+
+
+def optimize_vertex_cache(indices, num_verts, cache_size=VERTEX_CACHE_SIZE):
+    """Reorder triangles so that consecutive triangles share vertices, and
+    the GPU can reuse transformed vertices from its cache rather than
+    running the vertex shader again. Returns the reordered indices.
+
+    This is Tipsify, from "Fast Triangle Reordering for Vertex Locality
+    and Reduced Overdraw" (Sander, Nehab and Barczak, 2007). It emits every
+    remaining triangle around one vertex at a time, and then moves on to a
+    vertex of those triangles that is still in the cache. It runs in time
+    linear in the size of the mesh, but is inherently sequential so it
+    works on plain lists even when given an array.
+    """
+    use_arrays = np is not None and isinstance(indices, np.ndarray)
+    corners = indices.tolist() if use_arrays else list(indices)
+
+    # The triangles using each vertex, and how many of them are left
+    adjacency = _vertex_triangles(corners, num_verts)
+    live = [len(triangles) for triangles in adjacency]
+
+    cache = _VertexCache(num_verts, cache_size)
+    emitted = [False] * (len(corners) // 3)
+    dead_ends = []
+    cursor = 0
+    output = []
+    fanning = 0 if corners else -1
+    while fanning >= 0:
+        candidates = _emit_fan(adjacency[fanning], corners, emitted, live, cache)
+        output.extend(candidates)
+        dead_ends.extend(candidates)
+
+        fanning = _next_fanning_vertex(candidates, live, cache)
+        if fanning < 0:
+            fanning, cursor = _skip_dead_end(dead_ends, live, cursor)
+
+    if use_arrays:
+        return np.array(output, dtype=indices.dtype)
+    return output
+
+
+def _vertex_triangles(corners, num_verts):
+    """The triangles that use each vertex"""
+    adjacency = [[] for _ in range(num_verts)]
+    for corner, vertex in enumerate(corners):
+        adjacency[vertex].append(corner // 3)
+    return adjacency
+
+
+class _VertexCache:
+    """The FIFO vertex cache simulated by optimize_vertex_cache. Rather than
+    holding vertices it records when each one last entered the cache, and a
+    vertex is still cached if fewer than `size` vertices have entered since"""
+
+    def __init__(self, num_verts, size):
+        self.size = size
+        self.timestamps = [0] * num_verts
+        self.time = size + 1
+
+
+def _emit_fan(triangles, corners, emitted, live, cache):
+    """Emit the triangles around a vertex that haven't been emitted yet.
+    Returns their corners"""
+    # This is the inner loop, so the cache's fields are kept in locals
+    timestamps = cache.timestamps
+    time = cache.time
+    fan = []
+    for triangle in triangles:
+        if emitted[triangle]:
+            continue
+        emitted[triangle] = True
+        for vertex in corners[triangle * 3 : triangle * 3 + 3]:
+            fan.append(vertex)
+            live[vertex] -= 1
+            if time - timestamps[vertex] > cache.size:
+                timestamps[vertex] = time
+                time += 1
+    cache.time = time
+    return fan
+
+
+def _next_fanning_vertex(candidates, live, cache):
+    """The vertex that has been in the cache longest, but will still be
+    there after emitting the rest of its triangles. -1 if none of the
+    candidates have any triangles left"""
+    timestamps = cache.timestamps
+    fanning = -1
+    best = -1
+    for vertex in candidates:
+        if live[vertex] > 0:
+            age = cache.time - timestamps[vertex]
+            priority = age if age + 2 * live[vertex] <= cache.size else 0
+            if priority > best:
+                best = priority
+                fanning = vertex
+    return fanning
+
+
+def _skip_dead_end(dead_ends, live, cursor):
+    """Where to go after a dead end: the most recently used vertex that has
+    triangles left, or failing that the next one in the mesh after the
+    cursor. Returns that vertex (or -1 once every triangle has been
+    emitted) and the new cursor"""
+    while dead_ends:
+        vertex = dead_ends.pop()
+        if live[vertex] > 0:
+            return vertex, cursor
+    while cursor < len(live):
+        if live[cursor] > 0:
+            return cursor, cursor
+        cursor += 1
+    return -1, cursor
+
+
+def optimize_vertex_fetch(vertices, indices):
+    """Reorder vertices into the order the triangles first use them, so that
+    the GPU reads the vertex buffer front to back. Vertices that no triangle
+    uses go at the end. Returns `(vertices, indices)`"""
+    if np is not None and isinstance(indices, np.ndarray):
+        used, first_use = np.unique(indices, return_index=True)
+        order = np.concatenate(
+            (
+                used[np.argsort(first_use, kind="stable")],
+                np.setdiff1d(np.arange(len(vertices)), used),
+            )
+        )
+        remap = np.empty(len(vertices), dtype=indices.dtype)
+        remap[order] = np.arange(len(vertices), dtype=indices.dtype)
+        return vertices[order], remap[indices]
+
+    remap = {}
+    for vertex in itertools.chain(indices, range(len(vertices))):
+        if vertex not in remap:
+            remap[vertex] = len(remap)
+    order = sorted(remap, key=remap.get)
+    return [vertices[v] for v in order], [remap[v] for v in indices]
+
+
+def optimize_mesh_order(
+    vertices, indices, submeshes=None, cache_size=VERTEX_CACHE_SIZE
+):
+    """Reorder triangles for the vertex cache (optimize_vertex_cache) and
+    then vertices for fetching (optimize_vertex_fetch). Each submesh is
+    reordered on its own, so the submesh table stays the same. Returns
+    `(vertices, indices)`"""
+    use_arrays = np is not None and isinstance(indices, np.ndarray)
+    if submeshes is None:
+        submeshes = [(0, len(vertices), 0, len(indices) // 3)]
+
+    vertex_blocks = []
+    index_blocks = []
+    for first_vertex, vertex_count, first_tri, tri_count in submeshes:
+        block_vertices = vertices[first_vertex : first_vertex + vertex_count]
+        block_indices = indices[first_tri * 3 : (first_tri + tri_count) * 3]
+        if use_arrays:
+            block_indices = block_indices - indices.dtype.type(first_vertex)
+        else:
+            block_indices = [index - first_vertex for index in block_indices]
+
+        block_indices = optimize_vertex_cache(block_indices, vertex_count, cache_size)
+        block_vertices, block_indices = optimize_vertex_fetch(
+            block_vertices, block_indices
+        )
+
+        if use_arrays:
+            block_indices = block_indices + indices.dtype.type(first_vertex)
+        else:
+            block_indices = [index + first_vertex for index in block_indices]
+        vertex_blocks.append(block_vertices)
+        index_blocks.append(block_indices)
+
+    if use_arrays:
+        return np.concatenate(vertex_blocks), np.concatenate(index_blocks)
+    return (
+        list(itertools.chain.from_iterable(vertex_blocks)),
+        list(itertools.chain.from_iterable(index_blocks)),
+    )
+
+
+def average_cache_miss_ratio(indices, cache_size=VERTEX_CACHE_SIZE):
+    """The average number of vertices transformed per triangle (ACMR) with a
+    FIFO vertex cache of the given size. This is 3 with no reuse at all,
+    and approaches 0.5 for a large, perfectly ordered grid"""
+    if np is not None and isinstance(indices, np.ndarray):
+        indices = indices.tolist()
+    cache = collections.deque()
+    cached = set()
+    misses = 0
+    for vertex in indices:
+        if vertex not in cached:
+            misses += 1
+            cache.append(vertex)
+            cached.add(vertex)
+            if len(cache) > cache_size:
+                cached.discard(cache.popleft())
+    return misses / max(1, len(indices) // 3)
+
+
+def pack_mesh(attributes, indices, submeshes=None, encoding=()):
+    """Create the contents of a .mesh file.
+
+    `attributes` maps the name of each of ATTRIBUTES to its values, a numpy
+    array or a list of tuples with one entry per vertex. `indices` is flat,
+    with three entries per triangle. Every attribute block is packed with a
+    single call and the blocks are joined once at the end, so the cost is
+    linear in the size of the mesh.
+
+    `submeshes` is the table returned by deduplicate_submeshes, for meshes
+    with more than one material. `encoding` holds the names of ENCODINGS
+    to store the attributes with.
+    """
+    num_verts = len(attributes["positions"])
+    for name, _ in ATTRIBUTES:
+        assert len(attributes[name]) == num_verts
+    assert len(indices) % 3 == 0
+
+    encoding = encoding_flags(encoding)
+    if num_verts > UNORM16_MAX + 1:
+        encoding &= ~INDEX_U16
+
+    flags = encoding
+    offsets = {}
+    offset = MESH_HEADER.size
+    blocks = []
+    for name, attribute in ATTRIBUTES:
+        block = _pack_attribute(name, attributes[name], encoding)
+        flags |= attribute
+        offsets[attribute] = offset
+        offset += len(block)
+        blocks.append(block)
+    blocks.append(_pack_block("H" if encoding & INDEX_U16 else "I", indices))
+
+    version = MESH_VERSION_WITHOUT_SUBMESHES
+    if submeshes:
+        flags |= SUBMESHES
+        version = MESH_VERSION_WITHOUT_ENCODINGS
+        blocks.append(struct.pack("<I", len(submeshes)))
+        blocks.extend(SUBMESH.pack(*submesh) for submesh in submeshes)
+    if encoding:
+        version = MESH_VERSION
+
+    header = MESH_HEADER.pack(
+        MESH_MAGIC,
+        version,
+        flags,
+        num_verts,
+        len(indices) // 3,
+        offsets.get(ATTRIBUTE_POSITION, 0),
+        offsets.get(ATTRIBUTE_NORMAL, 0),
+        offsets.get(ATTRIBUTE_TANGENT, 0),
+        offsets.get(ATTRIBUTE_UV0, 0),
+        offset,
+    )
+    return b"".join([header] + blocks)
+
+
+def _pack_attribute(name, values, encoding):
+    """Pack the block of one of ATTRIBUTES, with the encoding the flags ask
+    for"""
+    if name == "positions" and encoding & POSITION_QUANTIZED:
+        return _pack_quantized_positions(values)
+    if name == "normals" and encoding & NORMAL_OCTAHEDRAL:
+        return _pack_block("h", _snorm16(_octahedral(values)))
+    if name == "normals" and encoding & NORMAL_SNORM16:
+        return _pack_block("h", _snorm16(values))
+    # Bevy expects tangents to be a vec4 because https://github.com/bevyengine/bevy/issues/3604
+    if name == "tangents" and encoding & TANGENT_SNORM16:
+        return _pack_block("h", _snorm16(values))
+    if name == "uv0" and encoding & UV0_HALF:
+        return _pack_block("e", values)
+    return _pack_block("f", values)
+
+
+def _pack_block(format_char, values):
+    """Pack an attribute into little-endian bytes. Values can be a numpy
+    array or a (possibly nested) list"""
+    if np is not None and isinstance(values, np.ndarray):
+        return np.ascontiguousarray(values, dtype="<" + format_char).tobytes()
+
+    values = list(values)
+    if values and isinstance(values[0], (tuple, list)):
+        values = list(itertools.chain.from_iterable(values))
+    return struct.pack(f"<{len(values)}{format_char}", *values)
+
+
+def _snorm16(values):
+    """Quantize values between -1 and 1 to signed 16 bit integers"""
+    if np is not None and isinstance(values, np.ndarray):
+        values = np.clip(values.astype(np.float64), -1.0, 1.0)
+        return np.round(values * SNORM16_MAX).astype(np.int16)
+    return [
+        tuple(round(min(max(v, -1.0), 1.0) * SNORM16_MAX) for v in value)
+        for value in values
+    ]
+
+
+def _octahedral(normals):
+    """Map unit vectors onto the faces of an octahedron, which unfolds into
+    a square. Returns the 2D coordinates of each, between -1 and 1"""
+    if np is not None and isinstance(normals, np.ndarray):
+        normals = normals.astype(np.float64)
+        length = np.abs(normals).sum(axis=1)
+        length[length == 0.0] = 1.0
+        x = normals[:, 0] / length
+        y = normals[:, 1] / length
+        sign_x = np.where(x >= 0.0, 1.0, -1.0)
+        sign_y = np.where(y >= 0.0, 1.0, -1.0)
+        lower = normals[:, 2] < 0.0
+        return np.stack(
+            [
+                np.where(lower, (1.0 - np.abs(y)) * sign_x, x),
+                np.where(lower, (1.0 - np.abs(x)) * sign_y, y),
+            ],
+            axis=1,
+        )
+
+    mapped = []
+    for normal in normals:
+        length = abs(normal[0]) + abs(normal[1]) + abs(normal[2]) or 1.0
+        x = normal[0] / length
+        y = normal[1] / length
+        if normal[2] < 0.0:
+            x, y = (
+                (1.0 - abs(y)) * (1.0 if x >= 0.0 else -1.0),
+                (1.0 - abs(x)) * (1.0 if y >= 0.0 else -1.0),
+            )
+        mapped.append((x, y))
+    return mapped
+
+
+def _pack_quantized_positions(positions):
+    """Pack positions as 16 bit steps across their bounding box, after the
+    minimum and size of the box"""
+    if np is not None and isinstance(positions, np.ndarray):
+        positions = positions.astype(np.float64)
+        if len(positions):
+            minimum = positions.min(axis=0)
+            size = positions.max(axis=0) - minimum
+        else:
+            minimum = np.zeros(3)
+            size = np.zeros(3)
+        # The loader only has the f32 size, so quantize with that too
+        size = size.astype(np.float32).astype(np.float64)
+        size[size == 0.0] = 1.0
+        steps = np.round((positions - minimum) / size * UNORM16_MAX)
+        bounds = np.concatenate([minimum, size])
+        return _pack_block("f", bounds) + _pack_block("H", steps.astype(np.uint16))
+
+    positions = list(positions)
+    if positions:
+        minimum = [min(p[axis] for p in positions) for axis in range(3)]
+        maximum = [max(p[axis] for p in positions) for axis in range(3)]
+        size = [hi - lo for lo, hi in zip(minimum, maximum)]
+    else:
+        minimum = [0.0, 0.0, 0.0]
+        size = [0.0, 0.0, 0.0]
+    size = [struct.unpack("<f", struct.pack("<f", s))[0] or 1.0 for s in size]
+    steps = [
+        tuple(
+            round((p[axis] - minimum[axis]) / size[axis] * UNORM16_MAX)
+            for axis in range(3)
+        )
+        for p in positions
+    ]
+    return _pack_block("f", minimum + size) + _pack_block("H", steps)
@@ -1,25 +1,35 @@
 """ Handles encoding types (vectors, floats) from blender formats into
 bevy-reflected formats serialized with RON """
 import mathutils
-from . import ron
+from . import ron, cbor
 from .ron import Str, Int, EnumValue, Map, List, Base
 
 
+class Reflected(Base):
+    """A rust type that is serialized as some other value. Subclasses
+    return that value from `as_ron` so it can be written in any format"""
+
+    def as_ron(self):
+        """The value this type is serialized as"""
+        raise NotImplementedError()
+
+    def write(self, stream, indent):
+        ron.write(self.as_ron(), stream, indent)
+
+
 def reflect(type_path, processor):
     """Bevy reflects structs as maps. Create a map
     for the specified type, using the passed in "processor" function
     to pre-process the value"""
 
-    class ReflectedType(Base):
+    class ReflectedType(Reflected):
         """Bevy reflects structs as maps"""
 
         def __init__(self, value):
             self.value = value
 
-        def to_str(self, indent):
-            return ron.encode(
-                ron.Map(type=type_path, value=processor(self.value)), indent
-            )
+        def as_ron(self):
+            return ron.Map(type=type_path, value=processor(self.value))
 
     return ReflectedType
 
@@ -45,37 +55,31 @@ RgbaLinear = reflect(
 Entity = reflect("bevy_ecs::entity::Entity", lambda x: x)
 
 
-class Enum(Base):
+class Enum(Reflected):
     """Reflected Enum that describes both type and value"""
 
     def __init__(self, contained_type, value):
         self.contained_type = contained_type
         self.value = value
 
-    def to_str(self, indent):
-        return ron.encode(
-            ron.Map(
-                type=self.contained_type,
-                value=self.value,
-            ),
-            indent,
+    def as_ron(self):
+        return ron.Map(
+            type=self.contained_type,
+            value=self.value,
         )
 
 
-class Option(Base):
+class Option(Reflected):
     """Reflected Rust option. None or Some(value)"""
 
     def __init__(self, contained_type, value):
         self.contained_type = contained_type
         self.value = value
 
-    def to_str(self, indent):
-        return ron.encode(
-            ron.Map(
-                type=f"core::option::Option<{self.contained_type}>",
-                value=ron.EnumValue("None")
-                if self.value is None
-                else ron.EnumValue("Some", ron.Tuple(self.value)),
-            ),
-            indent,
+    def as_ron(self):
+        return ron.Map(
+            type=f"core::option::Option<{self.contained_type}>",
+            value=ron.EnumValue("None")
+            if self.value is None
+            else ron.EnumValue("Some", ron.Tuple(self.value)),
         )
@@ -0,0 +1,151 @@
+""" Writes the same values as ron.py, but as CBOR (https://cbor.io) rather
+than as text. CBOR is a binary format that (unlike eg bincode) describes
+its own structure, which bevy's reflection based scene deserializer needs.
+
+The values are laid out the way serde_cbor expects them:
+
+ - Lists and tuples are arrays
+ - Structs and maps are maps with string keys
+ - `None` and `Some(value)` are null and the value itself
+ - Unit enum variants are the name of the variant as a string
+ - Other enum variants are a map with a single entry from the name of the
+   variant to its value
+
+```
+cbor.write(ron.Tuple(1, 2, 3), outfile)
+```
+"""
+import io
+import struct
+
+from . import ron
+
+
+MAJOR_UNSIGNED = 0
+MAJOR_NEGATIVE = 1
+MAJOR_TEXT = 3
+MAJOR_ARRAY = 4
+MAJOR_MAP = 5
+
+FALSE = b"\xf4"
+TRUE = b"\xf5"
+NULL = b"\xf6"
+FLOAT64 = struct.Struct(">Bd")
+
+# Arrays of unknown length (eg written from a generator) start with this
+# and end with BREAK
+INDEFINITE_ARRAY = b"\x9f"
+BREAK = b"\xff"
+
+
+def head(major, length):
+    """The initial bytes of a data item: its major type and its length
+    (or value, for integers)"""
+    major <<= 5
+    if length < 24:
+        return bytes((major | length,))
+    if length < 1 << 8:
+        return struct.pack(">BB", major | 24, length)
+    if length < 1 << 16:
+        return struct.pack(">BH", major | 25, length)
+    if length < 1 << 32:
+        return struct.pack(">BI", major | 26, length)
+    return struct.pack(">BQ", major | 27, length)
+
+
+def write_str(stream, value):
+    """Text string"""
+    data = value.encode("utf-8")
+    stream.write(head(MAJOR_TEXT, len(data)))
+    stream.write(data)
+
+
+def write_int(stream, value):
+    """Positive or negative integer"""
+    if value >= 0:
+        stream.write(head(MAJOR_UNSIGNED, value))
+    else:
+        stream.write(head(MAJOR_NEGATIVE, -1 - value))
+
+
+def write_array(stream, values):
+    """Array of values. Values that don't have a length (eg a generator) are
+    written as an indefinite length array"""
+    if hasattr(values, "__len__"):
+        stream.write(head(MAJOR_ARRAY, len(values)))
+        for value in values:
+            write(value, stream)
+    else:
+        stream.write(INDEFINITE_ARRAY)
+        for value in values:
+            write(value, stream)
+        stream.write(BREAK)
+
+
+def write_map(stream, mapping):
+    """Map with string keys"""
+    stream.write(head(MAJOR_MAP, len(mapping)))
+    for key, value in mapping.items():
+        write_str(stream, key)
+        write(value, stream)
+
+
+def write_enum_value(stream, value):
+    """Enum variants, including rust options"""
+    if value.value is None:
+        if value.variant == "None":
+            stream.write(NULL)
+        else:
+            write_str(stream, value.variant)
+        return
+
+    inner = value.value
+    if isinstance(inner, ron.Tuple) and len(inner.values) == 1:
+        # A newtype variant such as Some(value)
+        inner = inner.values[0]
+
+    if value.variant == "Some":
+        write(inner, stream)
+        return
+
+    stream.write(head(MAJOR_MAP, 1))
+    write_str(stream, value.variant)
+    write(inner, stream)
+
+
+def write(data, stream):
+    """Encode some data as CBOR, writing it into a binary file-like object"""
+    if isinstance(data, ron.Deferred):
+        data = data.resolve()
+
+    if hasattr(data, "as_ron"):
+        data = data.as_ron()
+    elif not isinstance(data, ron.Base):
+        data = ron.ENCODE_MAP[type(data)](data)
+
+    if isinstance(data, ron.Encoded):
+        # Already encoded as CBOR bytes
+        stream.write(data.value)
+    elif isinstance(data, (ron.List, ron.Tuple)):
+        write_array(stream, data.values)
+    elif isinstance(data, (ron.Struct, ron.Map)):
+        write_map(stream, data.mapping)
+    elif isinstance(data, ron.EnumValue):
+        write_enum_value(stream, data)
+    elif isinstance(data, ron.Str):
+        write_str(stream, data.value)
+    elif isinstance(data, ron.Bool):
+        stream.write(TRUE if data.value else FALSE)
+    elif isinstance(data, ron.Int):
+        write_int(stream, data.value)
+    elif isinstance(data, ron.Float):
+        stream.write(FLOAT64.pack(0xFB, data.value))
+    else:
+        raise TypeError(f"Can't encode {type(data).__name__} as CBOR")
+
+
+def encode(data):
+    """Encode some data as CBOR bytes"""
+    stream = io.BytesIO()
+    write(data, stream)
+    return stream.getvalue()
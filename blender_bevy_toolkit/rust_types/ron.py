@@ -9,7 +9,14 @@ For example, you can construct a tuple with:
 t = ron.Tuple(1,2,3,4)
 ron.encode(t)
 ```
+
+or write it straight into a file with:
+
+```
+ron.write(t, outfile)
+```
 """
+import io
 from abc import ABCMeta
 
 
@@ -17,18 +24,71 @@ INDENT_SIZE = 1
 INDENT_CHAR = "\t"
 
 
-def ind(indent_level):
-    """Create indent string"""
-    if INDENT_SIZE == 0:
+def ind(indent_level, indent_size=None, indent_char=None):
+    """Create indent string. Uses the module defaults unless a size or
+    character is given"""
+    if indent_size is None:
+        indent_size = INDENT_SIZE
+    if indent_char is None:
+        indent_char = INDENT_CHAR
+    if indent_size == 0:
         return ""
-    return "\n" + INDENT_CHAR * INDENT_SIZE * indent_level
+    return "\n" + indent_char * indent_size * indent_level
+
+
+class Writer:
+    """Wraps a file-like object with the formatting used while writing RON
+    into it. The formatting belongs to the writer rather than the module,
+    so differently formatted files can be written at the same time.
+
+    Without an indent size the module defaults are used. An indent size of
+    zero writes compact RON with no whitespace at all."""
+
+    def __init__(self, stream, indent_size=None, indent_char=None):
+        self.stream = stream
+        self.indent_size = INDENT_SIZE if indent_size is None else indent_size
+        self.indent_char = INDENT_CHAR if indent_char is None else indent_char
+
+    def write(self, text):
+        """Write a piece of already encoded RON"""
+        self.stream.write(text)
+
+    def ind(self, indent_level):
+        """Create indent string"""
+        return ind(indent_level, self.indent_size, self.indent_char)
 
 
 class Base(metaclass=ABCMeta):
-    """Convert into a rust/ron type"""
+    """Convert into a rust/ron type.
+
+    Subclasses need to implement at least one of `write` or `to_str`"""
 
     def to_str(self, indent):
         """Do Serialization"""
+        return encode(self, indent)
+
+    def write(self, stream, indent):
+        """Do Serialization, writing straight into a Writer"""
+        stream.write(self.to_str(indent))
+
+
+def write_sequence(stream, values, indent, open_char, close_char):
+    """Write the values separated by commas and surrounded by the open and
+    close characters. Values can be any iterable (including a generator)
+    and are only consumed as they are written"""
+    stream.write(open_char)
+    indc = None
+    for value in values:
+        if indc is None:
+            indc = stream.ind(indent + 1)
+            stream.write(indc)
+        else:
+            stream.write(",")
+            stream.write(indc)
+        write(value, stream, indent + 1)
+    if indc is not None:
+        stream.write(stream.ind(indent))
+    stream.write(close_char)
 
 
 class List(Base):
@@ -37,15 +97,17 @@ class List(Base):
     def __init__(self, *values):
         self.values = values
 
-    def to_str(self, indent):
-        if not self.values:
-            return "[]"
-        indc = ind(indent + 1)
-        return (
-            f"[{indc}"
-            + f",{indc}".join(encode(d, indent + 1) for d in self.values)
-            + f"{ind(indent)}]"
-        )
+    @classmethod
+    def from_iterable(cls, values):
+        """A list whose items are produced as they are written, eg from a
+        generator. This allows writing a list without holding every item
+        in memory at once"""
+        lst = cls()
+        lst.values = values
+        return lst
+
+    def write(self, stream, indent):
+        write_sequence(stream, self.values, indent, "[", "]")
 
 
 class Tuple(Base):
@@ -54,15 +116,8 @@ class Tuple(Base):
     def __init__(self, *values):
         self.values = values
 
-    def to_str(self, indent):
-        if not self.values:
-            return "()"
-        indc = ind(indent + 1)
-        return (
-            f"({indc}"
-            + f",{indc}".join(encode(d, indent + 1) for d in self.values)
-            + f"{ind(indent)})"
-        )
+    def write(self, stream, indent):
+        write_sequence(stream, self.values, indent, "(", ")")
 
 
 class Struct(Base):
@@ -76,14 +131,27 @@ class Struct(Base):
     def __init__(self, **mapping):
         self.mapping = mapping
 
-    def to_str(self, indent):
-        if not self.mapping:
-            return "()"
-        indc = ind(indent + 1)
-        field_string = f",{indc}".join(
-            f"{k}:{encode(v, indent+1)}" for k, v in self.mapping.items()
+    def write(self, stream, indent):
+        write_sequence(
+            stream,
+            (StructField(k, v) for k, v in self.mapping.items()),
+            indent,
+            "(",
+            ")",
         )
-        return f"({indc}{field_string}{ind(indent)})"
+
+
+class StructField(Base):
+    """A single `key:value` pair inside a Struct"""
+
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+
+    def write(self, stream, indent):
+        stream.write(self.key)
+        stream.write(":")
+        write(self.value, stream, indent)
 
 
 class Map(Base):
@@ -97,15 +165,27 @@ class Map(Base):
     def __init__(self, **mapping):
         self.mapping = mapping
 
-    def to_str(self, indent):
-        if not self.mapping:
-            return "{}"
-        indc = ind(indent + 1)
-        field_string = f",{indc}".join(
-            f"{encode(k, indent+1)}:{encode(v, indent+1)}"
-            for k, v in self.mapping.items()
+    def write(self, stream, indent):
+        write_sequence(
+            stream,
+            (MapEntry(k, v) for k, v in self.mapping.items()),
+            indent,
+            "{",
+            "}",
         )
-        return f"{{{indc}{field_string}{ind(indent)}}}"
+
+
+class MapEntry(Base):
+    """A single `"key":value` pair inside a Map"""
+
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+
+    def write(self, stream, indent):
+        write(self.key, stream, indent)
+        stream.write(":")
+        write(self.value, stream, indent)
 
 
 class EnumValue(Base):
@@ -121,10 +201,10 @@ class EnumValue(Base):
         self.variant = variant
         self.value = value
 
-    def to_str(self, indent):
-        if self.value is None:
-            return self.variant
-        return self.variant + encode(self.value, indent)
+    def write(self, stream, indent):
+        stream.write(self.variant)
+        if self.value is not None:
+            write(self.value, stream, indent)
 
 
 class Str(Base):
@@ -171,6 +251,29 @@ class Float(Base):
         return str(self.value)
 
 
+class Encoded(Base):
+    """A value that has already been encoded (eg from a previous export),
+    which is written out exactly as it is"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def to_str(self, _indent):
+        return self.value
+
+
+class Deferred(Base):
+    """A value that isn't known until it is written (eg because it is still
+    being worked out in the background). `resolve` is called to get the
+    value when it is needed"""
+
+    def __init__(self, resolve):
+        self.resolve = resolve
+
+    def write(self, stream, indent):
+        write(self.resolve(), stream, indent)
+
+
 ENCODE_MAP = {
     str: Str,
     int: Int,
@@ -181,9 +284,25 @@ ENCODE_MAP = {
 }
 
 
-def encode(data, indent=0):
+def encode(data, indent=0, indent_size=None, indent_char=None):
     """The "base" encoder. Call this with some data and hopefully it will be encoded
     as a string"""
-    if hasattr(data, "to_str"):
-        return data.to_str(indent)
-    return ENCODE_MAP[type(data)](data).to_str(indent)
+    stream = io.StringIO()
+    write(data, stream, indent, indent_size, indent_char)
+    return stream.getvalue()
+
+
+def write(data, stream, indent=0, indent_size=None, indent_char=None):
+    """Encode some data, writing it into a file-like object (eg an open file)
+    piece by piece rather than building up the whole string in memory.
+
+    `stream` may also be a Writer, in which case its formatting is used"""
+    if not isinstance(stream, Writer):
+        stream = Writer(stream, indent_size, indent_char)
+
+    if isinstance(data, Base):
+        data.write(stream, indent)
+    elif hasattr(data, "to_str"):
+        stream.write(data.to_str(indent))
+    else:
+        ENCODE_MAP[type(data)](data).write(stream, indent)
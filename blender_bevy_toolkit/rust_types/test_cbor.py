@@ -0,0 +1,80 @@
+""" Test that cbor.py produces valid CBOR laid out the way serde_cbor
+expects. Expected bytes are from the examples in RFC 8949 """
+from . import cbor, ron
+from . import Option, F32
+
+
+def test_int():
+    """Small numbers fit in the initial byte, larger ones follow it"""
+    assert cbor.encode(0) == bytes.fromhex("00")
+    assert cbor.encode(23) == bytes.fromhex("17")
+    assert cbor.encode(24) == bytes.fromhex("1818")
+    assert cbor.encode(1000) == bytes.fromhex("1903e8")
+    assert cbor.encode(1000000) == bytes.fromhex("1a000f4240")
+    assert cbor.encode(1000000000000) == bytes.fromhex("1b000000e8d4a51000")
+    assert cbor.encode(-1) == bytes.fromhex("20")
+    assert cbor.encode(-1000) == bytes.fromhex("3903e7")
+
+
+def test_float_bool_str():
+    """Floats are always 64 bit"""
+    assert cbor.encode(1.5) == bytes.fromhex("fb3ff8000000000000")
+    assert cbor.encode(ron.Float(1)) == bytes.fromhex("fb3ff0000000000000")
+    assert cbor.encode(True) == bytes.fromhex("f5")
+    assert cbor.encode(ron.Bool(False)) == bytes.fromhex("f4")
+    assert cbor.encode("a") == bytes.fromhex("6161")
+    assert cbor.encode("ü") == bytes.fromhex("62c3bc")
+
+
+def test_containers():
+    """Lists and tuples are arrays, structs and maps are maps"""
+    assert cbor.encode(ron.List()) == bytes.fromhex("80")
+    assert cbor.encode(ron.List(1, 2, 3)) == bytes.fromhex("83010203")
+    assert cbor.encode(ron.Tuple(1, ron.List(2, 3))) == bytes.fromhex("8201820203")
+    assert cbor.encode(ron.Map(a=1, b=ron.List(2, 3))) == bytes.fromhex(
+        "a26161016162820203"
+    )
+    assert cbor.encode(ron.Struct(a=1)) == cbor.encode(ron.Map(a=1))
+
+
+def test_list_from_iterable():
+    """Lists without a known length are indefinite length arrays"""
+    lst = ron.List.from_iterable(i for i in (1, 2))
+    assert cbor.encode(lst) == bytes.fromhex("9f0102ff")
+
+
+def test_enum_value():
+    """Enums follow serde's externally tagged representation"""
+    assert cbor.encode(ron.EnumValue("Center")) == cbor.encode("Center")
+    assert cbor.encode(ron.EnumValue("Click", ron.Tuple(1))) == bytes.fromhex(
+        "a165436c69636b01"
+    )
+    assert cbor.encode(ron.EnumValue("Click", ron.Tuple(1, 2))) == bytes.fromhex(
+        "a165436c69636b820102"
+    )
+    assert cbor.encode(ron.EnumValue("Click", ron.Struct(x=1))) == bytes.fromhex(
+        "a165436c69636ba1617801"
+    )
+
+
+def test_option():
+    """Options are null or the value itself"""
+    assert cbor.encode(ron.EnumValue("None")) == bytes.fromhex("f6")
+    assert cbor.encode(ron.EnumValue("Some", ron.Tuple("a"))) == bytes.fromhex("6161")
+    assert cbor.encode(Option("alloc::string::String", None)) == cbor.encode(
+        ron.Map(
+            type="core::option::Option<alloc::string::String>",
+            value=ron.EnumValue("None"),
+        )
+    )
+
+
+def test_reflected():
+    """Reflected types are written as the value they represent"""
+    assert cbor.encode(F32(1.5)) == cbor.encode(ron.Map(type="f32", value=1.5))
+
+
+def test_encoded():
+    """Already encoded values are written as they are"""
+    fragment = cbor.encode(ron.Struct(entity=1))
+    assert cbor.encode(ron.List(ron.Encoded(fragment))) == b"\x81" + fragment
@@ -1,4 +1,5 @@
 """ Test that ron.py produces valid RON """
+import io
 from . import ron
 
 
@@ -61,3 +62,64 @@ def test_enumvalue():
     assert ron.encode(ron.EnumValue("Click", ron.Tuple(1, 2))) == "Click(1,2)"
     assert ron.encode(ron.EnumValue("Some", ron.Tuple("Value"))) == 'Some("Value")'
     assert ron.encode(ron.EnumValue("None")) == "None"
+
+
+def test_write():
+    """Writing into a stream gives the same result as encoding"""
+    value = ron.List(ron.Struct(a=ron.Map(b=1.5)), ron.EnumValue("None"), "c")
+    stream = io.StringIO()
+    ron.write(value, stream)
+    assert stream.getvalue() == ron.encode(value)
+
+
+def test_list_from_iterable():
+    """Lists can be written from a generator, which is only consumed as the
+    list is written"""
+    consumed = []
+
+    def items():
+        for i in range(3):
+            consumed.append(i)
+            yield i
+
+    lst = ron.List.from_iterable(items())
+    assert not consumed
+    assert ron.encode(lst) == "[0,1,2]"
+    assert consumed == [0, 1, 2]
+    assert ron.encode(ron.List.from_iterable(iter(()))) == "[]"
+
+
+def test_writer_formatting():
+    """Formatting is per writer and doesn't touch the module defaults"""
+    value = ron.List(ron.Struct(a=1), ron.Map(b=ron.Tuple(2, 3)))
+
+    compact = io.StringIO()
+    ron.write(value, ron.Writer(compact, indent_size=0))
+    assert compact.getvalue() == '[(a:1),{"b":(2,3)}]'
+
+    pretty = io.StringIO()
+    ron.write(value, ron.Writer(pretty, indent_size=2, indent_char=" "))
+    assert pretty.getvalue() == (
+        '[\n  (\n    a:1\n  ),\n  {\n    "b":(\n      2,\n      3\n    )\n  }\n]'
+    )
+    assert ron.encode(value, indent_size=0) == compact.getvalue()
+    assert ron.INDENT_SIZE == 0
+
+
+def test_encoded():
+    """Already encoded values are written as they are"""
+    assert ron.encode(ron.List(ron.Encoded("(a:1)"), 2)) == "[(a:1),2]"
+
+
+def test_deferred():
+    """Deferred values are only worked out when they are written"""
+    resolved = []
+
+    def resolve():
+        resolved.append(True)
+        return ron.Str("late")
+
+    value = ron.Struct(path=ron.Deferred(resolve))
+    assert not resolved
+    assert ron.encode(value) == '(path:"late")'
+    assert resolved
@@ -0,0 +1,68 @@
+""" Test the background asset writer """
+import pytest
+
+from .asset_writer import AssetWriter, AtomicFile
+
+
+def test_write_and_copy(tmp_path):
+    """Files are all written by the time join returns"""
+    source = tmp_path / "source.png"
+    source.write_bytes(b"image")
+
+    writer = AssetWriter(fsync=True)
+    writer.write(str(tmp_path / "a.mesh"), b"mesh")
+    writer.copy(str(source), str(tmp_path / "b.png"))
+    writer.join()
+
+    assert (tmp_path / "a.mesh").read_bytes() == b"mesh"
+    assert (tmp_path / "b.png").read_bytes() == b"image"
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "a.mesh",
+        "b.png",
+        "source.png",
+    ]
+
+
+def test_existing_not_rewritten(tmp_path):
+    """Files are named after their contents, so existing files are kept"""
+    (tmp_path / "a.mesh").write_bytes(b"old")
+
+    writer = AssetWriter()
+    writer.write(str(tmp_path / "a.mesh"), b"new")
+    writer.write(str(tmp_path / "b.mesh"), b"first")
+    writer.write(str(tmp_path / "b.mesh"), b"second")
+    writer.join()
+
+    assert (tmp_path / "a.mesh").read_bytes() == b"old"
+    assert (tmp_path / "b.mesh").read_bytes() == b"first"
+
+
+def test_failed_write_leaves_nothing(tmp_path):
+    """A file that isn't completely written never appears"""
+    path = tmp_path / "a.mesh"
+    with pytest.raises(RuntimeError):
+        with AtomicFile(str(path)) as outfile:
+            outfile.write(b"partial")
+            raise RuntimeError()
+    assert not list(tmp_path.iterdir())
+
+
+def test_join_raises(tmp_path):
+    """Errors from the background threads are raised by join"""
+    writer = AssetWriter()
+    writer.copy(str(tmp_path / "missing.png"), str(tmp_path / "a.png"))
+    with pytest.raises(FileNotFoundError):
+        writer.join()
+
+
+def test_hardlink(tmp_path):
+    """Copies can be hard links to the source"""
+    source = tmp_path / "source.png"
+    source.write_bytes(b"image")
+
+    writer = AssetWriter(hardlink=True)
+    writer.copy(str(source), str(tmp_path / "a.png"))
+    writer.join()
+
+    assert (tmp_path / "a.png").read_bytes() == b"image"
+    assert (tmp_path / "a.png").stat().st_ino == source.stat().st_ino
@@ -0,0 +1,99 @@
+""" Test compressing exported files """
+import pytest
+
+from . import compression
+from .asset_writer import AssetWriter
+from .compression import Compressor, DictionaryGroup
+
+zstandard = pytest.importorskip("zstandard")
+lz4_frame = pytest.importorskip("lz4.frame")
+
+
+def material(i):
+    """A small RON file, like the ones written for materials"""
+    return (
+        f"(base_color: Rgba(red: {i / 64:.3f}, green: 0.8, blue: 0.8, alpha: 1.0), "
+        "base_color_texture: None, emissive: Rgba(red: 0.0, green: 0.0, "
+        "blue: 0.0, alpha: 1.0), emissive_texture: None, "
+        f"perceptual_roughness: {1 - i / 64:.3f}, metallic: 0.0, reflectance: 0.5, "
+        "unlit: false, double_sided: false, alpha_mode: Opaque)"
+    ).encode("utf-8")
+
+
+def test_round_trip():
+    """Compressed data starts with the magic bytes the loader looks for"""
+    data = bytes(range(256)) * 64
+    compressed = Compressor("zstd").compress(data)
+    assert compressed.startswith(compression.ZSTD_MAGIC)
+    assert zstandard.ZstdDecompressor().decompress(compressed) == data
+
+    compressed = Compressor("lz4", level=9).compress(data)
+    assert compressed.startswith(compression.LZ4_MAGIC)
+    assert lz4_frame.decompress(compressed) == data
+
+    assert Compressor().compress(data) is data
+
+
+def test_incompressible_kept():
+    """Data that compression doesn't make smaller is left as it is"""
+    assert Compressor("zstd").compress(b"(a)") == b"(a)"
+    assert Compressor("lz4").compress(b"(a)") == b"(a)"
+
+
+def test_stream(tmp_path):
+    """Streamed data decompresses to what was written"""
+    path = tmp_path / "a.scnb"
+    with open(path, "wb") as outfile:
+        with Compressor("zstd").stream(outfile) as stream:
+            for i in range(100):
+                stream.write(b"entity %d" % i)
+        assert not outfile.closed
+    expected = b"".join(b"entity %d" % i for i in range(100))
+    assert (
+        zstandard.ZstdDecompressor().decompressobj().decompress(path.read_bytes())
+        == expected
+    )
+
+
+def test_dictionary(tmp_path):
+    """Materials compressed with a shared dictionary are smaller than
+    materials compressed on their own, and need the dictionary to load"""
+    writer = AssetWriter(compressor=Compressor("zstd"))
+    group = DictionaryGroup(str(tmp_path), size=1024)
+    samples = {str(tmp_path / f"{i}.material"): material(i) for i in range(64)}
+    for path, data in samples.items():
+        group.add(path, data)
+    group.write(writer)
+    writer.join()
+
+    dictionaries = list(tmp_path.glob("*" + compression.DICTIONARY_SUFFIX))
+    assert len(dictionaries) == 1
+    dictionary = zstandard.ZstdCompressionDict(dictionaries[0].read_bytes())
+    assert dictionaries[0].name == f"{dictionary.dict_id():08x}.zdict"
+
+    decompressor = zstandard.ZstdDecompressor(dict_data=dictionary)
+    for path, data in samples.items():
+        with open(path, "rb") as infile:
+            compressed = infile.read()
+        assert zstandard.get_frame_parameters(compressed).dict_id == (
+            dictionary.dict_id()
+        )
+        assert decompressor.decompress(compressed) == data
+        assert len(compressed) < len(Compressor("zstd").compress(data))
+
+
+def test_dictionary_too_few_samples(tmp_path):
+    """With too few files to train on, they are compressed without one"""
+    writer = AssetWriter(compressor=Compressor("zstd"))
+    group = DictionaryGroup(str(tmp_path))
+    group.add(str(tmp_path / "a.material"), material(0))
+    group.write(writer)
+    writer.join()
+
+    assert [p.name for p in tmp_path.iterdir()] == ["a.material"]
+
+
+def test_unknown_method():
+    """Typos are errors rather than silently writing uncompressed files"""
+    with pytest.raises(ValueError):
+        Compressor("gzip")
@@ -0,0 +1,71 @@
+""" Test the persistent export cache """
+import json
+
+from . import export_cache
+
+
+def make_output(folder, name):
+    """Create a file in the output folder"""
+    path = folder / name
+    path.write_bytes(b"data")
+    return str(path)
+
+
+def test_roundtrip(tmp_path):
+    """Entries survive saving and loading the manifest"""
+    manifest = str(tmp_path / export_cache.MANIFEST_FILENAME)
+    output = make_output(tmp_path, "a.mesh")
+
+    cache = export_cache.ExportCache.load(manifest, 10)
+    assert cache.get("key") is None
+    cache.put("key", output)
+    cache.save()
+
+    cache = export_cache.ExportCache.load(manifest, 10)
+    assert cache.get("key") == output
+
+
+def test_missing_output(tmp_path):
+    """Entries whose files have been deleted are discarded"""
+    manifest = str(tmp_path / export_cache.MANIFEST_FILENAME)
+    output = make_output(tmp_path, "a.material")
+    texture = make_output(tmp_path, "a.png")
+
+    cache = export_cache.ExportCache(manifest, 10)
+    cache.put("key", output, depends=[texture])
+    assert cache.get("key") == output
+
+    (tmp_path / "a.png").unlink()
+    assert cache.get("key") is None
+
+
+def test_lru_eviction(tmp_path):
+    """The least recently used entries are dropped once the cache is full"""
+    manifest = str(tmp_path / export_cache.MANIFEST_FILENAME)
+    outputs = [make_output(tmp_path, f"{i}.mesh") for i in range(3)]
+
+    cache = export_cache.ExportCache(manifest, 2)
+    cache.put("0", outputs[0])
+    cache.put("1", outputs[1])
+    assert cache.get("0") == outputs[0]
+    cache.put("2", outputs[2])
+
+    assert cache.get("1") is None
+    assert cache.get("0") == outputs[0]
+    assert cache.get("2") == outputs[2]
+
+
+def test_version_change(tmp_path):
+    """A manifest from a different version of the exporter is ignored"""
+    manifest = tmp_path / export_cache.MANIFEST_FILENAME
+    make_output(tmp_path, "a.mesh")
+    manifest.write_text(
+        json.dumps(
+            {
+                "version": export_cache.CACHE_VERSION - 1,
+                "entries": {"key": {"path": "a.mesh", "depends": []}},
+            }
+        )
+    )
+    cache = export_cache.ExportCache.load(str(manifest), 10)
+    assert cache.get("key") is None
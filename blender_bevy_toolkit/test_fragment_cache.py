@@ -0,0 +1,62 @@
+""" Test the fragments kept for incremental exports """
+from . import fragment_cache
+
+
+def test_roundtrip(tmp_path):
+    """Fragments survive saving and loading, as text or as bytes"""
+    path = str(tmp_path / ("Scene" + fragment_cache.FRAGMENTS_SUFFIX))
+
+    cache = fragment_cache.FragmentCache.load(path, "settings")
+    assert cache.get("Cube", "key") is None
+    cache.put("Cube", "key", "(entity:0)")
+    cache.put("Lamp", "key", b"\xa0\xff")
+    cache.save()
+
+    cache = fragment_cache.FragmentCache.load(path, "settings")
+    assert cache.get("Cube", "key") == "(entity:0)"
+    assert cache.get("Cube", "changed") is None
+    assert cache.get("Lamp", "key") == b"\xa0\xff"
+    assert cache.reused == 2
+
+
+def test_settings_change(tmp_path):
+    """Fragments written with different settings are all discarded"""
+    path = str(tmp_path / ("Scene" + fragment_cache.FRAGMENTS_SUFFIX))
+    cache = fragment_cache.FragmentCache(path, "ron")
+    cache.put("Cube", "key", "(entity:0)")
+    cache.save()
+
+    cache = fragment_cache.FragmentCache.load(path, "binary")
+    assert cache.get("Cube", "key") is None
+
+
+def test_unused_dropped(tmp_path):
+    """Objects that weren't in the last export are forgotten"""
+    path = str(tmp_path / ("Scene" + fragment_cache.FRAGMENTS_SUFFIX))
+    cache = fragment_cache.FragmentCache(path, "settings")
+    cache.put("Cube", "key", "(entity:0)")
+    cache.put("Lamp", "key", "(entity:1)")
+    cache.save()
+
+    cache = fragment_cache.FragmentCache.load(path, "settings")
+    assert cache.get("Cube", "key") is not None
+    cache.save()
+
+    cache = fragment_cache.FragmentCache.load(path, "settings")
+    assert cache.get("Lamp", "key") is None
+
+
+def test_missing_depends(tmp_path):
+    """Fragments referencing files that have been deleted are discarded"""
+    path = str(tmp_path / ("Scene" + fragment_cache.FRAGMENTS_SUFFIX))
+    mesh = tmp_path / "a.mesh"
+    mesh.write_bytes(b"data")
+
+    cache = fragment_cache.FragmentCache(path, "settings")
+    cache.put("Cube", "key", "(entity:0)", depends=[str(mesh)])
+    cache.save()
+
+    cache = fragment_cache.FragmentCache.load(path, "settings")
+    assert cache.get("Cube", "key") == "(entity:0)"
+    mesh.unlink()
+    assert cache.get("Cube", "key") is None
@@ -0,0 +1,57 @@
+""" Test the batching of objects that only differ in their transform """
+import numpy as np
+
+from . import instance_buffers
+
+
+def test_group_instances():
+    """Objects sharing a key are grouped if there are enough of them"""
+    objects = [("a", 1), ("b", 2), ("c", 1), ("d", None), ("e", 1), ("f", 2)]
+
+    singles, groups = instance_buffers.group_instances(objects, min_instances=3)
+    assert singles == ["b", "d", "f"]
+    assert groups == [["a", "c", "e"]]
+
+    singles, groups = instance_buffers.group_instances(objects, min_instances=2)
+    assert singles == ["d"]
+    assert groups == [["a", "c", "e"], ["b", "f"]]
+
+
+def test_pack_instances():
+    """Lists and arrays pack the same, after the header"""
+    transforms = [
+        (1.0, 2.0, 3.0, 0.0, 0.0, 0.0, 1.0, 1.0, 1.0, 1.0),
+        (4.0, 5.0, 6.0, 0.0, 0.0, 1.0, 0.0, 2.0, 2.0, 2.0),
+    ]
+    from_lists = instance_buffers.pack_instances(transforms)
+    from_arrays = instance_buffers.pack_instances(
+        np.array(transforms, dtype=np.float32)
+    )
+    assert from_lists == from_arrays
+
+    header = instance_buffers.INSTANCES_HEADER.unpack_from(from_lists)
+    assert header == (
+        instance_buffers.INSTANCES_MAGIC,
+        instance_buffers.INSTANCES_VERSION,
+        0,
+        2,
+    )
+    assert len(from_lists) == instance_buffers.INSTANCES_HEADER.size + 2 * 10 * 4
+
+
+def test_pack_instance_names():
+    """Names follow the transforms, each prefixed by its length"""
+    transforms = [(0.0,) * 10, (1.0,) * 10]
+    data = instance_buffers.pack_instances(transforms, ["Cube", "Cübe.001"])
+
+    header = instance_buffers.INSTANCES_HEADER.unpack_from(data)
+    assert header[2] == instance_buffers.INSTANCE_NAMES
+    names_start = instance_buffers.INSTANCES_HEADER.size + 2 * 10 * 4
+    unnamed = instance_buffers.pack_instances(transforms)
+    assert len(unnamed) == names_start
+    assert data[instance_buffers.INSTANCES_HEADER.size : names_start] == (
+        unnamed[instance_buffers.INSTANCES_HEADER.size :]
+    )
+    assert data[names_start:] == (
+        b"\x04\x00\x00\x00Cube" + b"\x09\x00\x00\x00" + "Cübe.001".encode("utf-8")
+    )
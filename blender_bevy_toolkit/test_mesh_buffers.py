@@ -0,0 +1,366 @@
+""" Test the blender-independant mesh buffer operations """
+import struct
+
+import numpy as np
+import pytest
+
+from . import mesh_buffers
+
+
+CORNERS = [
+    (0.0, 0.0, 1.0),
+    (1.0, 0.0, 0.0),
+    (0.0, 0.0, 1.0),
+    (2.0, 0.0, 0.0),
+    (1.0, 0.0, 0.0),
+    (-0.0, 0.0, 1.0),
+]
+
+
+def test_dedup_first_seen_order():
+    """Vertices come out in the order they are first referenced"""
+    vertices, indices = mesh_buffers.deduplicate_vertices(
+        np.array(CORNERS, dtype=np.float32)
+    )
+    assert vertices.tolist() == [[0.0, 0.0, 1.0], [1.0, 0.0, 0.0], [2.0, 0.0, 0.0]]
+    assert indices.tolist() == [0, 1, 0, 2, 1, 0]
+
+
+def test_dedup_array_matches_list():
+    """The numpy and pure python implementations give the same answer"""
+    rng = np.random.default_rng(0)
+    corners = rng.integers(0, 4, size=(300, 5)).astype(np.float32) * 0.5
+
+    array_vertices, array_indices = mesh_buffers.deduplicate_vertices(corners)
+    list_vertices, list_indices = mesh_buffers.deduplicate_vertices(
+        [tuple(float(v) for v in row) for row in corners]
+    )
+    assert array_vertices.tolist() == [list(v) for v in list_vertices]
+    assert array_indices.tolist() == list_indices
+
+
+def test_dedup_tolerance():
+    """Nearly identical corners are merged when a tolerance is given"""
+    corners = np.array([(0.0, 1.0), (0.0001, 1.0), (0.5, 1.0)], dtype=np.float32)
+
+    vertices, indices = mesh_buffers.deduplicate_vertices(corners)
+    assert len(vertices) == 3
+
+    vertices, indices = mesh_buffers.deduplicate_vertices(corners, 0.001)
+    assert len(vertices) == 2
+    assert indices.tolist() == [0, 0, 1]
+
+    vertices, indices = mesh_buffers.deduplicate_vertices(
+        [tuple(float(v) for v in row) for row in corners], 0.001
+    )
+    assert indices == [0, 0, 1]
+
+
+def test_dedup_empty():
+    """A mesh with no triangles has no vertices"""
+    vertices, indices = mesh_buffers.deduplicate_vertices(
+        np.empty((0, 12), dtype=np.float32)
+    )
+    assert len(vertices) == 0
+    assert len(indices) == 0
+
+
+def test_pack_mesh_array_matches_list():
+    """Packing numpy arrays gives the same bytes as packing lists"""
+    positions = [(0.0, 1.0, 2.0), (3.0, 4.0, 5.0), (6.0, 7.0, 8.0)]
+    normals = [(0.0, 0.0, 1.0)] * 3
+    tangents = [(1.0, 0.0, 0.0, -1.0)] * 3
+    uv0 = [(0.0, 0.5), (1.0, 0.5), (0.5, 1.0)]
+    indices = [0, 1, 2]
+
+    attributes = {
+        "positions": positions,
+        "normals": normals,
+        "tangents": tangents,
+        "uv0": uv0,
+    }
+
+    from_lists = mesh_buffers.pack_mesh(attributes, indices)
+    from_arrays = mesh_buffers.pack_mesh(
+        {
+            name: np.array(values, dtype=np.float32)
+            for name, values in attributes.items()
+        },
+        np.array(indices, dtype=np.uint32),
+    )
+    assert from_lists == from_arrays
+    assert (
+        len(from_lists) == mesh_buffers.MESH_HEADER.size + 3 * (12 + 12 + 16 + 8) + 12
+    )
+
+
+def test_pack_mesh_header():
+    """The header describes where to find each block"""
+    data = mesh_buffers.pack_mesh(
+        {
+            "positions": [(0.0, 0.0, 0.0)] * 70000,
+            "normals": [(0.0, 0.0, 1.0)] * 70000,
+            "tangents": [(1.0, 0.0, 0.0, 1.0)] * 70000,
+            "uv0": [(0.0, 0.0)] * 70000,
+        },
+        indices=[0, 1, 2] * 70000,
+    )
+    header = mesh_buffers.MESH_HEADER.unpack_from(data)
+    magic, version, flags, num_verts, num_tris, *offsets = header
+    assert magic == mesh_buffers.MESH_MAGIC
+    assert version == mesh_buffers.MESH_VERSION_WITHOUT_SUBMESHES
+    assert flags == (
+        mesh_buffers.ATTRIBUTE_POSITION
+        | mesh_buffers.ATTRIBUTE_NORMAL
+        | mesh_buffers.ATTRIBUTE_TANGENT
+        | mesh_buffers.ATTRIBUTE_UV0
+    )
+    # More than fits in a u16
+    assert num_verts == 70000
+    assert num_tris == 70000
+    assert offsets[0] == mesh_buffers.MESH_HEADER.size
+    assert offsets[-1] == len(data) - 70000 * 12
+
+
+def test_dedup_submeshes():
+    """Vertices are only shared within a submesh, and each submesh is
+    contiguous. Lists and arrays give the same result"""
+    corners = [(0.0, 0.0), (1.0, 0.0), (0.0, 1.0)] * 2 + [(2.0, 2.0)] * 3
+    corner_submeshes = [1, 1, 1, 0, 0, 0, 1, 1, 1]
+
+    vertices, indices, submeshes = mesh_buffers.deduplicate_submeshes(
+        corners, corner_submeshes, 3
+    )
+    assert vertices == [(0.0, 0.0), (1.0, 0.0), (0.0, 1.0)] * 2 + [(2.0, 2.0)]
+    assert indices == [0, 1, 2, 3, 4, 5, 6, 6, 6]
+    assert submeshes == [(0, 3, 0, 1), (3, 4, 1, 2), (7, 0, 3, 0)]
+
+    array_vertices, array_indices, array_submeshes = mesh_buffers.deduplicate_submeshes(
+        np.array(corners, dtype=np.float32), np.array(corner_submeshes), 3
+    )
+    assert array_vertices.tolist() == [list(v) for v in vertices]
+    assert array_indices.tolist() == indices
+    assert array_submeshes == submeshes
+
+
+def test_pack_mesh_submeshes():
+    """The submesh table follows the index block, and only files that
+    have one are version 2 or later"""
+    positions = [(0.0, 0.0, 0.0)] * 6
+    data = mesh_buffers.pack_mesh(
+        {
+            "positions": positions,
+            "normals": positions,
+            "tangents": [(1.0, 0.0, 0.0, 1.0)] * 6,
+            "uv0": [(0.0, 0.0)] * 6,
+        },
+        indices=[0, 1, 2, 3, 4, 5],
+        submeshes=[(0, 3, 0, 1), (3, 3, 1, 1)],
+    )
+    header = mesh_buffers.MESH_HEADER.unpack_from(data)
+    _magic, version, flags, _num_verts, num_tris, *offsets = header
+    assert version == mesh_buffers.MESH_VERSION_WITHOUT_ENCODINGS
+    assert flags & mesh_buffers.SUBMESHES
+
+    table = offsets[-1] + num_tris * 12
+    assert struct.unpack_from("<I", data, table) == (2,)
+    assert mesh_buffers.SUBMESH.unpack_from(data, table + 4) == (0, 3, 0, 1)
+    assert mesh_buffers.SUBMESH.unpack_from(data, table + 20) == (3, 3, 1, 1)
+    assert len(data) == table + 4 + 2 * mesh_buffers.SUBMESH.size
+
+
+def random_mesh(num_verts, seed=0):
+    """The arguments of pack_mesh for a mesh with unit normals and
+    tangents"""
+    rng = np.random.default_rng(seed)
+    normals = rng.normal(size=(num_verts, 3))
+    normals /= np.linalg.norm(normals, axis=1)[:, None]
+    tangents = np.ones((num_verts, 4))
+    tangents[:, :3] = rng.normal(size=(num_verts, 3))
+    tangents[:, :3] /= np.linalg.norm(tangents[:, :3], axis=1)[:, None]
+    tangents[::2, 3] = -1.0
+    return {
+        "attributes": {
+            "positions": rng.uniform(-5.0, 3.0, size=(num_verts, 3)).astype(np.float32),
+            "normals": normals.astype(np.float32),
+            "tangents": tangents.astype(np.float32),
+            "uv0": rng.uniform(0.0, 1.0, size=(num_verts, 2)).astype(np.float32),
+        },
+        "indices": rng.integers(0, num_verts, size=num_verts * 3).astype(np.uint32),
+    }
+
+
+def as_lists(mesh):
+    """The same mesh as python lists"""
+    return {
+        "attributes": {
+            name: [tuple(float(v) for v in row) for row in values]
+            for name, values in mesh["attributes"].items()
+        },
+        "indices": [int(v) for v in mesh["indices"]],
+    }
+
+
+def decode_octahedral(values):
+    """Unit normals from their octahedral encoding, between -1 and 1"""
+    x, y = values.T
+    z = 1.0 - np.abs(x) - np.abs(y)
+    folded = z < 0.0
+    x, y = (
+        np.where(folded, (1.0 - np.abs(y)) * np.where(x >= 0.0, 1.0, -1.0), x),
+        np.where(folded, (1.0 - np.abs(x)) * np.where(y >= 0.0, 1.0, -1.0), y),
+    )
+    normals = np.stack([x, y, z], axis=1)
+    return normals / np.linalg.norm(normals, axis=1)[:, None]
+
+
+def decode_mesh(data):
+    """The attributes and indices of a mesh packed with every encoding
+    except snorm16 normals"""
+    num_verts, num_tris, *offsets = mesh_buffers.MESH_HEADER.unpack_from(data)[3:]
+    position_start, normal_start, tangent_start, uv0_start, index_start = offsets
+
+    bounds = np.frombuffer(data, "<f4", 6, position_start)
+    steps = np.frombuffer(data, "<u2", num_verts * 3, position_start + 24)
+    normals = np.frombuffer(data, "<i2", num_verts * 2, normal_start) / 32767
+    tangents = np.frombuffer(data, "<i2", num_verts * 4, tangent_start) / 32767
+    return {
+        "positions": bounds[:3] + steps.reshape(-1, 3) / 65535 * bounds[3:],
+        "normals": decode_octahedral(normals.reshape(-1, 2)),
+        "tangents": tangents.reshape(-1, 4),
+        "uv0": np.frombuffer(data, "<f2", num_verts * 2, uv0_start).reshape(-1, 2),
+        "indices": np.frombuffer(data, "<u2", num_tris * 3, index_start),
+    }
+
+
+def test_pack_mesh_encoding_array_matches_list():
+    """Every encoding packs arrays and lists to the same bytes"""
+    mesh = random_mesh(50)
+    for encoding in (
+        tuple(mesh_buffers.ENCODINGS.keys() - {"snorm16_normals"}),
+        ("snorm16_normals",),
+    ):
+        from_arrays = mesh_buffers.pack_mesh(**mesh, encoding=encoding)
+        from_lists = mesh_buffers.pack_mesh(**as_lists(mesh), encoding=encoding)
+        assert from_arrays == from_lists
+
+
+def test_pack_mesh_encoding_precision():
+    """Decoding the encoded attributes gives back roughly the originals"""
+    mesh = random_mesh(100)
+    encoding = tuple(mesh_buffers.ENCODINGS.keys() - {"snorm16_normals"})
+    data = mesh_buffers.pack_mesh(**mesh, encoding=encoding)
+
+    _magic, version, flags, *_, index_start = mesh_buffers.MESH_HEADER.unpack_from(data)
+    assert version == mesh_buffers.MESH_VERSION
+    assert flags & mesh_buffers.INDEX_U16
+
+    decoded = decode_mesh(data)
+    attributes = mesh["attributes"]
+    assert np.allclose(decoded["positions"], attributes["positions"], atol=8.0 / 65535)
+    assert np.allclose(decoded["normals"], attributes["normals"], atol=1e-3)
+    assert np.allclose(decoded["tangents"], attributes["tangents"], atol=1e-4)
+    assert np.allclose(decoded["uv0"], attributes["uv0"], atol=1e-3)
+    assert (decoded["indices"] == mesh["indices"]).all()
+    assert len(data) == index_start + len(mesh["indices"]) * 2
+
+
+def test_pack_mesh_encoding_errors():
+    """Unknown encodings are rejected, and u16 indices are only used when
+    every vertex can be indexed"""
+    mesh = random_mesh(3)
+    with pytest.raises(ValueError):
+        mesh_buffers.pack_mesh(**mesh, encoding=("u8_indices",))
+    with pytest.raises(ValueError):
+        mesh_buffers.pack_mesh(
+            **mesh, encoding=("snorm16_normals", "octahedral_normals")
+        )
+
+    mesh = random_mesh(70000)
+    data = mesh_buffers.pack_mesh(**mesh, encoding=("u16_indices",))
+    flags = mesh_buffers.MESH_HEADER.unpack_from(data)[2]
+    assert not flags & mesh_buffers.INDEX_U16
+
+
+def shuffled_grid(size, seed=0):
+    """The indices of a grid of quads, with the triangles in random order"""
+    triangles = []
+    for y in range(size):
+        for x in range(size):
+            corner = y * (size + 1) + x
+            triangles.append((corner, corner + 1, corner + size + 1))
+            triangles.append((corner + 1, corner + size + 2, corner + size + 1))
+    np.random.default_rng(seed).shuffle(triangles)
+    return np.array(triangles, dtype=np.uint32).reshape(-1)
+
+
+def triangle_set(vertices, indices):
+    """The triangles of a mesh as sets of vertex rows, each rotated to
+    start at its smallest vertex so that the winding is kept"""
+    triangles = []
+    for i in range(0, len(indices), 3):
+        corners = [tuple(vertices[index]) for index in indices[i : i + 3]]
+        start = corners.index(min(corners))
+        triangles.append(tuple(corners[start:] + corners[:start]))
+    return sorted(triangles)
+
+
+def test_average_cache_miss_ratio():
+    """Every vertex is transformed once if the cache holds them all"""
+    assert mesh_buffers.average_cache_miss_ratio([0, 1, 2, 2, 1, 3]) == 2.0
+    assert mesh_buffers.average_cache_miss_ratio([0, 1, 2, 3, 4, 5, 0, 1, 2], 3) == 3.0
+    assert mesh_buffers.average_cache_miss_ratio([]) == 0.0
+
+
+def test_optimize_mesh_order():
+    """The same triangles, with the same winding, but in an order that uses
+    the vertex cache much better. Vertices are in the order they are used"""
+    indices = shuffled_grid(32)
+    vertices = np.random.default_rng(0).random((33 * 33, 12)).astype(np.float32)
+    new_vertices, new_indices = mesh_buffers.optimize_mesh_order(vertices, indices)
+
+    assert new_indices.dtype == np.uint32
+    assert triangle_set(new_vertices, new_indices) == triangle_set(vertices, indices)
+    assert mesh_buffers.average_cache_miss_ratio(indices) > 2.5
+    assert mesh_buffers.average_cache_miss_ratio(new_indices) < 0.8
+
+    _, first_use = np.unique(new_indices, return_index=True)
+    assert new_indices[np.sort(first_use)].tolist() == list(range(len(vertices)))
+
+
+def test_optimize_mesh_order_array_matches_list():
+    """The numpy and pure python implementations give the same answer"""
+    indices = shuffled_grid(8)
+    vertices = np.random.default_rng(1).random((81, 4)).astype(np.float32)
+    array_vertices, array_indices = mesh_buffers.optimize_mesh_order(vertices, indices)
+    list_vertices, list_indices = mesh_buffers.optimize_mesh_order(
+        [tuple(row) for row in vertices.tolist()], indices.tolist()
+    )
+    assert array_vertices.tolist() == [list(v) for v in list_vertices]
+    assert array_indices.tolist() == list_indices
+
+
+def test_optimize_mesh_order_submeshes():
+    """Each submesh is reordered within its own range of the buffers"""
+    rng = np.random.default_rng(2)
+    corners = rng.integers(0, 3, size=(600, 4)).astype(np.float32)
+    corner_submeshes = np.repeat(rng.integers(0, 3, size=200), 3)
+    vertices, indices, submeshes = mesh_buffers.deduplicate_submeshes(
+        corners, corner_submeshes, 3
+    )
+    new_vertices, new_indices = mesh_buffers.optimize_mesh_order(
+        vertices, indices, submeshes
+    )
+
+    for first_vertex, vertex_count, first_tri, tri_count in submeshes:
+        vertex_range = slice(first_vertex, first_vertex + vertex_count)
+        index_range = slice(first_tri * 3, (first_tri + tri_count) * 3)
+        block = new_indices[index_range]
+        assert block.min() >= first_vertex
+        assert block.max() < first_vertex + vertex_count
+        assert sorted(map(tuple, new_vertices[vertex_range].tolist())) == sorted(
+            map(tuple, vertices[vertex_range].tolist())
+        )
+        assert triangle_set(new_vertices, block) == triangle_set(
+            vertices, indices[index_range]
+        )
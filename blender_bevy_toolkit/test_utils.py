@@ -0,0 +1,51 @@
+""" Test the small utility functions """
+import hashlib
+
+import pytest
+
+from . import utils
+from .utils import lookahead, hash_bytes, hash_file
+
+
+def test_lookahead():
+    """Items are taken from the source ahead of being yielded"""
+    taken = []
+
+    def source():
+        for i in range(5):
+            taken.append(i)
+            yield i
+
+    items = lookahead(source(), 2)
+    assert next(items) == 0
+    assert taken == [0, 1, 2]
+    assert list(items) == [1, 2, 3, 4]
+    assert not list(lookahead(iter(()), 2))
+
+
+def test_hash_file(tmp_path, monkeypatch):
+    """Files hashed a chunk at a time match hashing all their bytes"""
+    monkeypatch.setattr(utils, "HASH_CHUNK_SIZE", 7)
+    data = bytes(range(256)) * 3
+    path = tmp_path / "image.png"
+    path.write_bytes(data)
+    for algorithm in utils.HASH_ALGORITHMS:
+        if algorithm == "xxhash" and utils.xxhash is None:
+            continue
+        assert hash_file(str(path), algorithm) == hash_bytes(data, algorithm)
+        assert len(hash_bytes(data, algorithm)) == 32
+
+
+def test_hash_default():
+    """md5 is the default, so exported file names don't change"""
+    assert hash_bytes(b"mesh") == hashlib.md5(b"mesh").hexdigest()
+    with pytest.raises(ValueError):
+        hash_bytes(b"mesh", "sha1")
+
+
+def test_hash_xxhash_unavailable(monkeypatch):
+    """Without the xxhash package, xxhash is an error rather than quietly
+    naming files with another digest"""
+    monkeypatch.setattr(utils, "xxhash", None)
+    with pytest.raises(ValueError):
+        hash_bytes(b"mesh", "xxhash")
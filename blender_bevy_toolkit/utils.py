@@ -1,7 +1,84 @@
 """ Small Utility Functions """
 import json
+import time
+import hashlib
+import collections
+import contextlib
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+# Files are hashed this many bytes at a time, so that large textures never
+# have to be held in memory all at once
+HASH_CHUNK_SIZE = 1 << 20
+
+# Digests that can be used for naming exported files. md5 is the default so
+# that file names stay the same as they always have been. The others are
+# faster and produce names of the same length.
+HASH_ALGORITHMS = ("md5", "blake2b", "xxhash")
 
 
 def jdict(**kwargs):
     """Dump arguments into a JSON-encoded string"""
     return json.dumps(dict(**kwargs))
+
+
+@contextlib.contextmanager
+def timed(timings, name):
+    """Add the time spent inside the with block to timings[name]"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+
+def lookahead(iterable, size):
+    """Yields the same items as iterable, but always takes up to `size`
+    items from it before yielding one. If taking items starts work in the
+    background, this allows that work to be done before it is needed"""
+    buffered = collections.deque()
+    for item in iterable:
+        buffered.append(item)
+        if len(buffered) > size:
+            yield buffered.popleft()
+    while buffered:
+        yield buffered.popleft()
+
+
+def new_hash(algorithm="md5"):
+    """Create a hash object for one of the HASH_ALGORITHMS. xxhash is an
+    optional dependency, and asking for it when it isn't installed is an
+    error: falling back to another digest would give the same files
+    different names on different machines"""
+    if algorithm == "xxhash":
+        if xxhash is None:
+            raise ValueError("The xxhash asset hash needs the xxhash package")
+        return xxhash.xxh3_128()
+    if algorithm == "blake2b":
+        return hashlib.blake2b(digest_size=16)
+    if algorithm == "md5":
+        return hashlib.md5()
+    raise ValueError(f"Unknown hash algorithm {algorithm}")
+
+
+def hash_bytes(data, algorithm="md5"):
+    """Hex digest of some bytes"""
+    digest = new_hash(algorithm)
+    digest.update(data)
+    return digest.hexdigest()
+
+
+def hash_file(path, algorithm="md5"):
+    """Hex digest of the contents of a file, read a chunk at a time"""
+    digest = new_hash(algorithm)
+    with open(path, "rb") as infile:
+        while True:
+            chunk = infile.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,113 @@
+""" Measures how well optimize_mesh_order (see
+blender_bevy_toolkit/mesh_buffers.py) reorders exported meshes for the
+GPU's vertex cache.
+
+On the command line, call something like:
+	python scripts/benchmark_mesh_order.py ref-assets/scenes/meshes/*.mesh
+
+This doesn't need blender. For each .mesh file it reports the average cache
+miss ratio (ACMR, the number of vertices transformed per triangle) of the
+triangles in the order they were exported, and after reordering them, along
+with how long reordering took. Lower is better: 3 means no vertex is ever
+reused, and a well ordered grid approaches 0.5.
+
+The meshes are the ones in ref-assets if none are given. Meshes exported
+with --optimize-mesh-order are already reordered, and compressed meshes
+(--compression) are skipped.
+"""
+
+import os
+import sys
+import glob
+import time
+import argparse
+import importlib.util
+
+import numpy as np
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Importing the blender_bevy_toolkit package needs blender, but mesh_buffers
+# doesn't, so load it on its own
+spec = importlib.util.spec_from_file_location(
+    'mesh_buffers', os.path.join(ROOT, 'blender_bevy_toolkit', 'mesh_buffers.py')
+)
+mesh_buffers = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(mesh_buffers)
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('meshes', help=".mesh files to reorder", nargs='*')
+    parser.add_argument('--cache-size', help="Number of vertices in the simulated FIFO vertex cache", type=int, default=mesh_buffers.VERTEX_CACHE_SIZE)
+    config = parser.parse_args(args)
+
+    paths = config.meshes or sorted(glob.glob(os.path.join(ROOT, 'ref-assets', 'scenes', 'meshes', '*.mesh')))
+    if not paths:
+        print("No meshes to benchmark")
+        return 1
+
+    print("{:<40} {:>10} {:>8} {:>8} {:>8}".format('mesh', 'triangles', 'before', 'after', 'seconds'))
+    total_triangles = 0
+    total_before = 0.0
+    total_after = 0.0
+    total_seconds = 0.0
+    for path in paths:
+        with open(path, 'rb') as mesh_file:
+            mesh = read_indices(mesh_file.read())
+        if mesh is None:
+            print("{:<40} skipped, not an uncompressed versioned .mesh file".format(os.path.basename(path)))
+            continue
+        num_verts, indices, submeshes = mesh
+
+        before = mesh_buffers.average_cache_miss_ratio(indices, config.cache_size)
+        start = time.perf_counter()
+        # Only the indices matter, so the vertices are just their numbers
+        _, reordered = mesh_buffers.optimize_mesh_order(
+            np.arange(num_verts, dtype=np.uint32), indices, submeshes, config.cache_size
+        )
+        seconds = time.perf_counter() - start
+        after = mesh_buffers.average_cache_miss_ratio(reordered, config.cache_size)
+
+        num_tris = len(indices) // 3
+        print("{:<40} {:>10} {:>8.3f} {:>8.3f} {:>8.3f}".format(
+            os.path.basename(path), num_tris, before, after, seconds
+        ))
+        total_triangles += num_tris
+        total_before += before * num_tris
+        total_after += after * num_tris
+        total_seconds += seconds
+
+    if total_triangles:
+        print("{:<40} {:>10} {:>8.3f} {:>8.3f} {:>8.3f}".format(
+            'total', total_triangles, total_before / total_triangles,
+            total_after / total_triangles, total_seconds
+        ))
+    return 0
+
+
+def read_indices(data):
+    """The vertex count, index buffer and submesh table of a .mesh file (see
+    the layout in mesh_buffers.py), or None if it can't be read"""
+    if not data.startswith(mesh_buffers.MESH_MAGIC):
+        return None
+    _magic, _version, flags, num_verts, num_tris, *offsets = mesh_buffers.MESH_HEADER.unpack_from(data)
+
+    dtype = np.uint16 if flags & mesh_buffers.INDEX_U16 else np.uint32
+    index_offset = offsets[4]
+    indices = np.frombuffer(data, dtype=dtype, count=num_tris * 3, offset=index_offset).astype(np.uint32)
+
+    submeshes = None
+    if flags & mesh_buffers.SUBMESHES:
+        table_offset = index_offset + indices.size * np.dtype(dtype).itemsize
+        (count,) = np.frombuffer(data, dtype=np.uint32, count=1, offset=table_offset)
+        submeshes = [
+            mesh_buffers.SUBMESH.unpack_from(data, table_offset + 4 + i * mesh_buffers.SUBMESH.size)
+            for i in range(count)
+        ]
+    return num_verts, indices, submeshes
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -3,23 +3,57 @@ automatically export a bunch of files.
 
 On the command line, call something like:
 	blender -b test_scenes/Cube.blend --python export.py -- --output-file="bin/Cube.scn"
+
+To export many files without starting blender for each one, list them in a
+manifest and call:
+	blender -b --python export.py -- --manifest="test_scenes/manifest.json"
+
+The manifest is a JSON list of {"blend": ..., "output": ...} objects, with
+paths relative to the current directory. Each blend file is opened in turn
+and exported to its output path.
 """
 
 import os
 import sys
+import json
+import time
 import bpy
 import traceback
 import argparse
+import importlib.util
 
 import logging
 
 
 def export_all(args):
     parser = argparse.ArgumentParser()
-    parser.add_argument('--output-file', help="Output all data to here", 
-required=True)
+    parser.add_argument('--output-file', help="Output all data to here")
+    parser.add_argument('--manifest', help="Export every blend file listed in this JSON file (see above)")
+    parser.add_argument('--results-file', help="When exporting a manifest, write the outcome and time taken for each blend file to this JSON file")
     parser.add_argument('--log-level', help="Log level. One of: 'DEBUG', 'INFO', 'WARNING', 'ERROR' or CRITICAL", default='WARNING')
+    parser.add_argument('--use-export-cache', help="Reuse meshes and materials written by previous exports to the same folder", action='store_true')
+    parser.add_argument('--compact', help="Write the scene without any whitespace", action='store_true')
+    parser.add_argument('--incremental', help="Only encode the objects that changed since the last export of this scene", action='store_true')
+    parser.add_argument('--fsync', help="Flush every mesh, material and texture to disk before moving it into place", action='store_true')
+    parser.add_argument('--hardlink-textures', help="Hard link textures into the output folder rather than copying them. Only use this if source textures are never edited in place", action='store_true')
+    parser.add_argument('--scene-format', help="Write a RON .scn or a binary (CBOR) .scnb scene", choices=['ron', 'binary'], default='ron')
+    parser.add_argument('--instance-collections', help="Export each instanced collection once as a scene that its instances load, rather than making every instance real", action='store_true')
+    parser.add_argument('--batch-instances', help="Export objects that share a mesh and material, and only differ in their transform, as one entity per group", action='store_true')
+    parser.add_argument('--min-instances', help="Smallest number of objects batched together by --batch-instances", type=int, default=2)
+    parser.add_argument('--mesh-encoding', help="Store mesh attributes in less space. Can be given more than once", choices=['quantized_positions', 'snorm16_normals', 'octahedral_normals', 'snorm16_tangents', 'half_uvs', 'u16_indices'], action='append', default=[])
+    parser.add_argument('--optimize-mesh-order', help="Reorder the triangles and vertices of meshes so the GPU can reuse more transformed vertices. Slower to export", action='store_true')
+    parser.add_argument('--compression', help="Compress meshes, materials, instance transforms and binary scenes. RON scenes are never compressed", choices=['none', 'zstd', 'lz4'], default='none')
+    parser.add_argument('--compression-level', help="Compression level. Defaults to the library's default", type=int)
+    parser.add_argument('--material-dictionary', help="With --compression=zstd, train a dictionary on the materials of each export and compress them with it", action='store_true')
+    parser.add_argument('--vertex-merge-tolerance', help="Merge vertices whose attributes round to the same multiple of this. Zero only merges identical vertices", type=float, default=0.0)
+    parser.add_argument('--asset-hash', help="Digest used to name meshes, materials and textures. blake2b and xxhash are faster than md5, but give every file a new name. xxhash needs the xxhash python package", choices=['md5', 'blake2b', 'xxhash'], default='md5')
     config = parser.parse_args(args)
+    if (config.output_file is None) == (config.manifest is None):
+        parser.error("Exactly one of --output-file or --manifest is required")
+    if {'snorm16_normals', 'octahedral_normals'} <= set(config.mesh_encoding):
+        parser.error("Normals can only have one encoding: give --mesh-encoding snorm16_normals or octahedral_normals, not both")
+    if config.asset_hash == 'xxhash' and importlib.util.find_spec('xxhash') is None:
+        parser.error("--asset-hash=xxhash needs the xxhash python package installed into blender's python")
 
     logging.basicConfig(level=config.log_level)
 
@@ -33,12 +67,71 @@ required=True)
         blender_bevy_toolkit.register()
         blender_bevy_toolkit.load_handler(None)
 
+    if config.output_file is not None:
+        export_scene(blender_bevy_toolkit, config, config.output_file, None)
+        return
+
+    with open(config.manifest) as manifest_file:
+        jobs = json.load(manifest_file)
+
+    # Meshes and materials are cached by their contents, so the caches can be
+    # shared between all the scenes exported by this process
+    shared_caches = {}
+    failures = []
+    results = []
+    for job in jobs:
+        start = time.perf_counter()
+        try:
+            # Opening a file triggers the addon's load handler, which finds
+            # the components defined next to that file
+            bpy.ops.wm.open_mainfile(filepath=job["blend"])
+            export_scene(blender_bevy_toolkit, config, job["output"], shared_caches)
+        except Exception as err:
+            traceback.print_exc()
+            failures.append(job["blend"])
+            results.append(dict(job, ok=False, error=repr(err), seconds=time.perf_counter() - start))
+            print("FAILED {} ({:.2f}s)".format(job["blend"], time.perf_counter() - start))
+        else:
+            results.append(dict(job, ok=True, seconds=time.perf_counter() - start))
+            print("EXPORTED {} -> {} ({:.2f}s)".format(job["blend"], job["output"], time.perf_counter() - start))
+
+        if config.results_file is not None:
+            # Written after every file so that the results survive blender
+            # crashing part way through the manifest
+            with open(config.results_file, "w") as results_file:
+                json.dump(results, results_file)
+
+    if failures:
+        raise Exception("Failed to export: {}".format(", ".join(failures)))
+
+
+def export_scene(blender_bevy_toolkit, config, output_file, shared_caches):
+    # A new config for every scene, as the exporter fills it in as it goes
     blender_bevy_toolkit.do_export({
-        "output_filepath": config.output_file,
+        "output_filepath": output_file,
         "mesh_output_folder": "meshes",
         "material_output_folder": "materials",
         "texture_output_folder": "textures",
-        "make_duplicates_real": True
+        "collection_output_folder": "collections",
+        "instance_output_folder": "instances",
+        "make_duplicates_real": not config.instance_collections,
+        "vertex_merge_tolerance": config.vertex_merge_tolerance,
+        "use_export_cache": config.use_export_cache,
+        "export_cache_max_entries": 10000,
+        "compact_ron": config.compact,
+        "scene_format": config.scene_format,
+        "incremental_export": config.incremental,
+        "shared_caches": shared_caches,
+        "fsync_assets": config.fsync,
+        "hardlink_textures": config.hardlink_textures,
+        "asset_hash": config.asset_hash,
+        "mesh_encoding": config.mesh_encoding,
+        "optimize_mesh_order": config.optimize_mesh_order,
+        "asset_compression": config.compression,
+        "compression_level": config.compression_level,
+        "material_dictionary": config.material_dictionary,
+        "batch_instances": config.batch_instances,
+        "min_instances": config.min_instances,
     })
 
 
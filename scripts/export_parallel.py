@@ -0,0 +1,236 @@
+""" Exports lots of blend files at once using several blender processes. This
+is useful for large asset sets on machines with many cores.
+
+On the command line, call something like:
+	python scripts/export_parallel.py --manifest="test_scenes/manifest.json" --jobs=4
+
+The manifest is the same as for `export.py --manifest`. The blend files are
+split into chunks which are handed out to a pool of workers. Each worker runs
+blender in batch mode (`export.py --manifest`) on one chunk at a time, writing
+into a staging folder of its own. Once blender is done, the output is merged
+into the real output folders:
+
+ - Meshes, materials, textures, collection scenes and instance transforms
+   are named after their contents, so a file that already exists is the
+   same file. New files are hard linked into place, which fails rather than
+   overwrites if another worker got there first.
+ - Scenes are moved into place with an atomic rename, but only for the
+   blend files that exported successfully.
+
+A blend file that fails to export (or crashes blender) is reported at the
+end, without stopping the other blend files from exporting. If blender
+crashes, the files in the chunk it didn't get to are retried one at a time.
+
+Any arguments after `--` are passed on to export.py.
+
+Caches from previous exports (--use-export-cache, --incremental) only apply
+within a chunk, as every chunk starts with an empty staging folder.
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import argparse
+import threading
+import subprocess
+
+
+EXPORT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "export.py")
+
+# Folders of files that are named after their contents (see mesh.py and
+# material.py in blender_bevy_toolkit/definitions, and export_collection and
+# export_instance_group in blender_bevy_toolkit/export.py)
+CONTENT_FOLDERS = ("meshes", "materials", "textures", "collections", "instances")
+
+# Files written next to a scene: the binary scene and the fragments used by
+# incremental exports (see blender_bevy_toolkit/export.py)
+SCENE_SUFFIXES = (".scnb", ".fragments.json")
+
+
+def main(args):
+    export_args = []
+    if '--' in args:
+        export_args = args[args.index('--') + 1:]
+        args = args[:args.index('--')]
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--manifest', help="JSON file listing the blend files to export (see export.py)", required=True)
+    parser.add_argument('--blender', help="Path to the blender executable", default='blender')
+    parser.add_argument('--jobs', help="Number of blender processes to run at once", type=int, default=os.cpu_count())
+    parser.add_argument('--chunk-size', help="Number of blend files each blender process exports", type=int, default=4)
+    parser.add_argument('--log-level', help="Log level passed to export.py", default='WARNING')
+    config = parser.parse_args(args)
+
+    with open(config.manifest) as manifest_file:
+        jobs = json.load(manifest_file)
+    if not jobs:
+        return 0
+
+    # Staging folders are inside the output folder so that they are on the
+    # same filesystem, which is needed for renames and links to be atomic
+    output_root = os.path.commonpath([os.path.dirname(os.path.abspath(job["output"])) for job in jobs])
+
+    chunks = queue.Queue()
+    for i in range(0, len(jobs), config.chunk_size):
+        chunks.put(jobs[i:i + config.chunk_size])
+
+    results = []
+    results_lock = threading.Lock()
+    start = time.perf_counter()
+
+    workers = [
+        threading.Thread(
+            target=run_worker,
+            args=(worker_id, config, export_args, output_root, chunks, results, results_lock),
+        )
+        for worker_id in range(max(1, min(config.jobs, chunks.qsize())))
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    failures = [result for result in results if not result["ok"]]
+    print("Exported {} of {} blend files in {:.2f}s".format(
+        len(results) - len(failures), len(jobs), time.perf_counter() - start
+    ))
+    for result in failures:
+        print("FAILED {}: {}".format(result["blend"], result["error"]))
+        if result.get("log"):
+            print(result["log"])
+
+    return 1 if failures else 0
+
+
+def run_worker(worker_id, config, export_args, output_root, chunks, results, results_lock):
+    """Export chunks from the queue until there are none left"""
+    staging_root = os.path.join(output_root, ".export-staging-{}".format(worker_id))
+    while True:
+        try:
+            chunk = chunks.get_nowait()
+        except queue.Empty:
+            return
+
+        try:
+            chunk_results = export_chunk(config, export_args, output_root, staging_root, chunk)
+        except Exception as err:
+            chunk_results = [dict(job, ok=False, error=repr(err), seconds=0.0) for job in chunk]
+        finally:
+            shutil.rmtree(staging_root, ignore_errors=True)
+
+        unreported = [result for result in chunk_results if result.get("unreported")]
+        if unreported and len(chunk) > 1:
+            # Blender crashed part way through the chunk. Try the files it
+            # didn't get to on their own, so only the file that crashes it fails
+            for result in unreported:
+                chunks.put([{"blend": result["blend"], "output": result["output"]}])
+            chunk_results = [result for result in chunk_results if not result.get("unreported")]
+
+        with results_lock:
+            results.extend(chunk_results)
+            for result in chunk_results:
+                print("{} {} ({:.2f}s)".format(
+                    "EXPORTED" if result["ok"] else "FAILED", result["blend"], result["seconds"]
+                ))
+            sys.stdout.flush()
+
+
+def export_chunk(config, export_args, output_root, staging_root, chunk):
+    """Run blender on some blend files, then merge whatever it exported
+    into the output folders. Returns the result for each blend file"""
+    shutil.rmtree(staging_root, ignore_errors=True)
+    os.makedirs(staging_root)
+
+    staged_jobs = [
+        {
+            "blend": os.path.abspath(job["blend"]),
+            "output": os.path.join(staging_root, os.path.relpath(os.path.abspath(job["output"]), output_root)),
+        }
+        for job in chunk
+    ]
+    manifest_path = os.path.join(staging_root, "manifest.json")
+    results_path = os.path.join(staging_root, "results.json")
+    with open(manifest_path, "w") as manifest_file:
+        json.dump(staged_jobs, manifest_file)
+
+    command = [
+        config.blender, "-b", "--python", EXPORT_SCRIPT, "--python-exit-code=1", "--",
+        "--manifest={}".format(manifest_path),
+        "--results-file={}".format(results_path),
+        "--log-level={}".format(config.log_level),
+    ] + export_args
+    process = subprocess.run(
+        command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, errors="replace"
+    )
+
+    try:
+        with open(results_path) as results_file:
+            reported = {result["blend"]: result for result in json.load(results_file)}
+    except (OSError, ValueError):
+        reported = {}
+
+    # Content addressed files are valid even if a scene failed part way
+    # through, and have to be in place before any scene that uses them
+    merge_content(staging_root, output_root)
+
+    log_tail = "\n".join(process.stdout.splitlines()[-20:])
+    results = []
+    for job, staged in zip(chunk, staged_jobs):
+        result = reported.get(staged["blend"])
+        if result is None:
+            results.append(dict(
+                job, ok=False, seconds=0.0, log=log_tail, unreported=True,
+                error="blender exited with code {} before exporting this file".format(process.returncode),
+            ))
+        elif not result["ok"]:
+            results.append(dict(job, ok=False, seconds=result["seconds"], error=result["error"], log=log_tail))
+        else:
+            merge_scene(staged["output"], job["output"])
+            results.append(dict(job, ok=True, seconds=result["seconds"]))
+    return results
+
+
+def merge_content(staging_root, output_root):
+    """Move the content addressed files from a staging folder into the output
+    folder. Files that are already there are left alone"""
+    for root, _folders, files in os.walk(staging_root):
+        if os.path.basename(root) not in CONTENT_FOLDERS:
+            continue
+        for filename in files:
+            if filename.endswith(".tmp"):
+                # Left behind by blender crashing part way through writing
+                continue
+            source = os.path.join(root, filename)
+            destination = os.path.join(output_root, os.path.relpath(source, staging_root))
+            if os.path.exists(destination):
+                continue
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            try:
+                os.link(source, destination)
+            except FileExistsError:
+                # Another worker merged the same file first
+                pass
+            except OSError:
+                # Filesystems without hard links. The file contents are the
+                # same no matter which worker wrote it, so replacing is safe
+                os.replace(source, destination)
+
+
+def merge_scene(staged_output, output):
+    """Move a scene (and the files written alongside it) into place"""
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    staged_stem = os.path.splitext(staged_output)[0]
+    output_stem = os.path.splitext(output)[0]
+    candidates = [(staged_output, output)] + [
+        (staged_stem + suffix, output_stem + suffix) for suffix in SCENE_SUFFIXES
+    ]
+    for source, destination in candidates:
+        if os.path.exists(source):
+            os.replace(source, destination)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,4 +1,6 @@
-use bevy::prelude::*;
+use bevy::{
+    asset::LoadState, ecs::entity::EntityMap, prelude::*, reflect::TypeRegistryArc, utils::HashMap,
+};
 
 /// This component loads another collection and spawns it as a child
 /// of the entity with this component
@@ -8,26 +10,62 @@ pub struct BlendCollectionLoader {
     path: String,
 }
 
+/// Collections that have been loaded, keyed by path. Many instances of a
+/// collection share one `Scene`, which is only built once.
+#[derive(Default)]
+pub struct LoadedCollections {
+    loading: HashMap<String, Handle<DynamicScene>>,
+    loaded: HashMap<String, Handle<Scene>>,
+}
+
 pub fn blend_collection_loader(
     mut commands: Commands,
     asset_server: Res<AssetServer>,
     mut scene_spawner: ResMut<SceneSpawner>,
+    dynamic_scenes: Res<Assets<DynamicScene>>,
+    mut scenes: ResMut<Assets<Scene>>,
+    type_registry: Res<TypeRegistryArc>,
+    mut collections: Local<LoadedCollections>,
     query: Query<(&BlendCollectionLoader, Entity)>,
 ) {
     for (collectionloader, entity) in query.iter() {
-        //println!("Loading Collection {} for {:?}", collectionloader.path, entity);
-        commands.entity(entity).remove::<BlendCollectionLoader>();
+        let path = &collectionloader.path;
+        if !collections.loaded.contains_key(path) {
+            let collection_handle = collections
+                .loading
+                .entry(path.clone())
+                .or_insert_with(|| asset_server.load(path.as_str()))
+                .clone();
+            if asset_server.get_load_state(&collection_handle) == LoadState::Failed {
+                error!("Failed to load collection {}", path);
+                collections.loading.remove(path);
+                commands.entity(entity).remove::<BlendCollectionLoader>();
+                continue;
+            }
+            let dynamic_scene = match dynamic_scenes.get(&collection_handle) {
+                Some(dynamic_scene) => dynamic_scene,
+                // Still loading, try again next frame
+                None => continue,
+            };
 
-        let collection_handle: Handle<DynamicScene> =
-            asset_server.load(collectionloader.path.as_str());
+            // Only a `Scene` can be spawned as a child of an entity, so turn
+            // the collection into one
+            let mut world = World::default();
+            world.insert_resource(type_registry.clone());
+            if let Err(err) = dynamic_scene.write_to_world(&mut world, &mut EntityMap::default()) {
+                error!("Failed to load collection {}: {:?}", path, err);
+                collections.loading.remove(path);
+                commands.entity(entity).remove::<BlendCollectionLoader>();
+                continue;
+            }
+            collections.loading.remove(path);
+            collections
+                .loaded
+                .insert(path.clone(), scenes.add(Scene::new(world)));
+        }
 
-        // let dynscene = assets_dynscene.get(collection_handle).unwrap();
-        // let mut world = World::default();
-        // dynscene.write_to_world(&mut world, &mut entity_map).expect("Failed to create world");
-        // let scene: Scene = Scene::new(world);
-        // let scene_handle: Handle<Scene> = assets_scene.add(scene);
-
-        //TODO!!!!
-        scene_spawner.spawn_dynamic(collection_handle);
+        //println!("Loading Collection {} for {:?}", collectionloader.path, entity);
+        commands.entity(entity).remove::<BlendCollectionLoader>();
+        scene_spawner.spawn_as_child(collections.loaded[path].clone(), entity);
     }
 }
@@ -0,0 +1,115 @@
+use bevy::asset::LoadContext;
+use std::borrow::Cow;
+use std::collections::HashMap;
+use std::path::PathBuf;
+use std::sync::{Arc, Mutex};
+
+/// The first four bytes of a zstd frame and of an LZ4 frame
+const ZSTD_MAGIC: [u8; 4] = [0x28, 0xb5, 0x2f, 0xfd];
+const LZ4_MAGIC: [u8; 4] = [0x04, 0x22, 0x4d, 0x18];
+
+/// Decompresses the files written with compression enabled (see
+/// `blender_bevy_toolkit/compression.py`). Compressed files are recognised by
+/// the magic bytes at the start of every zstd and LZ4 frame, and anything
+/// else is passed through as it is, so a loader can use this on every file.
+///
+/// Files compressed with a dictionary name it by ID in their zstd frame
+/// header, and it is loaded from `<id>.zdict` next to the file. Dictionaries
+/// are shared by many files, so each is only read once.
+#[derive(Default)]
+pub struct Decompressor {
+    dictionaries: Mutex<HashMap<PathBuf, Arc<Vec<u8>>>>,
+}
+
+impl Decompressor {
+    pub async fn decompress<'b>(
+        &self,
+        bytes: &'b [u8],
+        load_context: &LoadContext<'_>,
+    ) -> Result<Cow<'b, [u8]>, anyhow::Error> {
+        if bytes.starts_with(&ZSTD_MAGIC) {
+            let dictionary = match zstd_dictionary_id(bytes) {
+                Some(id) => Some(self.dictionary(id, load_context).await?),
+                None => None,
+            };
+            let dictionary = dictionary.as_ref().map(|d| d.as_slice()).unwrap_or(&[]);
+            Ok(Cow::Owned(decompress_zstd(bytes, dictionary)?))
+        } else if bytes.starts_with(&LZ4_MAGIC) {
+            Ok(Cow::Owned(decompress_lz4(bytes)?))
+        } else {
+            Ok(Cow::Borrowed(bytes))
+        }
+    }
+
+    async fn dictionary(
+        &self,
+        id: u32,
+        load_context: &LoadContext<'_>,
+    ) -> Result<Arc<Vec<u8>>, anyhow::Error> {
+        let path = load_context
+            .path()
+            .with_file_name(format!("{:08x}.zdict", id));
+        let cached = self.dictionaries.lock().unwrap().get(&path).cloned();
+        if let Some(dictionary) = cached {
+            return Ok(dictionary);
+        }
+
+        let dictionary = Arc::new(load_context.read_asset_bytes(&path).await?);
+        self.dictionaries
+            .lock()
+            .unwrap()
+            .insert(path, dictionary.clone());
+        Ok(dictionary)
+    }
+}
+
+/// The dictionary ID in the header of a zstd frame, if it has one. See
+/// https://github.com/facebook/zstd/blob/dev/doc/zstd_compression_format.md#frame_header
+fn zstd_dictionary_id(frame: &[u8]) -> Option<u32> {
+    let descriptor = *frame.get(4)?;
+    let id_size = [0, 1, 2, 4][(descriptor & 0b11) as usize];
+    // Frames that aren't a single segment have a window descriptor first
+    let start = if descriptor & 0b10_0000 == 0 { 6 } else { 5 };
+    let id = frame
+        .get(start..start + id_size)?
+        .iter()
+        .rev()
+        .fold(0u32, |id, byte| (id << 8) | *byte as u32);
+    if id == 0 {
+        None
+    } else {
+        Some(id)
+    }
+}
+
+#[cfg(feature = "zstd")]
+fn decompress_zstd(bytes: &[u8], dictionary: &[u8]) -> Result<Vec<u8>, anyhow::Error> {
+    use std::io::Read;
+    let mut decoder = zstd::stream::read::Decoder::with_dictionary(bytes, dictionary)?;
+    let mut data = Vec::new();
+    decoder.read_to_end(&mut data)?;
+    Ok(data)
+}
+
+#[cfg(not(feature = "zstd"))]
+fn decompress_zstd(_bytes: &[u8], _dictionary: &[u8]) -> Result<Vec<u8>, anyhow::Error> {
+    Err(anyhow::anyhow!(
+        "File is compressed with zstd, but the zstd feature is disabled"
+    ))
+}
+
+#[cfg(feature = "lz4")]
+fn decompress_lz4(bytes: &[u8]) -> Result<Vec<u8>, anyhow::Error> {
+    use std::io::Read;
+    let mut decoder = lz4_flex::frame::FrameDecoder::new(bytes);
+    let mut data = Vec::new();
+    decoder.read_to_end(&mut data)?;
+    Ok(data)
+}
+
+#[cfg(not(feature = "lz4"))]
+fn decompress_lz4(_bytes: &[u8]) -> Result<Vec<u8>, anyhow::Error> {
+    Err(anyhow::anyhow!(
+        "File is compressed with LZ4, but the lz4 feature is disabled"
+    ))
+}
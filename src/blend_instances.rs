@@ -0,0 +1,171 @@
+use bevy::{
+    asset::{AssetLoader, LoadContext, LoadedAsset},
+    prelude::*,
+    reflect::TypeUuid,
+    utils::BoxedFuture,
+};
+use std::convert::TryInto;
+
+use crate::blend_compression::Decompressor;
+use crate::blend_label::BlendLabel;
+
+/// Loads the transforms of a group of objects that share a mesh and a
+/// material, and spawns a child entity for each of them. The entity with
+/// this component holds the mesh and material, and isn't drawn itself.
+#[derive(Reflect, Default, Component)]
+#[reflect(Component)]
+pub struct BlendInstancesLoader {
+    path: String,
+}
+
+/// The contents of an .instances file: the transform of every object in a
+/// batched group, and its name if the file has them
+#[derive(Debug, TypeUuid)]
+#[uuid = "c73f9245-99cc-4323-b8c5-f5474ab5025a"]
+pub struct InstanceTransforms {
+    pub transforms: Vec<Transform>,
+    pub names: Vec<String>,
+}
+
+pub fn blend_instances_loader(
+    mut commands: Commands,
+    asset_server: Res<AssetServer>,
+    query: Query<(&BlendInstancesLoader, Entity)>,
+) {
+    for (instancesloader, entity) in query.iter() {
+        commands.entity(entity).remove::<BlendInstancesLoader>();
+        let instances_handle: Handle<InstanceTransforms> =
+            asset_server.load(instancesloader.path.as_str());
+        commands.entity(entity).insert(instances_handle);
+    }
+}
+
+/// Once the transforms have loaded, spawn the instances. Each one shares
+/// the mesh and material handles of the group, so bevy can draw them
+/// together, and is labelled with the name of the object it came from.
+pub fn spawn_instances(
+    mut commands: Commands,
+    instance_transforms: Res<Assets<InstanceTransforms>>,
+    query: Query<(
+        &Handle<InstanceTransforms>,
+        &Handle<Mesh>,
+        &Handle<StandardMaterial>,
+        Entity,
+    )>,
+) {
+    for (instances_handle, mesh, material, entity) in query.iter() {
+        let instances = match instance_transforms.get(instances_handle) {
+            Some(instances) => instances,
+            None => continue,
+        };
+        commands
+            .entity(entity)
+            .remove::<Handle<InstanceTransforms>>();
+        commands.entity(entity).with_children(|parent| {
+            for (index, transform) in instances.transforms.iter().enumerate() {
+                let mut instance = parent.spawn_bundle(PbrBundle {
+                    mesh: mesh.clone(),
+                    material: material.clone(),
+                    transform: *transform,
+                    ..Default::default()
+                });
+                if let Some(name) = instances.names.get(index) {
+                    instance.insert(BlendLabel { name: name.clone() });
+                }
+            }
+        });
+    }
+}
+
+#[derive(Default)]
+pub struct BlendInstancesAssetLoader {
+    decompressor: Decompressor,
+}
+
+impl AssetLoader for BlendInstancesAssetLoader {
+    fn load<'a>(
+        &'a self,
+        bytes: &'a [u8],
+        load_context: &'a mut LoadContext,
+    ) -> BoxedFuture<'a, Result<(), anyhow::Error>> {
+        Box::pin(async move {
+            let bytes = self.decompressor.decompress(bytes, load_context).await?;
+            let instances = load_instances(&bytes)?;
+            load_context.set_default_asset(LoadedAsset::new(instances));
+            Ok(())
+        })
+    }
+
+    fn extensions(&self) -> &[&str] {
+        &["instances"]
+    }
+}
+
+/// Magic bytes at the start of an .instances file. See
+/// `blender_bevy_toolkit/instance_buffers.py` for the layout.
+const INSTANCES_MAGIC: &[u8; 4] = b"BBTI";
+const INSTANCES_VERSION: u16 = 1;
+const INSTANCES_HEADER_SIZE: usize = 12;
+const INSTANCE_SIZE: usize = 10 * 4;
+const INSTANCE_NAMES: u16 = 1 << 0;
+
+/// Reads a f32 from a buffer
+fn get_f32(arr: &[u8]) -> f32 {
+    f32::from_le_bytes(arr[0..4].try_into().unwrap())
+}
+
+/// Reads the name of every instance, each a u32 length followed by UTF-8
+fn parse_names(mut data: &[u8], num_instances: usize) -> Result<Vec<String>, anyhow::Error> {
+    let truncated = || anyhow::anyhow!("Instances file truncated");
+    let mut names = Vec::with_capacity(num_instances);
+    for _ in 0..num_instances {
+        let length =
+            u32::from_le_bytes(data.get(0..4).ok_or_else(truncated)?.try_into().unwrap()) as usize;
+        let name = data.get(4..4 + length).ok_or_else(truncated)?;
+        names.push(std::str::from_utf8(name)?.to_string());
+        data = &data[4 + length..];
+    }
+    Ok(names)
+}
+
+pub fn load_instances(data: &[u8]) -> Result<InstanceTransforms, anyhow::Error> {
+    if data.len() < INSTANCES_HEADER_SIZE || !data.starts_with(INSTANCES_MAGIC) {
+        return Err(anyhow::anyhow!("Not an instances file"));
+    }
+    let version = u16::from_le_bytes(data[4..6].try_into().unwrap());
+    if version > INSTANCES_VERSION {
+        return Err(anyhow::anyhow!(
+            "Instances file version {} is newer than supported version {}",
+            version,
+            INSTANCES_VERSION
+        ));
+    }
+    let flags = u16::from_le_bytes(data[6..8].try_into().unwrap());
+    if flags & !INSTANCE_NAMES != 0 {
+        return Err(anyhow::anyhow!("Unknown instances file flags {:#x}", flags));
+    }
+    let num_instances = u32::from_le_bytes(data[8..12].try_into().unwrap()) as usize;
+    let body_end = INSTANCES_HEADER_SIZE + num_instances * INSTANCE_SIZE;
+    let body = data
+        .get(INSTANCES_HEADER_SIZE..body_end)
+        .ok_or_else(|| anyhow::anyhow!("Instances file truncated"))?;
+
+    let transforms = body
+        .chunks(INSTANCE_SIZE)
+        .map(|instance| {
+            let value = |i: usize| get_f32(&instance[i * 4..]);
+            Transform {
+                translation: Vec3::new(value(0), value(1), value(2)),
+                rotation: Quat::from_xyzw(value(3), value(4), value(5), value(6)),
+                scale: Vec3::new(value(7), value(8), value(9)),
+            }
+        })
+        .collect();
+
+    let names = if flags & INSTANCE_NAMES != 0 {
+        parse_names(&data[body_end..], num_instances)?
+    } else {
+        Vec::new()
+    };
+    Ok(InstanceTransforms { transforms, names })
+}
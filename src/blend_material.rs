@@ -7,12 +7,22 @@ use ron;
 use serde::{Deserialize, Serialize};
 use std::path::Path;
 
+use crate::blend_compression::Decompressor;
+
 #[derive(Reflect, Default, Component)]
 #[reflect(Component)] // this tells the reflect derive to also reflect component behaviors
 pub struct BlendMaterialLoader {
     path: String,
 }
 
+/// The material of each submesh of a mesh with several materials. Used by
+/// `blend_submesh_loader` in `blend_mesh.rs`
+#[derive(Reflect, Default, Component)]
+#[reflect(Component)]
+pub struct BlendSubmeshMaterials {
+    pub paths: Vec<String>,
+}
+
 pub fn blend_material_loader(
     mut commands: Commands,
     asset_server: Res<AssetServer>,
@@ -29,7 +39,9 @@ pub fn blend_material_loader(
 }
 
 #[derive(Default)]
-pub struct BlendMaterialAssetLoader;
+pub struct BlendMaterialAssetLoader {
+    decompressor: Decompressor,
+}
 
 impl AssetLoader for BlendMaterialAssetLoader {
     fn load<'a>(
@@ -38,7 +50,9 @@ impl AssetLoader for BlendMaterialAssetLoader {
         load_context: &'a mut LoadContext,
     ) -> BoxedFuture<'a, Result<(), anyhow::Error>> {
         Box::pin(async move {
-            let material_raw: BlenderStandardMaterial = ron::from_str(std::str::from_utf8(bytes)?)?;
+            let bytes = self.decompressor.decompress(bytes, load_context).await?;
+            let material_raw: BlenderStandardMaterial =
+                ron::from_str(std::str::from_utf8(&bytes)?)?;
 
             let mut material = StandardMaterial {
                 base_color: material_raw.base_color,
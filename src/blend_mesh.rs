@@ -1,17 +1,36 @@
 use bevy::{
-    asset::{AssetLoader, LoadContext},
+    asset::{AssetLoader, LoadContext, LoadState},
     prelude::*,
     render::{mesh::Indices, render_resource::PrimitiveTopology},
-    utils::BoxedFuture,
+    utils::{BoxedFuture, HashMap},
 };
 use std::convert::TryInto;
 
+use crate::blend_compression::Decompressor;
+use crate::blend_material::BlendSubmeshMaterials;
+
 #[derive(Reflect, Default, Component)]
 #[reflect(Component)] // this tells the reflect derive to also reflect component behaviors
 pub struct BlendMeshLoader {
     path: String,
 }
 
+/// Loads a mesh that is split into a submesh per material slot, and spawns
+/// a child entity for each submesh. The materials come from the
+/// `BlendSubmeshMaterials` component on the same entity.
+#[derive(Reflect, Default, Component)]
+#[reflect(Component)]
+pub struct BlendSubmeshLoader {
+    path: String,
+}
+
+/// The .mesh files of `BlendSubmeshLoader`s that are still loading, keyed
+/// by path
+#[derive(Default)]
+pub struct LoadingSubmeshes {
+    loading: HashMap<String, Handle<Mesh>>,
+}
+
 type FVec4Arr = Vec<[f32; 4]>;
 type FVec3Arr = Vec<[f32; 3]>;
 type FVec2Arr = Vec<[f32; 2]>;
@@ -29,8 +48,70 @@ pub fn blend_mesh_loader(
     }
 }
 
+/// Once the mesh has loaded, spawn a child for each of its submeshes.
+/// Material slots without any faces have an empty submesh, which isn't
+/// added as an asset (see `BlendMeshAssetLoader`), so no child is spawned
+/// for them.
+pub fn blend_submesh_loader(
+    mut commands: Commands,
+    asset_server: Res<AssetServer>,
+    meshes: Res<Assets<Mesh>>,
+    mut submeshes: Local<LoadingSubmeshes>,
+    query: Query<(&BlendSubmeshLoader, &BlendSubmeshMaterials, Entity)>,
+) {
+    for (meshloader, materials, entity) in query.iter() {
+        let path = &meshloader.path;
+        let mesh_handle = submeshes
+            .loading
+            .entry(path.clone())
+            .or_insert_with(|| asset_server.load(path.as_str()))
+            .clone();
+        if asset_server.get_load_state(&mesh_handle) == LoadState::Failed {
+            error!("Failed to load mesh {}", path);
+            submeshes.loading.remove(path);
+            commands
+                .entity(entity)
+                .remove::<BlendSubmeshLoader>()
+                .remove::<BlendSubmeshMaterials>();
+            continue;
+        }
+        // The submeshes are added to the mesh assets together with the
+        // whole mesh. Until then it is still loading, so try again next frame
+        if meshes.get(&mesh_handle).is_none() {
+            continue;
+        }
+        submeshes.loading.remove(path);
+
+        commands
+            .entity(entity)
+            .remove::<BlendSubmeshLoader>()
+            .remove::<BlendSubmeshMaterials>();
+        commands.entity(entity).with_children(|parent| {
+            for (index, material_path) in materials.paths.iter().enumerate() {
+                let mesh_path = format!("{}#{}", path, submesh_label(index));
+                let submesh: Handle<Mesh> = asset_server.get_handle(mesh_path.as_str());
+                if meshes.get(&submesh).is_none() {
+                    continue;
+                }
+                parent.spawn_bundle(PbrBundle {
+                    mesh: submesh,
+                    material: asset_server.load(material_path.as_str()),
+                    ..Default::default()
+                });
+            }
+        });
+    }
+}
+
+/// The label of the mesh asset for one submesh of a .mesh file
+fn submesh_label(index: usize) -> String {
+    format!("Submesh{}", index)
+}
+
 #[derive(Default)]
-pub struct BlendMeshAssetLoader;
+pub struct BlendMeshAssetLoader {
+    decompressor: Decompressor,
+}
 
 impl AssetLoader for BlendMeshAssetLoader {
     fn load<'a>(
@@ -39,10 +120,20 @@ impl AssetLoader for BlendMeshAssetLoader {
         load_context: &'a mut LoadContext,
     ) -> BoxedFuture<'a, Result<(), anyhow::Error>> {
         Box::pin(async move {
-            let mesh = load_mesh(bytes);
-            let asset = bevy::asset::LoadedAsset::new(mesh);
+            let bytes = self.decompressor.decompress(bytes, load_context).await?;
+            let buffers = extact_buffers_from_mesh(&bytes)?;
+            for (index, submesh) in buffers.submeshes.iter().enumerate() {
+                // Material slots without any faces
+                if submesh.num_faces == 0 {
+                    continue;
+                }
+                let mesh = build_mesh(buffers.submesh(submesh)?);
+                load_context
+                    .set_labeled_asset(&submesh_label(index), bevy::asset::LoadedAsset::new(mesh));
+            }
 
-            load_context.set_default_asset(asset);
+            let mesh = build_mesh(buffers);
+            load_context.set_default_asset(bevy::asset::LoadedAsset::new(mesh));
             Ok(())
         })
     }
@@ -52,16 +143,30 @@ impl AssetLoader for BlendMeshAssetLoader {
     }
 }
 
-pub fn load_mesh(data: &[u8]) -> Mesh {
-    let (indices, positions, tangents, normals, uv0s) = extact_buffers_from_mesh(data);
-    let indices = Indices::U32(indices);
+pub fn load_mesh(data: &[u8]) -> Result<Mesh, anyhow::Error> {
+    Ok(build_mesh(extact_buffers_from_mesh(data)?))
+}
+
+/// Creates a bevy mesh from the contents of a .mesh file
+fn build_mesh(buffers: MeshBuffers) -> Mesh {
+    let indices = if buffers.small_indices {
+        Indices::U16(buffers.indices.iter().map(|&index| index as u16).collect())
+    } else {
+        Indices::U32(buffers.indices)
+    };
 
     let mut mesh = Mesh::new(PrimitiveTopology::TriangleList);
     mesh.set_indices(Some(indices));
-    mesh.set_attribute(Mesh::ATTRIBUTE_POSITION, positions);
-    mesh.set_attribute(Mesh::ATTRIBUTE_NORMAL, normals);
-    mesh.set_attribute(Mesh::ATTRIBUTE_UV_0, uv0s);
-    mesh.set_attribute(Mesh::ATTRIBUTE_TANGENT, tangents);
+    mesh.set_attribute(Mesh::ATTRIBUTE_POSITION, buffers.positions);
+    if let Some(normals) = buffers.normals {
+        mesh.set_attribute(Mesh::ATTRIBUTE_NORMAL, normals);
+    }
+    if let Some(uv0s) = buffers.uv0 {
+        mesh.set_attribute(Mesh::ATTRIBUTE_UV_0, uv0s);
+    }
+    if let Some(tangents) = buffers.tangents {
+        mesh.set_attribute(Mesh::ATTRIBUTE_TANGENT, tangents);
+    }
     mesh
 }
 
@@ -69,7 +174,7 @@ pub fn load_mesh(data: &[u8]) -> Mesh {
 fn get_f32(arr: &[u8]) -> f32 {
     f32::from_le_bytes(arr[0..4].try_into().unwrap())
 }
-/// Reads a u16 from a buffer
+/// Reads a u32 from a buffer
 fn get_u32(arr: &[u8]) -> u32 {
     u32::from_le_bytes(arr[0..4].try_into().unwrap())
 }
@@ -116,18 +221,333 @@ fn parse_u32_array(data: &[u8], num_elements: usize) -> Vec<u32> {
     out_array
 }
 
-/// Converts the bytes of a binary stl file into a vector of face indices,
-/// vertices and vertex normals.
-/// Expects correctly formatted STL files
-fn extact_buffers_from_mesh(mesh: &[u8]) -> (Vec<u32>, FVec3Arr, FVec4Arr, FVec3Arr, FVec2Arr) {
-    let num_verts = u16::from_le_bytes(mesh[0..2].try_into().unwrap()) as usize;
-    let num_faces = u16::from_le_bytes(mesh[2..4].try_into().unwrap()) as usize;
+/// Reads a i16 from a buffer, as a value between -1 and 1
+fn get_snorm16(arr: &[u8]) -> f32 {
+    (i16::from_le_bytes(arr[0..2].try_into().unwrap()) as f32 / 32767.0).max(-1.0)
+}
+
+/// Reads a half precision float from a buffer
+fn get_f16(arr: &[u8]) -> f32 {
+    let bits = get_u16(arr) as u32;
+    let sign = (bits & 0x8000) << 16;
+    let exponent = (bits >> 10) & 0x1f;
+    let mantissa = bits & 0x3ff;
+    let magnitude = match exponent {
+        // Zero and subnormals
+        0 => mantissa as f32 * (1.0 / (1 << 24) as f32),
+        // Infinity and NaN
+        0x1f => f32::from_bits(0x7f80_0000 | (mantissa << 13)),
+        _ => f32::from_bits(((exponent + 127 - 15) << 23) | (mantissa << 13)),
+    };
+    f32::from_bits(magnitude.to_bits() | sign)
+}
+
+/// Converts u16 steps across a bounding box into positions. The minimum and
+/// size of the box are in `bounds`
+fn parse_quantized_positions(bounds: &[u8], data: &[u8], num_elements: usize) -> FVec3Arr {
+    let minimum = [
+        get_f32(bounds),
+        get_f32(&bounds[4..]),
+        get_f32(&bounds[8..]),
+    ];
+    let step = [
+        get_f32(&bounds[12..]) / 65535.0,
+        get_f32(&bounds[16..]) / 65535.0,
+        get_f32(&bounds[20..]) / 65535.0,
+    ];
+    let mut out_array = Vec::with_capacity(num_elements);
+    for i in 0..num_elements {
+        let mut position = [0.0; 3];
+        for axis in 0..3 {
+            let steps = get_u16(&data[i * 6 + axis * 2..]) as f32;
+            position[axis] = minimum[axis] + steps * step[axis];
+        }
+        out_array.push(position);
+    }
+    out_array
+}
+
+/// Converts octahedral encoded unit vectors back into vec3's
+fn parse_octahedral_array(data: &[u8], num_elements: usize) -> FVec3Arr {
+    let mut out_array = Vec::with_capacity(num_elements);
+    for i in 0..num_elements {
+        let mut x = get_snorm16(&data[i * 4..]);
+        let mut y = get_snorm16(&data[i * 4 + 2..]);
+        let z = 1.0 - x.abs() - y.abs();
+        if z < 0.0 {
+            // Unfold the lower half of the octahedron
+            let folded_x = (1.0 - y.abs()) * if x >= 0.0 { 1.0 } else { -1.0 };
+            y = (1.0 - x.abs()) * if y >= 0.0 { 1.0 } else { -1.0 };
+            x = folded_x;
+        }
+        out_array.push(Vec3::new(x, y, z).normalize_or_zero().to_array());
+    }
+    out_array
+}
+
+/// Converts i16's into vec3's with components between -1 and 1
+fn parse_snorm16_vec3_array(data: &[u8], num_elements: usize) -> FVec3Arr {
+    let mut out_array = Vec::with_capacity(num_elements);
+    for i in 0..num_elements {
+        out_array.push([
+            get_snorm16(&data[i * 6..]),
+            get_snorm16(&data[i * 6 + 2..]),
+            get_snorm16(&data[i * 6 + 4..]),
+        ]);
+    }
+    out_array
+}
+
+/// Converts i16's into vec4's with components between -1 and 1
+fn parse_snorm16_vec4_array(data: &[u8], num_elements: usize) -> FVec4Arr {
+    let mut out_array = Vec::with_capacity(num_elements);
+    for i in 0..num_elements {
+        out_array.push([
+            get_snorm16(&data[i * 8..]),
+            get_snorm16(&data[i * 8 + 2..]),
+            get_snorm16(&data[i * 8 + 4..]),
+            get_snorm16(&data[i * 8 + 6..]),
+        ]);
+    }
+    out_array
+}
+
+/// Converts half precision floats into vec2's
+fn parse_half_vec2_array(data: &[u8], num_elements: usize) -> FVec2Arr {
+    let mut out_array = Vec::with_capacity(num_elements);
+    for i in 0..num_elements {
+        out_array.push([get_f16(&data[i * 4..]), get_f16(&data[i * 4 + 2..])]);
+    }
+    out_array
+}
+
+/// Converts a slice of u8's into a vec of u32's
+fn parse_u16_array(data: &[u8], num_elements: usize) -> Vec<u32> {
+    let mut out_array = Vec::with_capacity(num_elements);
+    for i in 0..num_elements {
+        out_array.push(get_u16(&data[i * 2..]) as u32);
+    }
+    out_array
+}
+
+/// The contents of a .mesh file
+struct MeshBuffers {
+    indices: Vec<u32>,
+    positions: FVec3Arr,
+    normals: Option<FVec3Arr>,
+    tangents: Option<FVec4Arr>,
+    uv0: Option<FVec2Arr>,
+    submeshes: Vec<Submesh>,
+    /// The indices were stored as u16, so they are kept that way
+    small_indices: bool,
+}
+
+/// Where the vertices and triangles of one submesh are in a .mesh file
+struct Submesh {
+    first_vertex: usize,
+    num_verts: usize,
+    first_face: usize,
+    num_faces: usize,
+}
+
+impl MeshBuffers {
+    /// Copies out the vertices and triangles of one submesh, with the
+    /// indices changed to refer to the copied vertices
+    fn submesh(&self, submesh: &Submesh) -> Result<MeshBuffers, anyhow::Error> {
+        let verts = submesh.first_vertex..submesh.first_vertex + submesh.num_verts;
+        let faces = submesh.first_face * 3..(submesh.first_face + submesh.num_faces) * 3;
+        if verts.end > self.positions.len() || faces.end > self.indices.len() {
+            return Err(anyhow::anyhow!("Submesh out of range"));
+        }
+        let first_vertex = submesh.first_vertex as u32;
+        Ok(MeshBuffers {
+            indices: self.indices[faces]
+                .iter()
+                .map(|index| index - first_vertex)
+                .collect(),
+            positions: self.positions[verts.clone()].to_vec(),
+            normals: self.normals.as_ref().map(|a| a[verts.clone()].to_vec()),
+            tangents: self.tangents.as_ref().map(|a| a[verts.clone()].to_vec()),
+            uv0: self.uv0.as_ref().map(|a| a[verts].to_vec()),
+            submeshes: Vec::new(),
+            small_indices: self.small_indices,
+        })
+    }
+}
+
+/// Magic bytes at the start of a .mesh file with a versioned header. See
+/// `blender_bevy_toolkit/mesh_buffers.py` for the layout.
+const MESH_MAGIC: &[u8; 4] = b"BBTM";
+const MESH_VERSION: u16 = 3;
+const MESH_HEADER_SIZE: usize = 36;
+const SUBMESH_SIZE: usize = 16;
+
+const ATTRIBUTE_POSITION: u16 = 1 << 0;
+const ATTRIBUTE_NORMAL: u16 = 1 << 1;
+const ATTRIBUTE_TANGENT: u16 = 1 << 2;
+const ATTRIBUTE_UV0: u16 = 1 << 3;
+const SUBMESHES: u16 = 1 << 4;
+
+const NORMAL_SNORM16: u16 = 1 << 5;
+const NORMAL_OCTAHEDRAL: u16 = 1 << 6;
+const TANGENT_SNORM16: u16 = 1 << 7;
+const UV0_HALF: u16 = 1 << 8;
+const POSITION_QUANTIZED: u16 = 1 << 9;
+const INDEX_U16: u16 = 1 << 10;
+
+/// Returns the part of the buffer starting at `start` that is `len` bytes long,
+/// or an error if the file is too short
+fn get_block(data: &[u8], start: usize, len: usize) -> Result<&[u8], anyhow::Error> {
+    data.get(start..start + len)
+        .ok_or_else(|| anyhow::anyhow!("Mesh file truncated"))
+}
+
+/// Reads a u16 from a buffer
+fn get_u16(arr: &[u8]) -> u16 {
+    u16::from_le_bytes(arr[0..2].try_into().unwrap())
+}
+
+/// Converts the bytes of a .mesh file into a vector of face indices and
+/// the vertex attributes. Both the versioned and the original
+/// (unversioned) layouts are supported.
+fn extact_buffers_from_mesh(mesh: &[u8]) -> Result<MeshBuffers, anyhow::Error> {
+    if mesh.starts_with(MESH_MAGIC) {
+        extract_buffers_versioned(mesh)
+    } else {
+        extract_buffers_legacy(mesh)
+    }
+}
+
+/// Reads a mesh file with a versioned header
+fn extract_buffers_versioned(mesh: &[u8]) -> Result<MeshBuffers, anyhow::Error> {
+    let header = get_block(mesh, 0, MESH_HEADER_SIZE)?;
+    let version = get_u16(&header[4..]);
+    if version > MESH_VERSION {
+        return Err(anyhow::anyhow!(
+            "Mesh file version {} is newer than supported version {}",
+            version,
+            MESH_VERSION
+        ));
+    }
+    let flags = get_u16(&header[6..]);
+    let num_verts = get_u32(&header[8..]) as usize;
+    let num_faces = get_u32(&header[12..]) as usize;
+    let positions_start = get_u32(&header[16..]) as usize;
+    let normals_start = get_u32(&header[20..]) as usize;
+    let tangents_start = get_u32(&header[24..]) as usize;
+    let uv0_start = get_u32(&header[28..]) as usize;
+    let indices_start = get_u32(&header[32..]) as usize;
+
+    if flags & ATTRIBUTE_POSITION == 0 {
+        return Err(anyhow::anyhow!("Mesh file has no vertex positions"));
+    }
+    let positions = if flags & POSITION_QUANTIZED != 0 {
+        let bounds = get_block(mesh, positions_start, 4 * 6)?;
+        parse_quantized_positions(
+            bounds,
+            get_block(mesh, positions_start + 4 * 6, num_verts * 2 * 3)?,
+            num_verts,
+        )
+    } else {
+        parse_vec3_array(
+            get_block(mesh, positions_start, num_verts * 4 * 3)?,
+            num_verts,
+        )
+    };
+
+    let normals = if flags & ATTRIBUTE_NORMAL == 0 {
+        None
+    } else if flags & NORMAL_OCTAHEDRAL != 0 {
+        Some(parse_octahedral_array(
+            get_block(mesh, normals_start, num_verts * 2 * 2)?,
+            num_verts,
+        ))
+    } else if flags & NORMAL_SNORM16 != 0 {
+        Some(parse_snorm16_vec3_array(
+            get_block(mesh, normals_start, num_verts * 2 * 3)?,
+            num_verts,
+        ))
+    } else {
+        Some(parse_vec3_array(
+            get_block(mesh, normals_start, num_verts * 4 * 3)?,
+            num_verts,
+        ))
+    };
+    let tangents = if flags & ATTRIBUTE_TANGENT == 0 {
+        None
+    } else if flags & TANGENT_SNORM16 != 0 {
+        Some(parse_snorm16_vec4_array(
+            get_block(mesh, tangents_start, num_verts * 2 * 4)?,
+            num_verts,
+        ))
+    } else {
+        Some(parse_vec4_array(
+            get_block(mesh, tangents_start, num_verts * 4 * 4)?,
+            num_verts,
+        ))
+    };
+    let uv0 = if flags & ATTRIBUTE_UV0 == 0 {
+        None
+    } else if flags & UV0_HALF != 0 {
+        Some(parse_half_vec2_array(
+            get_block(mesh, uv0_start, num_verts * 2 * 2)?,
+            num_verts,
+        ))
+    } else {
+        Some(parse_vec2_array(
+            get_block(mesh, uv0_start, num_verts * 4 * 2)?,
+            num_verts,
+        ))
+    };
+    let small_indices = flags & INDEX_U16 != 0;
+    let index_size = if small_indices { 2 } else { 4 };
+    let index_block = get_block(mesh, indices_start, num_faces * 3 * index_size)?;
+    let indices = if small_indices {
+        parse_u16_array(index_block, num_faces * 3)
+    } else {
+        parse_u32_array(index_block, num_faces * 3)
+    };
+
+    // The submesh table follows the index block
+    let mut submeshes = Vec::new();
+    if flags & SUBMESHES != 0 {
+        let table_start = indices_start + num_faces * 3 * index_size;
+        let num_submeshes = get_u32(get_block(mesh, table_start, 4)?) as usize;
+        let table = get_block(mesh, table_start + 4, num_submeshes * SUBMESH_SIZE)?;
+        for entry in table.chunks(SUBMESH_SIZE) {
+            submeshes.push(Submesh {
+                first_vertex: get_u32(&entry[0..]) as usize,
+                num_verts: get_u32(&entry[4..]) as usize,
+                first_face: get_u32(&entry[8..]) as usize,
+                num_faces: get_u32(&entry[12..]) as usize,
+            });
+        }
+    }
+
+    Ok(MeshBuffers {
+        indices,
+        positions,
+        normals,
+        tangents,
+        uv0,
+        submeshes,
+        small_indices,
+    })
+}
+
+/// Reads a mesh file written before the header was versioned. These have
+/// u16 vertex and face counts and always contain every attribute.
+fn extract_buffers_legacy(mesh: &[u8]) -> Result<MeshBuffers, anyhow::Error> {
+    let header = get_block(mesh, 0, 4)?;
+    let num_verts = get_u16(&header[0..]) as usize;
+    let num_faces = get_u16(&header[2..]) as usize;
 
     let verts_start = 4;
     let normals_start = verts_start + num_verts * 4 * 3;
     let tangents_start = normals_start + num_verts * 4 * 3;
     let uv0_start = tangents_start + num_verts * 4 * 4;
     let indices_start = uv0_start + num_verts * 4 * 2;
+    get_block(mesh, indices_start, num_faces * 3 * 4)?;
 
     let positions = parse_vec3_array(&mesh[verts_start..], num_verts);
     let normals = parse_vec3_array(&mesh[normals_start..], num_verts);
@@ -135,5 +555,13 @@ fn extact_buffers_from_mesh(mesh: &[u8]) -> (Vec<u32>, FVec3Arr, FVec4Arr, FVec3
     let uv0 = parse_vec2_array(&mesh[uv0_start..], num_verts);
     let indices = parse_u32_array(&mesh[indices_start..], num_faces * 3);
 
-    (indices, positions, tangents, normals, uv0)
+    Ok(MeshBuffers {
+        indices,
+        positions,
+        normals: Some(normals),
+        tangents: Some(tangents),
+        uv0: Some(uv0),
+        submeshes: Vec::new(),
+        small_indices: false,
+    })
 }
@@ -0,0 +1,54 @@
+use bevy::{
+    asset::{AssetLoader, LoadContext, LoadedAsset},
+    prelude::*,
+    reflect::TypeRegistryArc,
+    scene::serde::SceneDeserializer,
+    utils::BoxedFuture,
+};
+use serde::de::DeserializeSeed;
+
+use crate::blend_compression::Decompressor;
+
+/// Loads the binary (.scnb) scenes written by the exporter when the scene
+/// format is set to binary. These hold the same data as a .scn file, but
+/// encoded as CBOR rather than RON, which is much faster to parse for large
+/// scenes. They load into a `DynamicScene` just like a .scn file does, and
+/// may be compressed (see `blend_compression.rs`).
+pub struct BlendBinarySceneLoader {
+    type_registry: TypeRegistryArc,
+    decompressor: Decompressor,
+}
+
+impl FromWorld for BlendBinarySceneLoader {
+    fn from_world(world: &mut World) -> Self {
+        let type_registry = world.get_resource::<TypeRegistryArc>().unwrap();
+        Self {
+            type_registry: (&*type_registry).clone(),
+            decompressor: Decompressor::default(),
+        }
+    }
+}
+
+impl AssetLoader for BlendBinarySceneLoader {
+    fn load<'a>(
+        &'a self,
+        bytes: &'a [u8],
+        load_context: &'a mut LoadContext,
+    ) -> BoxedFuture<'a, Result<(), anyhow::Error>> {
+        Box::pin(async move {
+            let bytes = self.decompressor.decompress(bytes, load_context).await?;
+            let mut deserializer = serde_cbor::Deserializer::from_slice(&bytes);
+            let scene_deserializer = SceneDeserializer {
+                type_registry: &*self.type_registry.read(),
+            };
+            let scene = scene_deserializer.deserialize(&mut deserializer)?;
+            deserializer.end()?;
+            load_context.set_default_asset(LoadedAsset::new(scene));
+            Ok(())
+        })
+    }
+
+    fn extensions(&self) -> &[&str] {
+        &["scnb"]
+    }
+}